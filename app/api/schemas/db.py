@@ -6,6 +6,20 @@ class QueryDB(BaseModel):
     query_text: Text
     threshold: Optional[float] = 0.8
     limit: Optional[int] = 10
+    offset: Optional[int] = 0
+    # fields to return besides ids
+    include: Optional[List[Literal['documents', 'metadatas', 'distances', 'embeddings']]] = None
+    # chromadb style metadata filter, e.g. {"source": "google"} or {"year": {"$gte": 2020}}
+    where: Optional[Dict[Text, Any]] = None
+    # fuse BM25 and vector rankings, default from the HYBRID_SEARCH env var
+    hybrid: Optional[bool] = None
+    # json, csv, or streamed as ndjson (jsonl) or arrow (Arrow IPC stream)
+    return_type_option: Optional[Text] = 'json'
+
+class QueryBatchDB(BaseModel):
+    query_texts: List[Text]
+    threshold: Optional[Union[float, List[float]]] = 0.8
+    limit: Optional[int] = 10
     return_type_option: Optional[Text] = 'json'
 
 class InsertDB(BaseModel):
@@ -14,6 +28,8 @@ class InsertDB(BaseModel):
     data: Optional[Text] = None
     path: Optional[Text] = None
     authen: Optional[Text] = None
+    chunk_size: Optional[int] = None
+    persist_every: Optional[int] = 10
 
 
 class Ask(BaseModel):
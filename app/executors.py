@@ -0,0 +1,74 @@
+import os
+import asyncio
+import functools
+from typing import Any, Callable, Text
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ExecutorSaturated(Exception):
+    """
+    Raised when an executor already holds as many calls as it can run and queue
+    """
+
+    def __init__(self, name: Text):
+        super().__init__("{} executor is saturated, retry later".format(name))
+        self.name = name
+
+
+class BoundedExecutor:
+    """
+    Thread pool for blocking calls from async handlers, with a bounded queue for backpressure
+
+    Attributes:
+        name (Text): name used in errors and thread names
+        max_workers (int): calls running at the same time
+        max_queue (int): calls allowed to wait for a worker, more are rejected with ExecutorSaturated
+    """
+
+    def __init__(self, name: Text, max_workers: int, max_queue: int):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        # only touched from the event loop thread, no lock needed
+        self._in_flight = 0
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        """
+        Run func in the pool without blocking the event loop
+
+        Args:
+            func: blocking function
+
+        Returns:
+            result of func
+        """
+        if self._in_flight >= self.max_workers + self.max_queue:
+            raise ExecutorSaturated(self.name)
+        self._in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._pool,
+                                                                    functools.partial(func, *args, **kwargs))
+        finally:
+            self._in_flight -= 1
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+# slow network calls to chat bots
+bot_executor = BoundedExecutor("bot",
+                               max_workers=int(os.getenv("BOT_WORKERS", 16)),
+                               max_queue=int(os.getenv("BOT_QUEUE", 64)))
+# model encode + collection query, CPU bound so kept close to the number of cores
+query_executor = BoundedExecutor("query",
+                                 max_workers=int(os.getenv("QUERY_WORKERS", os.cpu_count() or 2)),
+                                 max_queue=int(os.getenv("QUERY_QUEUE", 128)))
+# inserts are serialized by DBMS anyway, one worker keeps them from starving queries
+write_executor = BoundedExecutor("write",
+                                 max_workers=int(os.getenv("WRITE_WORKERS", 1)),
+                                 max_queue=int(os.getenv("WRITE_QUEUE", 8)))
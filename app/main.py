@@ -1,13 +1,15 @@
+import os
 import uvicorn
-import pandas as pd
 from typing import Any
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
 from starlette.middleware import Middleware
 from starlette.middleware.cors import CORSMiddleware
 
 from app.api.schemas import db
-from tools.components.APIs.libs.download import fetch_data_as_dataframe
-from app.services import get_db_services_instance, get_query_db_json, get_bot_services_instance
+from app.services import ask_bot, query_db, query_batch_db, insert_db, get_db_services_instance, get_readiness, \
+    flush_db_services, STREAM_MEDIA_TYPES
+from app.executors import ExecutorSaturated, bot_executor, query_executor, write_executor
 
 middleware = [
     Middleware(CORSMiddleware,
@@ -19,11 +21,37 @@ middleware = [
 
 app = FastAPI(middleware=middleware)
 
+@app.exception_handler(ExecutorSaturated)
+async def executor_saturated(request: Request, exc: ExecutorSaturated):
+    """Reject requests while the executor serving them is full."""
+    return JSONResponse(status_code=429,
+                        content={"status": "Error", "message": str(exc)},
+                        headers={"Retry-After": "1"})
+
+@app.on_event("startup")
+async def startup():
+    # load the model and collection in the background so the server accepts requests right away
+    if os.getenv("WARM_UP", "1") == "1":
+        get_db_services_instance().warm_up(background=True)
+
+@app.on_event("shutdown")
+async def shutdown():
+    for executor in (bot_executor, query_executor, write_executor):
+        executor.shutdown()
+    # persist what is still only in the write-ahead log
+    flush_db_services()
+
 @app.get("/")
 async def root():
     """Root page."""
     return {"text": f"Hello, This is an api for COT backend"}
 
+@app.get("/ready")
+async def ready():
+    """Readiness probe, 503 until the database model and collection are loaded."""
+    readiness = get_readiness()
+    return JSONResponse(status_code=200 if readiness["ready"] else 503, content=readiness)
+
 @app.post('/ask/')
 async def ask(data: db.Ask) -> Any:
     """
@@ -35,8 +63,7 @@ async def ask(data: db.Ask) -> Any:
     Returns:
         Union[Text, List[Text]]: Response from the bot.
     """
-    bot_services = get_bot_services_instance()
-    answer = bot_services.ask(data.question)
+    answer = await bot_executor.run(ask_bot, data.question)
     return {"answer": answer}
 
 @app.post("/query/")
@@ -48,18 +75,25 @@ async def query(data: db.QueryDB) -> Any:
         data: query data
 
     Returns:
-        dataframe of answer
+        answers as json or csv, or streamed as ndjson or Arrow IPC
+    """
+    result = await query_executor.run(query_db, data)
+    if data.return_type_option in STREAM_MEDIA_TYPES and not isinstance(result, dict):
+        return StreamingResponse(result, media_type=STREAM_MEDIA_TYPES[data.return_type_option])
+    return result
+
+@app.post("/query/batch/")
+async def query_batch(data: db.QueryBatchDB) -> Any:
+    """
+    Query the database with many questions at once
+
+    Args:
+        data: batch query data
+
+    Returns:
+        dict of question -> answers
     """
-    db_services = get_db_services_instance()
-    data_query = db_services.query(
-        ques=data.query_text,
-        threshold=data.threshold,
-        limit=data.limit
-    )
-    # check if data_query is empty
-    if data_query is None:
-        return [{"metadatas": {}}]
-    return get_query_db_json(data_query, data.return_type_option)
+    return await query_executor.run(query_batch_db, data)
 
 @app.post("/insert/")
 async def insert(data: db.InsertDB) -> Any:
@@ -72,33 +106,14 @@ async def insert(data: db.InsertDB) -> Any:
     Returns:
         status of insert
     """
-    db_services = get_db_services_instance()
-    main_column_name = data.main_column_name
-    if "https" in data.path:
-        data = fetch_data_as_dataframe(data.path, authen=data.authen)
-    elif data.path or data.data:
-        data_load = data.path if data.path else data.data
-        # read data from path
-        if data.data_type == 'csv':
-            data = pd.read_csv(data_load, encoding='utf-8')
-        elif data.data_type in ['json', 'jsonl']:
-            data = pd.read_json(data_load, orient='records',
-                                lines=True if data.data_type == 'jsonl' else False)
-        else:
-            return {"status": "Error", "message": "Data type is not supported"}
-    if not isinstance(data, pd.DataFrame):
-        return {"status": "Error", "message": "Data is not supported"}
-    # make main_column_name to "documents" and all other columns to "metadatas"
-    # rename main_column_name to "documents"
-    data = data.rename(columns={main_column_name: 'documents'})
-    # merge all other columns to "metadatas" as dict
-    data['metadatas'] = data.drop(columns=['documents']).to_dict('records')
-    # remove all columns except "documents" and "metadatas"
-    data = data[['documents', 'metadatas']]
-    # insert data to database
-    db_services.insert(data)
-    return {"status": "Success", "message": "Insert data successfully"}
+    return await write_executor.run(insert_db, data)
 
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", reload=True, port=8000, workers=1)
+    workers = int(os.getenv("COT_WORKERS", 1))
+    if workers > 1:
+        # query workers read a shared snapshot, a single writer process owns the database
+        from app.writer import start_writer_process
+        os.environ["COT_READ_ONLY"] = "1"
+        start_writer_process()
+    uvicorn.run("main:app", host="0.0.0.0", reload=workers == 1, port=8000, workers=workers)
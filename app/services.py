@@ -1,33 +1,115 @@
+import io
+import os
 import json
-from tools.dbms import DBMS
-from typing import Any, Text
-from tools.components.LLMs.open_gpt import OpenGPTBot
+import threading
+import importlib.util
+import pandas as pd
+from typing import Any, Dict, Text, Optional, Iterator, List
+from app.api.schemas import db
+from tools.dbms import DBMS, DATA_DIR
+from tools.caching import AnswerCache
+
+# handlers now run in executor threads, make sure each service is only built once
+_instance_lock = threading.Lock()
 
 db_services = None
 
 
 def get_db_services_instance():
     global db_services
-    if db_services is None:
-        db_services = DBMS(
-            model_path='sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2',
-            collection_name='search',
-            threshold=0.35
-        )
+    with _instance_lock:
+        if db_services is None:
+            db_services = DBMS(
+                model_path='sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2',
+                collection_name='search',
+                threshold=0.35,
+                backend=os.getenv("EMBEDDING_BACKEND", "torch"),
+                quantize=os.getenv("EMBEDDING_QUANTIZE", "0") == "1",
+                read_only=os.getenv("COT_READ_ONLY", "0") == "1",
+                vector_store=os.getenv("VECTOR_STORE", "chroma"),
+                hnsw_ef=int(os.getenv("HNSW_EF", 64)),
+                hybrid=os.getenv("HYBRID_SEARCH", "0") == "1",
+                micro_batch=True,
+                micro_batch_size=int(os.getenv("MICRO_BATCH_SIZE", 64)),
+                micro_batch_wait_ms=float(os.getenv("MICRO_BATCH_WAIT_MS", 5))
+            )
     return db_services
 
 
-def get_query_db_json(data_query: Any, return_type: Text):
-    # drop embedding column
-    data_query = data_query.drop(columns=['embeddings'])
-    if return_type in ['json', 'jsonl']:
-        # convert dataframe to json for response to client
-        data_query = data_query.to_json(orient='records',
-                                        lines=True if return_type == 'jsonl' else False,
-                                        force_ascii=False)
+def get_insert_data(data: Any, main_column_name: Text):
+    # make main_column_name to "documents" and all other columns to "metadatas"
+    # rename main_column_name to "documents"
+    data = data.rename(columns={main_column_name: 'documents'})
+    # merge all other columns to "metadatas" as dict
+    data['metadatas'] = data.drop(columns=['documents']).to_dict('records')
+    # remove all columns except "documents" and "metadatas"
+    return data[['documents', 'metadatas']]
+
+
+def get_query_db_json(data_query: Any, return_type: Text, include: Optional[List[Text]] = None):
+    # drop embedding column unless asked for
+    if include and 'embeddings' in include and 'embeddings' in data_query:
+        data_query = data_query.assign(embeddings=data_query['embeddings'].map(
+            lambda embedding: embedding.tolist() if hasattr(embedding, "tolist") else embedding))
     else:
-        data_query = data_query.to_csv(index=False, encoding='utf-8')
-    return json.loads(data_query)
+        data_query = data_query.drop(columns=['embeddings'], errors='ignore')
+    if return_type == 'csv':
+        return data_query.to_csv(index=False, encoding='utf-8')
+    # records straight from the dataframe, no json string round trip
+    return data_query.to_dict(orient='records')
+
+
+# formats streamed by /query/ instead of returned as one json document
+STREAM_MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "jsonl": "application/x-ndjson",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+STREAM_BATCH_SIZE = 1000
+
+
+def _json_default(value):
+    # numpy scalars and arrays left in the dataframe
+    return value.tolist() if hasattr(value, "tolist") else str(value)
+
+
+def iter_ndjson(data_query: Optional[pd.DataFrame]) -> Iterator[bytes]:
+    """
+    One json line per answer, in batches of STREAM_BATCH_SIZE lines
+    """
+    if data_query is None:
+        return
+    for start in range(0, len(data_query), STREAM_BATCH_SIZE):
+        records = data_query.iloc[start:start + STREAM_BATCH_SIZE].to_dict(orient='records')
+        yield "".join(json.dumps(record, ensure_ascii=False, default=_json_default) + "\n"
+                      for record in records).encode("utf-8")
+
+
+def iter_arrow(data_query: Optional[pd.DataFrame]) -> Iterator[bytes]:
+    """
+    Arrow IPC stream of the answers, one record batch per STREAM_BATCH_SIZE rows
+
+    Metadatas become a struct column, keys missing from an answer are null and ints mixed with floats become
+    floats. They are sent as json strings when a key holds incompatible types, e.g. a number and a string.
+    """
+    import pyarrow as pa
+
+    if data_query is None:
+        return
+    try:
+        table = pa.Table.from_pandas(data_query, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        table = pa.Table.from_pandas(data_query.assign(metadatas=data_query['metadatas'].map(
+            lambda metadata: json.dumps(metadata, ensure_ascii=False, default=_json_default))), preserve_index=False)
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        for batch in table.to_batches(max_chunksize=STREAM_BATCH_SIZE):
+            writer.write_batch(batch)
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+    # end of stream marker written on close
+    yield sink.getvalue()
 
 
 bot_services = None
@@ -35,6 +117,126 @@ bot_services = None
 
 def get_bot_services_instance():
     global bot_services
-    if bot_services is None:
-        bot_services = OpenGPTBot()
+    with _instance_lock:
+        if bot_services is None:
+            from tools.components.LLMs.open_gpt import OpenGPTBot
+            bot_services = OpenGPTBot(race=int(os.getenv("OPEN_GPT_RACE", 3)))
     return bot_services
+
+
+answer_cache = None
+
+
+def get_answer_cache_instance():
+    global answer_cache
+    with _instance_lock:
+        if answer_cache is None:
+            answer_cache = AnswerCache(path=os.path.join(DATA_DIR, 'ask_answers.sqlite3'),
+                                       ttl=float(os.getenv("ASK_CACHE_TTL", 24 * 3600)),
+                                       max_memory_items=int(os.getenv("ASK_CACHE_SIZE", 10000)))
+    return answer_cache
+
+
+def flush_db_services():
+    """
+    Persist pending writes of the database, called on shutdown
+    """
+    if db_services is not None:
+        db_services.flush()
+
+
+def get_readiness() -> Dict:
+    """
+    Which services are loaded, the API is ready once the database model and collection are
+    """
+    db_ready = db_services is not None and db_services.ready
+    return {
+        "ready": db_ready,
+        "db": db_ready,
+        "bot": bot_services is not None,
+    }
+
+
+def ask_bot(question: Text) -> Text:
+    """
+    Ask the bot, answers are cached by normalized question
+
+    Args:
+        question: question
+
+    Returns:
+        answer
+    """
+    answer_cache = get_answer_cache_instance()
+    answer = answer_cache.get(question)
+    if answer is None:
+        answer = get_bot_services_instance().ask(question)
+        if answer and "Tôi xin lỗi" not in answer:
+            answer_cache.set(question, answer)
+    return answer
+
+
+def query_db(data: db.QueryDB) -> Any:
+    if data.return_type_option == 'arrow' and importlib.util.find_spec("pyarrow") is None:
+        return {"status": "Error", "message": "Arrow output needs pyarrow installed"}
+    data_query = get_db_services_instance().query(
+        ques=data.query_text,
+        threshold=data.threshold,
+        limit=data.limit,
+        offset=data.offset,
+        where=data.where,
+        include=data.include if data.include else ['documents', 'metadatas', 'distances'],
+        **({"hybrid": data.hybrid} if data.hybrid is not None else {})
+    )
+    if data.return_type_option in STREAM_MEDIA_TYPES:
+        return iter_arrow(data_query) if data.return_type_option == 'arrow' else iter_ndjson(data_query)
+    # check if data_query is empty
+    if data_query is None:
+        return [{"metadatas": {}}]
+    return get_query_db_json(data_query, data.return_type_option, data.include)
+
+
+def query_batch_db(data: db.QueryBatchDB) -> Dict:
+    data_query = get_db_services_instance().query_many(
+        questions=data.query_texts,
+        threshold=data.threshold,
+        limit=data.limit
+    )
+    return {
+        ques: [{"metadatas": {}}] if answers is None else get_query_db_json(answers, data.return_type_option)
+        for ques, answers in data_query.items()
+    }
+
+
+def insert_db(data: db.InsertDB) -> Dict:
+    db_services = get_db_services_instance()
+    main_column_name = data.main_column_name
+    if data.chunk_size and data.path and "https" not in data.path:
+        # stream the file chunk by chunk so large datasets never sit in memory at once
+        try:
+            chunks = db_services.read_chunks(data.path, data.data_type, data.chunk_size)
+        except ValueError as e:
+            return {"status": "Error", "message": str(e)}
+        stats = db_services.stream_insert(chunks,
+                                          transform=lambda chunk: get_insert_data(chunk, main_column_name),
+                                          persist_every=data.persist_every)
+        return {"status": "Success", "message": "Insert data successfully", "stats": stats}
+    if data.path and "https" in data.path:
+        from tools.components.APIs.libs.download import fetch_data_as_dataframe
+        data = fetch_data_as_dataframe(data.path, authen=data.authen)
+    elif data.path or data.data:
+        data_load = data.path if data.path else data.data
+        # read data from path
+        if data.data_type == 'csv':
+            data = pd.read_csv(data_load, encoding='utf-8')
+        elif data.data_type in ['json', 'jsonl']:
+            data = pd.read_json(data_load, orient='records',
+                                lines=True if data.data_type == 'jsonl' else False)
+        else:
+            return {"status": "Error", "message": "Data type is not supported"}
+    if not isinstance(data, pd.DataFrame):
+        return {"status": "Error", "message": "Data is not supported"}
+    data = get_insert_data(data, main_column_name)
+    # insert data to database
+    db_services.insert(data)
+    return {"status": "Success", "message": "Insert data successfully"}
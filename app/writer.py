@@ -0,0 +1,83 @@
+import os
+import time
+from multiprocessing import Process
+
+from tools.dbms import DBMS
+from tools.snapshot import SpoolQueue, publish_snapshot
+
+
+def run_writer(poll_interval: float = 1, publish_interval: float = 10, max_attempts: int = 3):
+    """
+    Single writer of the database in multi-worker mode
+
+    Query workers run with a read-only DBMS: they search the memory-mapped snapshot and spool their
+    inserts. This process is the only one opening the vector store, it inserts spooled batches
+    and publishes the records it inserted as a new snapshot segment at most every publish_interval
+    seconds, see publish_snapshot. A batch that cannot be read, or still fails to insert after
+    max_attempts polls, is moved to spool/failed.
+
+    Args:
+        poll_interval: seconds between scans of the spool directory
+        publish_interval: min seconds between two snapshots
+        max_attempts: number of polls a failing batch is retried before it is moved aside
+    """
+    db = DBMS(
+        model_path='sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2',
+        collection_name='search',
+        threshold=0.35,
+        vector_store=os.getenv("VECTOR_STORE", "chroma"),
+        hybrid=os.getenv("HYBRID_SEARCH", "0") == "1"
+    )
+    spool = SpoolQueue(os.path.join(db.persist_directory, 'spool'))
+    snapshots = os.path.join(db.persist_directory, 'snapshots')
+    publish_snapshot(db.collection, snapshots)
+    # ids inserted since the last snapshot, documents already stored come back without embeddings
+    inserted = []
+    published_at = time.time()
+    attempts = {}
+    while True:
+        for path in spool.pending():
+            try:
+                data = spool.load(path)
+            except Exception as e:
+                # partial or corrupt batch, retrying cannot help
+                print("Writer failed to read {}: {}".format(path, e))
+                spool.fail(path, e)
+                continue
+            try:
+                result = db.insert(data)
+            except Exception as e:
+                attempts[path] = attempts.get(path, 0) + 1
+                print("Writer failed to insert {} (attempt {}): {}".format(path, attempts[path], e))
+                if attempts[path] >= max_attempts:
+                    spool.fail(path, e)
+                    attempts.pop(path)
+                # keep the batch order, later batches wait for the next poll
+                break
+            attempts.pop(path, None)
+            inserted += result.loc[result['embeddings'].notna(), 'ids'].tolist()
+            os.remove(path)
+        if inserted and time.time() - published_at >= publish_interval:
+            try:
+                publish_snapshot(db.collection, snapshots, ids=inserted)
+                inserted = []
+            except Exception as e:
+                # workers keep the current snapshot, the records are published with the next ones
+                print("Writer failed to publish a snapshot: {}".format(e))
+            published_at = time.time()
+        time.sleep(poll_interval)
+
+
+def start_writer_process() -> Process:
+    process = Process(target=run_writer,
+                      kwargs={"poll_interval": float(os.getenv("WRITER_POLL_INTERVAL", 1)),
+                              "publish_interval": float(os.getenv("WRITER_PUBLISH_INTERVAL", 10)),
+                              "max_attempts": int(os.getenv("WRITER_MAX_ATTEMPTS", 3))},
+                      name="cot-writer",
+                      daemon=True)
+    process.start()
+    return process
+
+
+if __name__ == "__main__":
+    run_writer()
@@ -0,0 +1,80 @@
+import os
+import re
+import time
+import random
+import pandas as pd
+
+from tools.utils import clean_data, DEFAULT_RULES
+from tools.components.APIs.libs.text_processor import StringUtils
+from tools.components.APIs.libs.constants import REGEX_REMOVE_ADS, REGEX_COMMAND_REMOVE
+
+DATA_PATH = './datasets/vnd_cleaned.jsonl'
+N_ROWS = int(os.getenv("N_ROWS", 1000000))
+
+
+def legacy_replace_by_rule(rules, text):
+    # implementation before the compiled pipeline, kept as the baseline
+    for rule in rules:
+        text = re.sub(rule[0], rule[1], text, flags=re.MULTILINE | re.DOTALL | re.IGNORECASE)
+        text = text.strip(' ')
+    return text
+
+
+def legacy_clean_data(rules, data):
+    rules = DEFAULT_RULES + (rules if rules else [])
+    data['documents'] = data['documents'].apply(lambda x: legacy_replace_by_rule(rules, x))
+    return data
+
+
+def legacy_clean_text(text):
+    # StringUtils.clean_text before the compiled patterns, the flags land in the count argument of re.sub
+    text = StringUtils.normalize_res(text)
+    ads = re.search(REGEX_REMOVE_ADS, text, re.DOTALL | re.IGNORECASE)
+    if ads:
+        text = text[:ads.start()] + text[ads.end():]
+    text = re.sub(REGEX_REMOVE_ADS, '', text, re.DOTALL | re.IGNORECASE)
+    text = re.sub(REGEX_COMMAND_REMOVE, '', text, re.MULTILINE | re.IGNORECASE | re.DOTALL)
+    text = text.strip(' ')
+    return text
+
+
+def fuzz_clean_text(n_texts=20000):
+    random.seed(1)
+    pieces = ["Như đã nêu ở trên, chúng ta hãy xem xét kỹ.", "Đây là câu cuối.", "Hãy xem thêm tại đây!",
+              "mời bạn đọc tiếp: ", "Xin cảm ơn.", "xin chào", "Dành cho bạn đọc miễn phí", "dành cho ai MIỄN PHÍ",
+              "Nêu ví dụ?", "Vui lòng\nđợi.", "Thanks » ", "Please wait", "tra cứu từ điển."]
+    for _ in range(n_texts):
+        text = " ".join(random.choices(pieces, k=random.randint(1, 30)))
+        assert StringUtils.clean_text(text) == legacy_clean_text(text), 'clean_text differs from legacy: ' + text
+    print("clean_text: {} texts identical to legacy".format(n_texts))
+
+
+def load_corpus(n_rows):
+    if os.path.exists(DATA_PATH):
+        texts = pd.read_json(DATA_PATH, lines=True, encoding='utf-8')["output"].dropna().astype(str).tolist()
+    else:
+        random.seed(0)
+        pieces = ["Trừ bữa là ăn thay cho bữa cơm hằng ngày.", "Thủ đô của Việt Nam là Hà Nội[^1^].",
+                  "Searching for: thủ đô", ":[1] nguồn", "Tra cứu từ điển.", "< p>quảng cáo",
+                  "lịch sử thay đổi sửa đổi", "\\n\\nXem thêm", "Như đã nêu ở trên, chúng ta hãy xem xét kỹ.",
+                  "searching nữa", "tra cứu thêm."]
+        texts = [" ".join(random.choices(pieces, k=4)) for _ in range(10000)]
+    return pd.DataFrame({"documents": (texts * (n_rows // len(texts) + 1))[:n_rows]})
+
+
+def timed(func, data):
+    start_time = time.perf_counter()
+    result = func(None, data.copy())
+    return result, time.perf_counter() - start_time
+
+
+if __name__ == '__main__':
+    fuzz_clean_text()
+    corpus = load_corpus(N_ROWS)
+    expected, legacy_seconds = timed(legacy_clean_data, corpus)
+    print("legacy: {:.1f}s ({:.0f} rows/sec)".format(legacy_seconds, len(corpus) / legacy_seconds))
+    for processes in [1, None]:
+        actual, seconds = timed(lambda rules, data: clean_data(rules, data, processes=processes), corpus)
+        assert actual['documents'].equals(expected['documents']), 'Cleaned documents differ from legacy'
+        print("compiled, processes={}: {:.1f}s ({:.0f} rows/sec, x{:.1f})".format(
+            processes if processes else os.cpu_count(), seconds, len(corpus) / seconds, legacy_seconds / seconds))
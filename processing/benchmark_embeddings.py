@@ -0,0 +1,30 @@
+import os
+import json
+import pandas as pd
+from sentence_transformers import SentenceTransformer
+
+from tools.dbms import DATA_DIR
+from tools.embedding_backends import OnnxEncoder, parity_check, benchmark
+
+MODEL_PATH = 'sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2'
+DATA_PATH = './datasets/vnd_cleaned.jsonl'
+N_SENTENCES = 512
+
+
+if __name__ == '__main__':
+    if os.path.exists(DATA_PATH):
+        sentences = pd.read_json(DATA_PATH, lines=True, encoding='utf-8')["instruction"].dropna().tolist()[:N_SENTENCES]
+    else:
+        sentences = ["Trừ bữa có nghĩa là gì?",
+                     "Thủ đô của Việt Nam là thành phố nào?",
+                     "Ăn khoai trừ bữa thay cho bữa cơm hằng ngày."] * (N_SENTENCES // 3)
+
+    # three models, only loaded when the benchmark runs
+    torch_model = SentenceTransformer(MODEL_PATH, device='cpu')
+    onnx_model = OnnxEncoder(MODEL_PATH, cache_dir=os.path.join(DATA_DIR, 'onnx'))
+    onnx_int8_model = OnnxEncoder(MODEL_PATH, cache_dir=os.path.join(DATA_DIR, 'onnx'), quantize=True)
+
+    print("Parity onnx:", json.dumps(parity_check(torch_model, onnx_model, sentences[:64])))
+    print("Parity onnx int8:", json.dumps(parity_check(torch_model, onnx_int8_model, sentences[:64])))
+    print(json.dumps(benchmark({"torch": torch_model, "onnx": onnx_model, "onnx-int8": onnx_int8_model},
+                               sentences), indent=2))
@@ -0,0 +1,20 @@
+import os
+import sys
+
+from tools.dbms import DATA_DIR
+from tools.vector_stores import ChromaStore, HnswStore, migrate_chroma
+
+COLLECTION_NAME = 'search'
+
+if __name__ == '__main__':
+    # usage: python -m processing.migrate_to_hnsw [M] [ef_construction]
+    M = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    ef_construction = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    target_path = os.path.join(DATA_DIR, 'hnsw', COLLECTION_NAME)
+    if os.path.exists(os.path.join(target_path, 'records.sqlite3')):
+        raise SystemExit('{} already exists, remove it to migrate again'.format(target_path))
+    source = ChromaStore(DATA_DIR, COLLECTION_NAME)
+    target = HnswStore(target_path, M=M, ef_construction=ef_construction)
+    copied = migrate_chroma(source, target)
+    target.close()
+    print('Migrated {} records to {}, start DBMS with vector_store="hnsw" to use them'.format(copied, target_path))
@@ -0,0 +1,93 @@
+import time
+import queue
+import threading
+import numpy as np
+from concurrent.futures import Future
+from typing import Optional
+
+
+class MicroBatcher:
+    """
+    Merge concurrent encode calls into one model forward pass
+
+    Callers block on encode as before. A background thread waits up to max_wait_ms after the first
+    pending request for more requests, encodes all their texts in one call and hands every caller its rows.
+
+    Attributes:
+        model: object with an encode method, e.g. SentenceTransformer or CachedEncoder
+        max_batch_size (int): max number of texts encoded in one call
+        max_wait_ms (float): max milliseconds the first request of a batch waits for others
+        batches (int): number of model calls made
+        requests (int): number of encode calls served
+    """
+
+    def __init__(self, model, max_batch_size: Optional[int] = 64, max_wait_ms: Optional[float] = 5):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.batches = 0
+        self.requests = 0
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self._worker.start()
+
+    def encode(self, sentences, **kwargs) -> np.ndarray:
+        """
+        Encode sentences, sharing the model call with concurrent callers
+
+        Args:
+            sentences: text or list of texts
+
+        Returns:
+            numpy array of embeddings
+        """
+        single = isinstance(sentences, str)
+        sentences = [sentences] if single else list(sentences)
+        # calls with options or already large enough do not benefit from waiting
+        if kwargs or len(sentences) >= self.max_batch_size or not sentences:
+            result = self.model.encode(sentences, **kwargs)
+            return result[0] if single and len(result) else result
+        future = Future()
+        self._queue.put((sentences, future))
+        result = future.result()
+        return result[0] if single else result
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        size = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait_ms / 1000
+        while size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            texts = [text for sentences, _ in batch for text in sentences]
+            try:
+                embeddings = np.asarray(self.model.encode(texts))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.requests += len(batch)
+            start = 0
+            for sentences, future in batch:
+                future.set_result(embeddings[start:start + len(sentences)])
+                start += len(sentences)
+
+    def batch_stats(self):
+        return {"batches": self.batches, "requests": self.requests,
+                "avg_requests_per_batch": self.requests / self.batches if self.batches else 0.0}
+
+    def __getattr__(self, item):
+        return getattr(self.model, item)
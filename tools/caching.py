@@ -0,0 +1,320 @@
+import re
+import time
+import pickle
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+import numpy as np
+from collections import OrderedDict
+from typing import Any, Text, Optional, List, Dict
+
+
+class SQLiteCache:
+    """
+    Small key -> blob store on top of SQLite with LRU eviction
+
+    The number of rows is tracked while writing, it is only counted again once it passes max_items, then the
+    least recently used rows are evicted down to evict_ratio * max_items so counting stays rare.
+
+    Attributes:
+        path (Text): path to SQLite file
+        max_items (int): max number of rows to keep, least recently used rows are evicted first
+        evict_ratio (float): share of max_items kept by an eviction
+    """
+    def __init__(self, path: Text, table: Text, max_items: Optional[int] = 1000000,
+                 evict_ratio: Optional[float] = 0.9):
+        self.path = path
+        self.table = table
+        self.max_items = max_items
+        self.evict_ratio = evict_ratio
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, value BLOB, created REAL, used REAL)".format(table)
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS {0}_used ON {0} (used)".format(table))
+        self._conn.commit()
+        # other processes may write the same file, the count is exact again whenever it is checked
+        self._count = self._conn.execute("SELECT COUNT(*) FROM {}".format(table)).fetchone()[0]
+
+    def _existing(self, keys: List[Text]) -> set:
+        existing = set()
+        # stay under SQLite's limit of host parameters per statement
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            existing.update(key for key, in self._conn.execute(
+                "SELECT key FROM {} WHERE key IN ({})".format(self.table, ",".join("?" * len(batch))), batch))
+        return existing
+
+    def get_many(self, keys: List[Text]) -> Dict[Text, tuple]:
+        """
+        Get many rows at once and mark them as recently used
+
+        Args:
+            keys: list of keys
+
+        Returns:
+            dict of key -> (value, created time) for keys found
+        """
+        found = {}
+        now = time.time()
+        with self._lock:
+            # stay under SQLite's limit of host parameters per statement
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                rows = self._conn.execute(
+                    "SELECT key, value, created FROM {} WHERE key IN ({})".format(self.table,
+                                                                                 ",".join("?" * len(batch))),
+                    batch
+                ).fetchall()
+                found.update({key: (value, created) for key, value, created in rows})
+            if found:
+                self._conn.executemany("UPDATE {} SET used = ? WHERE key = ?".format(self.table),
+                                       [(now, key) for key in found])
+                self._conn.commit()
+        return found
+
+    def put_many(self, items: Dict[Text, bytes]):
+        """
+        Insert or replace many rows at once, then evict least recently used rows above max_items
+
+        Args:
+            items: dict of key -> value
+        """
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            if self.max_items:
+                self._count += len(items) - len(self._existing(list(items)))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO {} (key, value, created, used) VALUES (?, ?, ?, ?)".format(self.table),
+                [(key, value, now, now) for key, value in items.items()]
+            )
+            if self.max_items and self._count > self.max_items:
+                self._count = self._conn.execute("SELECT COUNT(*) FROM {}".format(self.table)).fetchone()[0]
+                if self._count > self.max_items:
+                    keep = int(self.max_items * self.evict_ratio)
+                    self._conn.execute(
+                        "DELETE FROM {0} WHERE key IN (SELECT key FROM {0} ORDER BY used LIMIT ?)".format(self.table),
+                        (self._count - keep,)
+                    )
+                    self._count = keep
+            self._conn.commit()
+
+    def delete_many(self, keys: List[Text]):
+        """
+        Delete many rows at once
+
+        Args:
+            keys: list of keys
+        """
+        with self._lock:
+            cursor = self._conn.executemany("DELETE FROM {} WHERE key = ?".format(self.table),
+                                            [(key,) for key in keys])
+            self._count = max(0, self._count - cursor.rowcount)
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class EmbeddingCache(SQLiteCache):
+    """
+    On-disk cache of embeddings keyed by hash of model name and text
+    """
+    def __init__(self, path: Text, model_name: Text, max_items: Optional[int] = 1000000):
+        super().__init__(path, table="embeddings", max_items=max_items)
+        self.model_name = model_name
+
+    def key(self, text: Text, options: Optional[Text] = "") -> Text:
+        """
+        Args:
+            text: text embedded
+            options: encode options changing the embedding, e.g. normalize_embeddings, see CachedEncoder
+        """
+        prefix = self.model_name + "\0" + options if options else self.model_name
+        return hashlib.sha1((prefix + "\0" + text).encode('utf-8')).hexdigest()
+
+    def get_vectors(self, keys: List[Text]) -> Dict[Text, np.ndarray]:
+        return {key: np.frombuffer(value, dtype=np.float32) for key, (value, _) in self.get_many(keys).items()}
+
+    def put_vectors(self, vectors: Dict[Text, np.ndarray]):
+        self.put_many({key: np.asarray(vector, dtype=np.float32).tobytes() for key, vector in vectors.items()})
+
+
+class CachedEncoder:
+    """
+    Wrap a SentenceTransformer so texts embedded before are read from the cache instead of encoded again
+
+    Encode kwargs changing the embeddings (normalize_embeddings, precision, prompt...) are part of the cache
+    key, the ones only changing how it is computed are not, see RUN_OPTIONS.
+
+    Attributes:
+        model (SentenceTransformer): model used on cache misses
+        cache (EmbeddingCache): embedding cache
+        hits (int): number of texts served from the cache
+        misses (int): number of texts encoded by the model
+    """
+    RUN_OPTIONS = ("batch_size", "show_progress_bar", "convert_to_numpy", "device", "pool", "chunk_size")
+
+    def __init__(self, model, cache: EmbeddingCache):
+        self.model = model
+        self.cache = cache
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def encode(self, sentences, **kwargs) -> np.ndarray:
+        """
+        Encode sentences, only the ones missing from the cache go through the model
+
+        Args:
+            sentences: text or list of texts
+
+        Returns:
+            numpy array of embeddings
+        """
+        if kwargs.get("convert_to_tensor") or kwargs.get("output_value", "sentence_embedding") != "sentence_embedding":
+            return self.model.encode(sentences, **kwargs)
+        single = isinstance(sentences, str)
+        sentences = [sentences] if single else list(sentences)
+        options = repr(sorted((key, value) for key, value in kwargs.items() if key not in self.RUN_OPTIONS))
+        options = options if options != "[]" else ""
+        keys = [self.cache.key(text, options) for text in sentences]
+        vectors = self.cache.get_vectors(list(set(keys)))
+        missing = [text for text, key in zip(sentences, keys) if key not in vectors]
+        with self._lock:
+            self.hits += len(sentences) - len(missing)
+            self.misses += len(missing)
+        missing = list(dict.fromkeys(missing))
+        if missing:
+            encoded = np.asarray(self.model.encode(missing, **kwargs), dtype=np.float32)
+            encoded = {self.cache.key(text, options): vector for text, vector in zip(missing, encoded)}
+            self.cache.put_vectors(encoded)
+            vectors.update(encoded)
+        if not sentences:
+            return np.zeros((0, self.get_sentence_embedding_dimension()), dtype=np.float32)
+        result = np.stack([vectors[key] for key in keys])
+        return result[0] if single else result
+
+    def stats(self) -> Dict:
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {"hits": hits, "misses": misses, "hit_rate": hits / total if total else 0.0}
+
+    def __getattr__(self, item):
+        return getattr(self.model, item)
+
+
+class AnswerCache:
+    """
+    Two-level answer cache: in-memory LRU in front of an SQLite store, both keyed by normalized question
+
+    Attributes:
+        ttl (float): seconds an answer stays valid, None to keep forever
+        max_memory_items (int): max number of answers kept in memory
+        store (SQLiteCache): persistent store, None to only cache in memory
+        hits (int): number of lookups served from memory or disk
+        misses (int): number of lookups not found
+    """
+    def __init__(self,
+                 path: Optional[Text] = None,
+                 ttl: Optional[float] = 7 * 24 * 3600,
+                 max_memory_items: Optional[int] = 10000,
+                 max_items: Optional[int] = 1000000):
+        self.ttl = ttl
+        self.max_memory_items = max_memory_items
+        self.store = SQLiteCache(path, table="answers", max_items=max_items) if path else None
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(question: Text) -> Text:
+        """
+        Normalize question so trivially different spellings share one entry
+
+        Only case, spaces and the final punctuation are normalized, operators and symbols are kept so
+        "2+2" and "2*2" or "C++" and "C" stay different questions.
+
+        Args:
+            question: question
+
+        Returns:
+            normalized question
+        """
+        question = unicodedata.normalize("NFC", question).lower()
+        question = re.sub(r"\s+", " ", question).strip()
+        return question.rstrip("?.! ")
+
+    @staticmethod
+    def _copy(value: Any) -> Any:
+        # callers may modify the answer they get, e.g. a dataframe, the cached one must not change
+        return value.copy() if hasattr(value, "copy") else value
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def get(self, question: Text) -> Optional[Any]:
+        """
+        Get answer of question
+
+        Args:
+            question: question
+
+        Returns:
+            cached answer or None
+        """
+        key = self.normalize(question)
+        with self._lock:
+            item = self._memory.get(key)
+            if item is not None:
+                created, value = item
+                if not self._expired(created):
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return self._copy(value)
+                del self._memory[key]
+        if self.store:
+            found = self.store.get_many([key]).get(key)
+            if found is not None and not self._expired(found[1]):
+                value = pickle.loads(found[0])
+                self._remember(key, self._copy(value), found[1])
+                with self._lock:
+                    self.hits += 1
+                return value
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _remember(self, key: Text, value: Any, created: float):
+        with self._lock:
+            self._memory[key] = (created, value)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_items:
+                self._memory.popitem(last=False)
+
+    def set(self, question: Text, value: Any):
+        """
+        Cache answer of question
+
+        Args:
+            question: question
+            value: answer
+        """
+        key = self.normalize(question)
+        self._remember(key, self._copy(value), time.time())
+        if self.store:
+            self.store.put_many({key: pickle.dumps(value)})
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0,
+                "memory_items": len(self._memory)}
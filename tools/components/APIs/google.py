@@ -1,10 +1,10 @@
 import re
+import json
 import asyncio
-from time import sleep
 from rapidfuzz import fuzz
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
-from typing import Any, Text, Dict, Optional, List
+from typing import Any, Text, Dict, Optional, List, Tuple
 
 from tools.components.LLMs.open_gpt import OpenGPTBot
 from tools.components.APIs.libs.req_agents import CrawlUrl
@@ -16,23 +16,31 @@ load_dotenv()
 class Google:
     """Google search engine."""
 
-    def __init__(self) -> None:
-        """Initialize Google search engine."""
+    def __init__(self, num_results: Optional[int] = 3, fetch_timeout: Optional[float] = 15) -> None:
+        """Initialize Google search engine.
+
+        Args:
+            num_results: number of search results whose content is fetched and scored (default: 3)
+            fetch_timeout: seconds given to the content fetches of one question (default: 15)
+        """
         self.req_agent = CrawlUrl()
         self.gpt = OpenGPTBot()
+        self.num_results = num_results
+        self.fetch_timeout = fetch_timeout
 
-    async def query(self, q: str) -> Optional[Dict[str, Any]]:
+    async def query(self, q: str, num: Optional[int] = None) -> Optional[Dict[str, Any]]:
         """Search for a query using Google search.
 
         Args:
             q: your query that you want to search.
+            num: max number of results (default: num_results)
 
         Returns:
             Results from Google search engine.
         """
         params = {
             "q": q,
-            "num": 2,
+            "num": num if num else self.num_results,
             "hl": "vi"
         }
         start = 0
@@ -79,10 +87,9 @@ class Google:
                     item_result["snippet"] = description_box.text
                 google_results.append(item_result)
                 start += 1
-            sleep(delay)
-        if google_results:
-            return {"items": [google_results[0]]}
-        return {"items": []}
+            if delay:
+                await asyncio.sleep(delay)
+        return {"items": google_results[:params["num"]]}
 
     @staticmethod
     def search_engine_results(response_data: Optional[Dict[str, Any]]
@@ -122,19 +129,25 @@ class Google:
         raw = ""
         solution = "1"
         if solution == "1":
-            url = f"http://webcache.googleusercontent.com/search?q=cache:{url}&prmd=ivn&strip=1&vwsrc=0"
-            raw = await self.req_agent.gettext(url)
+            cache_url = f"http://webcache.googleusercontent.com/search?q=cache:{url}&prmd=ivn&strip=1&vwsrc=0"
+            raw = await self.req_agent.gettext(cache_url)
             if "Our systems have detected unusual traffic from your computer" in raw:
                 print("Google block: ", url)
                 raw = ""
                 solution = "2"
         if solution == "2":
-            url = f"https://archive.org/wayback/available?url={url}"
-            raw = await self.req_agent.gettext(url)
-            if raw.get("archived_snapshots"):
-                url = raw["archived_snapshots"]["closest"]["url"]
-                raw = await self.req_agent.gettext(url)
-        return raw
+            # the snapshot of the page itself, not of its webcache url
+            available = await self.req_agent.gettext(f"https://archive.org/wayback/available?url={url}")
+            if isinstance(available, str):
+                # served as json with a charset, gettext only decodes a bare application/json
+                try:
+                    available = json.loads(available)
+                except ValueError:
+                    available = {}
+            closest = available.get("archived_snapshots", {}).get("closest")
+            if closest and closest.get("url"):
+                raw = await self.req_agent.gettext(closest["url"])
+        return raw if isinstance(raw, str) else ""
 
     async def get_full_content(self, url, desc):
         raw_html = await self.req_agent.gettext(url)
@@ -155,6 +168,77 @@ class Google:
             desc += "."
         return desc
 
+    @staticmethod
+    def _complete_snippet(snippet: Text) -> Optional[Text]:
+        """Snippet as the answer when it ends with a full sentence, else None."""
+        ending = snippet.replace("...", "").strip(" ")
+        if not ending or "." not in ending[-1]:
+            return None
+        desc = snippet.split(".")
+        desc = [des.strip(" ").capitalize() for des in desc]
+        return ". ".join(desc).strip(" ")
+
+    @staticmethod
+    def _relevant(desc: Text, relate: float) -> bool:
+        return relate > 28 and len(desc) > 25
+
+    async def _score(self, ques: Text, result: Dict[str, str]) -> Tuple[Text, Text, float]:
+        """Fetch the full content of a search result and score it against the question."""
+        desc = result["snippet"].replace(" · ", ", ")
+        try:
+            desc = await self.get_full_content(result["url"], desc)
+        except Exception as e:
+            # an unreachable page only loses its own result
+            print("Fetch failed: ", result["url"], e)
+            return result["url"], desc, 0
+        return result["url"], desc, fuzz.ratio(desc, ques)
+
+    async def search(self, ques: Text) -> List[Tuple[Text, Text, float]]:
+        """Search Google and score the top results, on a single event loop.
+
+        The most relevant snippet being a complete sentence relevant to the question answers right away,
+        otherwise the full content of the top results is fetched concurrently and scored with fuzz.ratio.
+        Fetching stops as soon as a relevant content arrives or after fetch_timeout seconds, the fetches
+        still running are cancelled.
+
+        Args:
+            ques: Question
+
+        Returns:
+            A list of (url, content, score) of the fetched results, best first.
+        """
+        results = self.search_engine_results(await self.query(ques))
+        results = [result for result in results or []
+                   if "Not found" not in result["snippet"] and result["url"] != "Not found"]
+        # snippets are scored like fetched contents, a well formed one is not an answer by itself
+        snippets = [(result["url"], desc, fuzz.ratio(desc, ques)) for result, desc in
+                    ((result, self._complete_snippet(result["snippet"].replace(" · ", ", "))) for result in results)
+                    if desc]
+        snippets = [snippet for snippet in snippets if self._relevant(snippet[1], snippet[2])]
+        if snippets:
+            return [max(snippets, key=lambda snippet: snippet[2])]
+        pending = [asyncio.ensure_future(self._score(ques, result)) for result in results]
+        # Google's ranking breaks ties, see the stable sort below
+        rank = {task: position for position, task in enumerate(pending)}
+        pending = set(pending)
+        scored = []
+        expires_at = asyncio.get_running_loop().time() + self.fetch_timeout
+        try:
+            while pending:
+                remaining = expires_at - asyncio.get_running_loop().time()
+                if remaining <= 0:
+                    break
+                done, pending = await asyncio.wait(pending, timeout=remaining,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                scored.extend((rank[task], task.result()) for task in done)
+                if any(self._relevant(desc, relate) for _, (_, desc, relate) in scored):
+                    break
+        finally:
+            for task in pending:
+                task.cancel()
+        scored = [item for _, item in sorted(scored, key=lambda item: item[0])]
+        return sorted(scored, key=lambda item: item[2], reverse=True)
+
     def ask(self, ques: Text):
         """
         Full pipeline query answer via Google Search
@@ -165,31 +249,15 @@ class Google:
         Return:
             A dict contains "source" and "documents" content or None.
         """
-        data_search = asyncio.run(self.query(ques))
-        data_search = self.search_engine_results(data_search)
-        if data_search:
-            data_search = data_search[0]
-            url = data_search["url"]
-            desc = data_search["snippet"].replace(" · ", ", ")
-            if "Not found" in desc:
-                return None
-            if "." in desc.replace("...", "").strip(" ")[-1]:
-                relate = 100
-                desc = desc.split(".")
-                desc = [des.strip(" ").capitalize() for des in desc]
-                desc = ". ".join(desc).strip(" ")
-            else:
-                desc = asyncio.run(self.get_full_content(url, desc))
-                relate = fuzz.ratio(desc, ques)
-            print("\nques:", ques, "desc:", desc, "relate:", relate)
-            if relate > 28 and len(desc) > 25:
-                gpt_reponse = self.gpt.ask(question=ques+"? "+desc, prompt="Hãy diễn đạt lại văn bản sau thật tự nhiên, không chứa câu hỏi và đúng ngữ pháp tiếng Việt, hãy loại bỏ các từ viết tắc mà bạn không biết: {}")
-                print("gpt_reponse:", gpt_reponse)
-                if gpt_reponse and "Tôi xin lỗi" not in gpt_reponse and "Please visit" not in gpt_reponse:
-                    desc = gpt_reponse
-                    data_search = {"metadatas": [{"source": url}], "documents": [desc]}
-                else:
-                    data_search = None
-            else:
-                data_search = None
-        return data_search
+        # on the shared CrawlUrl event loop, no new loop per question
+        candidates = self.req_agent.run_sync(self.search(ques))
+        candidates = [(url, desc, relate) for url, desc, relate in candidates if self._relevant(desc, relate)]
+        if not candidates:
+            return None
+        url, desc, relate = candidates[0]
+        print("\nques:", ques, "desc:", desc, "relate:", relate)
+        gpt_reponse = self.gpt.ask(question=ques+"? "+desc, prompt="Hãy diễn đạt lại văn bản sau thật tự nhiên, không chứa câu hỏi và đúng ngữ pháp tiếng Việt, hãy loại bỏ các từ viết tắc mà bạn không biết: {}")
+        print("gpt_reponse:", gpt_reponse)
+        if gpt_reponse and "Tôi xin lỗi" not in gpt_reponse and "Please visit" not in gpt_reponse:
+            return {"metadatas": [{"source": url}], "documents": [gpt_reponse]}
+        return None
@@ -0,0 +1,243 @@
+import os
+import json
+import time
+import random
+import threading
+from requests import get
+from bs4 import BeautifulSoup
+from typing import Text, Optional, List, Dict, Iterable
+
+# outside the package, the source tree may be read-only and must not collect runtime files
+CACHE_PATH = os.path.join(os.getenv("COT_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "cot-lib")),
+                          "proxies.json")
+
+
+class ProxyPool:
+    """
+    Process-wide pool of free proxies, loaded in the background and scored by observed health
+
+    Attributes:
+        cache_path (Text): json file caching the scraped proxies
+        ttl (float): seconds before the proxy list is scraped again, also while the process runs
+        retry_interval (float): min seconds between two background scrapes of an empty or stale pool
+        size (int): number of proxies kept from the scraped list
+        min_requests (int): requests before a proxy may be evicted for failing
+        max_failure_rate (float): failure rate above which a proxy is evicted
+    """
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self,
+                 cache_path: Optional[Text] = CACHE_PATH,
+                 ttl: Optional[float] = 6 * 3600,
+                 size: Optional[int] = 20,
+                 min_requests: Optional[int] = 3,
+                 max_failure_rate: Optional[float] = 0.6,
+                 retry_interval: Optional[float] = 60):
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.size = size
+        self.min_requests = min_requests
+        self.max_failure_rate = max_failure_rate
+        self.retry_interval = retry_interval
+        self.headers = {
+            "Accept": "*/*",
+            "Referer": "https://www.google.com",
+        }
+        self._health = {}
+        self._lock = threading.Lock()
+        self._loader = None
+        self._fetched_at = 0
+        self._refresher = None
+        self._refresh_started_at = 0
+        self.loaded = threading.Event()
+
+    @classmethod
+    def shared(cls) -> "ProxyPool":
+        """
+        Get the pool shared by every CrawlUrl of the process
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    @property
+    def proxies(self) -> Optional[List[Text]]:
+        with self._lock:
+            return list(self._health) or None
+
+    @property
+    def timeout(self) -> int:
+        """
+        Request timeout fitting the slowest proxy of the pool
+        """
+        with self._lock:
+            latencies = [health["latency"] for health in self._health.values()]
+        if not latencies:
+            return 50
+        return round(max(latencies)) + 5
+
+    def load_async(self):
+        """
+        Load the pool in a background thread once, from the disk cache when fresh or by scraping
+        """
+        with self._lock:
+            if self._loader is not None:
+                return
+            self._loader = threading.Thread(target=self._load, name="proxy-pool-loader", daemon=True)
+        self._loader.start()
+
+    def _load(self):
+        try:
+            if not self._load_cache():
+                self.refresh()
+        except Exception as e:
+            print(e)
+        finally:
+            self.loaded.set()
+
+    def _load_cache(self) -> bool:
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return False
+        with open(self.cache_path, encoding="utf-8") as f:
+            cache = json.load(f)
+        if time.time() - cache.get("fetched_at", 0) > self.ttl or not cache.get("proxies"):
+            return False
+        self._set(cache["proxies"], fetched_at=cache["fetched_at"])
+        return True
+
+    def _save_cache(self, proxies: List[Dict]):
+        if not self.cache_path:
+            return
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        tmp_path = self.cache_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"fetched_at": time.time(), "proxies": proxies}, f)
+        os.replace(tmp_path, self.cache_path)
+
+    def _set(self, proxies: List[Dict], fetched_at: Optional[float] = None):
+        with self._lock:
+            self._fetched_at = fetched_at if fetched_at else time.time()
+            self._health = {
+                proxy["addr"]: {"latency": float(proxy["latency"]), "requests": 0, "failures": 0}
+                for proxy in proxies
+            }
+
+    def _scrape(self) -> List[Dict]:
+        """
+        Scrape proxies with their advertised latency in seconds, fastest first
+        """
+        proxies = []
+        try:
+            url = f"https://checkerproxy.net/api/archive/{time.strftime('%Y-%m-%d')}"
+            resp = get(url=url, headers=self.headers, timeout=50)
+            resp.raise_for_status()
+            proxies = [{"addr": proxy["addr"], "latency": int(proxy["timeout"]) / 1000} for proxy in resp.json()]
+        except Exception as e:
+            # print(e)
+            url = f"""https://www.proxynova.com/proxy-server-list/country-{random.choice(['vn', 'us',
+                                                                                          'fr', 'de',
+                                                                                          'jp', 'cn',
+                                                                                          'ru', 'gb',
+                                                                                          'ca', 'au'])}/"""
+            resp = get(url=url, headers=self.headers, timeout=50)
+            soup = BeautifulSoup(resp.text, "html.parser")
+            table_proxies = soup.find("table", {"id": "tbl_proxy_list"})
+            table_proxies = table_proxies.find("tbody").find_all("tr")
+            for row in table_proxies:
+                row = row.find_all("td")
+                try:
+                    proxies.append({
+                        "addr": row[0].text.strip() + ":" + row[1].text.strip(),
+                        "latency": int(row[3].text.replace("ms", "").strip()) / 1000,
+                    })
+                except (IndexError, ValueError):
+                    continue
+        return sorted(proxies, key=lambda x: x["latency"])[:self.size]
+
+    def refresh(self):
+        """
+        Scrape a new proxy list, blocking, and cache it on disk
+        """
+        proxies = self._scrape()
+        self._set(proxies)
+        if proxies:
+            self._save_cache(proxies)
+
+    def _refresh_async(self):
+        """
+        Scrape again in the background when the pool is empty or older than ttl, at most every retry_interval
+        """
+        with self._lock:
+            now = time.time()
+            if self._health and now - self._fetched_at <= self.ttl:
+                return
+            if self._refresher is not None and self._refresher.is_alive():
+                return
+            if now - self._refresh_started_at < self.retry_interval:
+                return
+            self._refresh_started_at = now
+            self._refresher = threading.Thread(target=self._refresh_quietly, name="proxy-pool-refresher",
+                                               daemon=True)
+        self._refresher.start()
+
+    def _refresh_quietly(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            print(e)
+
+    def _score(self, health: Dict) -> float:
+        failure_rate = (health["failures"] + 1) / (health["requests"] + 2)
+        return health["latency"] * (1 + 4 * failure_rate)
+
+    def get(self, exclude: Optional[Iterable[Text]] = None) -> Optional[Text]:
+        """
+        Get a healthy proxy without blocking, None when the pool is not loaded yet or empty
+
+        Args:
+            exclude: proxies to skip, e.g. the ones that already failed for the current request
+
+        Returns:
+            proxy address
+        """
+        self.load_async()
+        if self.loaded.is_set():
+            # every proxy evicted or the list expired, a new one is scraped while requests go direct
+            self._refresh_async()
+        exclude = set(exclude) if exclude else set()
+        with self._lock:
+            candidates = [(self._score(health), addr) for addr, health in self._health.items() if addr not in exclude]
+        if not candidates:
+            return None
+        # pick among the best few so load is spread instead of piling onto a single proxy
+        candidates = sorted(candidates)[:3]
+        return random.choice(candidates)[1]
+
+    def report(self, proxy: Text, latency: float, ok: bool):
+        """
+        Record the outcome of a request sent through proxy, failing proxies are evicted
+
+        Args:
+            proxy: proxy address
+            latency: seconds the request took
+            ok: whether the request succeeded
+        """
+        with self._lock:
+            health = self._health.get(proxy)
+            if health is None:
+                return
+            health["requests"] += 1
+            if ok:
+                # exponential moving average of the measured latency
+                health["latency"] = 0.7 * health["latency"] + 0.3 * latency
+            else:
+                health["failures"] += 1
+            if health["requests"] >= self.min_requests and \
+                    health["failures"] / health["requests"] > self.max_failure_rate:
+                del self._health[proxy]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {addr: dict(health) for addr, health in self._health.items()}
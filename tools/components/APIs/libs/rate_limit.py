@@ -0,0 +1,69 @@
+import time
+import asyncio
+import threading
+from urllib.parse import urlparse
+from typing import Text, Optional, Dict
+
+
+class HostRateLimiter:
+    """
+    Space out requests per host, shared by every thread and event loop of the process
+
+    Attributes:
+        rates (Dict[Text, float]): max requests per second by host, a host also matches its subdomains
+        default_rate (float): max requests per second for hosts not in rates, None for no limit
+    """
+    def __init__(self, rates: Optional[Dict[Text, float]] = None, default_rate: Optional[float] = None):
+        self.rates = dict(rates) if rates else {}
+        self.default_rate = default_rate
+        self._next = {}
+        self._lock = threading.Lock()
+
+    def set_rate(self, host: Text, rate: Optional[float]):
+        """
+        Set max requests per second of host, None to remove the limit
+        """
+        with self._lock:
+            if rate:
+                self.rates[host] = rate
+            else:
+                self.rates.pop(host, None)
+
+    def _rate(self, host: Text) -> Optional[float]:
+        for limited_host, rate in self.rates.items():
+            if host == limited_host or host.endswith("." + limited_host):
+                return rate
+        return self.default_rate
+
+    def reserve(self, url: Text) -> float:
+        """
+        Reserve the next free slot of the host of url
+
+        Args:
+            url: url to request
+
+        Returns:
+            seconds to wait before sending the request
+        """
+        host = urlparse(url).netloc.split(":")[0]
+        with self._lock:
+            rate = self._rate(host)
+            if not rate:
+                return 0.0
+            now = time.monotonic()
+            start = max(now, self._next.get(host, now))
+            self._next[host] = start + 1.0 / rate
+            return start - now
+
+    def wait(self, url: Text):
+        delay = self.reserve(url)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def wait_async(self, url: Text):
+        delay = self.reserve(url)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+HOST_LIMITER = HostRateLimiter()
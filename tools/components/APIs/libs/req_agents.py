@@ -1,67 +1,236 @@
 import time
+import atexit
 import random
-from bs4 import BeautifulSoup
-from typing import Any, Text, Union
+import asyncio
+import threading
+import httpx
+from urllib.parse import urlparse
+from typing import Any, Text, Union, Optional, Set, List
 from fake_useragent import UserAgent
-from requests import get, Response, request
+from concurrent.futures import Future
 
 from .constants import USERAGENT_LIST
+from .rate_limit import HOST_LIMITER
+from .retry import RetryPolicy, DEFAULT_RETRY_POLICY
+from .proxy_pool import ProxyPool
+
+try:
+    import h2  # noqa: F401
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+
+class _EventLoopThread:
+    """
+    Process-wide event loop running in a daemon thread, owns the pooled HTTP clients
+    """
 
-class CrawlUrl:
     def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="crawl-url-loop", daemon=True)
+        self.thread.start()
+
+    def submit(self, coro) -> Future:
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+
+class CrawlUrl:
+    """
+    Crawl url without blocking
+
+    Every instance shares one event loop and one pooled client per proxy, so connections are kept alive
+    across instances and requests of any thread or event loop overlap on the same pool.
+
+    Attributes:
+        max_connections (int): max open connections of a pooled client
+        max_keepalive_connections (int): max idle connections kept alive by a pooled client
+        max_connections_per_host (int): max concurrent requests to one host
+    """
+    max_connections = 100
+    max_keepalive_connections = 20
+    max_connections_per_host = 8
+
+    _loop_thread = None
+    _clients = {}
+    _host_slots = {}
+    _init_lock = threading.Lock()
+
+    def __init__(self, retry_policy: Optional[RetryPolicy] = None):
         """
         Crawl url without blocking
+
+        Args:
+            retry_policy: retry policy of failed requests (default: process-wide DEFAULT_RETRY_POLICY)
         """
+        self.retry_policy = retry_policy if retry_policy else DEFAULT_RETRY_POLICY
         self.ua = UserAgent()
         self.headers = {
             "Accept": "*/*",
             "Referer": "https://www.google.com",
         }
-        self.proxies = None
-        self.timeout = 50
-        self._update_proxy()
+        # shared by every instance, loaded in the background so construction never blocks on scraping
+        self.proxy_pool = ProxyPool.shared()
+        self.proxy_pool.load_async()
+
+    @property
+    def proxies(self) -> Optional[List[Text]]:
+        return self.proxy_pool.proxies
+
+    @property
+    def timeout(self) -> int:
+        return self.proxy_pool.timeout
 
-    def _crawl_proxy(self):
+    def _update_proxy(self):
+        """
+        Update proxy
         """
-        Crawl proxy
+        self.proxy_pool.refresh()
+
+    @classmethod
+    def _get_loop_thread(cls) -> _EventLoopThread:
+        with cls._init_lock:
+            if cls._loop_thread is None:
+                cls._loop_thread = _EventLoopThread()
+                atexit.register(cls.close_all)
+            return cls._loop_thread
+
+    @classmethod
+    def _get_client(cls, proxy: Union[Text, None]) -> httpx.AsyncClient:
         """
-        proxies = []
+        Get the pooled client of proxy, must be called on the shared event loop
+        """
+        client = cls._clients.get(proxy)
+        if client is None:
+            client = httpx.AsyncClient(
+                http2=HTTP2,
+                # keep the previous behaviour of only routing plain http traffic through the proxy
+                proxies={"http://": "http://" + proxy} if proxy else None,
+                limits=httpx.Limits(max_connections=cls.max_connections,
+                                    max_keepalive_connections=cls.max_keepalive_connections),
+                follow_redirects=True,
+            )
+            cls._clients[proxy] = client
+        return client
+
+    @classmethod
+    def _get_host_slot(cls, url: Text) -> asyncio.Semaphore:
+        """
+        Get the semaphore limiting concurrent requests to the host of url, must be called on the shared event loop
+        """
+        host = urlparse(url).netloc
+        slot = cls._host_slots.get(host)
+        if slot is None:
+            slot = asyncio.Semaphore(cls.max_connections_per_host)
+            cls._host_slots[host] = slot
+        return slot
+
+    @classmethod
+    def close_all(cls):
+        """
+        Close every pooled client
+        """
+        if cls._loop_thread is None:
+            return
+
+        async def close():
+            for client in list(cls._clients.values()):
+                await client.aclose()
+            cls._clients.clear()
+
         try:
-            url = f"https://checkerproxy.net/api/archive/{time.strftime('%Y-%m-%d')}"
-            resp = get(url=url, headers=self.headers, timeout=self.timeout)
-            resp.raise_for_status()
-            proxies = resp.json()
+            cls._loop_thread.submit(close()).result(timeout=5)
         except Exception as e:
-            # print(e)
-            url = f"""https://www.proxynova.com/proxy-server-list/country-{random.choice(['vn', 'us',
-                                                                                          'fr', 'de',
-                                                                                          'jp', 'cn',
-                                                                                          'ru', 'gb',
-                                                                                          'ca', 'au'])}/"""
-            resp = get(url=url, headers=self.headers, timeout=self.timeout)
-            soup = BeautifulSoup(resp.text, "html.parser")
-            table_proxies = soup.find("table", {"id": "tbl_proxy_list"})
-            table_proxies = table_proxies.find("tbody").find_all("tr")
-            for row in table_proxies:
-                row = row.find_all("td")
-                proxies.append({
-                    "addr": row[0].text + ":" + row[1].text,
-                    "timeout": row[3].text.replace("ms", ""),
-                })
-        if not proxies:
-            self.proxies = None
-            return
-        proxies = sorted(proxies, key=lambda x: x["timeout"])[:5]
-        self.timeout = round(int(proxies[-1]["timeout"]) / 1000) + 5
-        self.proxies = [proxy["addr"] for proxy in proxies]
+            print(e)
 
-    def _update_proxy(self):
+    def _next_proxy(self, tried: Set[Text]) -> Optional[Text]:
         """
-        Update proxy
+        Pick the healthiest proxy not tried yet by the current request
+        """
+        proxy = self.proxy_pool.get(exclude=tried)
+        return proxy if proxy else self.proxy_pool.get()
+
+    async def _request(self, url: Text, **kwargs) -> httpx.Response:
         """
-        self._crawl_proxy()
+        Send request with the pooled client, runs on the shared event loop
 
-    async def crawl_url(self, url: Text, **kwargs) -> Union[Any, Response]:
+        Failed attempts are retried according to retry_policy, rotating through the cached proxies first
+        and refreshing the proxy list at most once per request when all of them failed. The deadline
+        kwarg (default: retry_policy.deadline) bounds the whole request, each attempt gets at most the
+        time left.
+        """
+        host = urlparse(url).netloc
+        timeout = kwargs.get("timeout", self.timeout)
+        method = kwargs.get("method", "get")
+        deadline = kwargs.get("deadline", self.retry_policy.deadline)
+        expires_at = time.monotonic() + deadline if deadline else None
+        tried = set()
+        refreshed = False
+        attempt = 0
+        while True:
+            proxy = self._next_proxy(tried)
+            header = dict(kwargs.get("headers", self.headers))
+            header["User-Agent"] = random.choice([random.choice(USERAGENT_LIST), self.ua.random])
+            await HOST_LIMITER.wait_async(url)
+            attempt_timeout = timeout
+            if expires_at is not None:
+                remaining = expires_at - time.monotonic()
+                if remaining <= 0:
+                    self.retry_policy.record_give_up(host)
+                    raise httpx.TimeoutException("Deadline of {}s exceeded for {}".format(deadline, url))
+                attempt_timeout = min(timeout, remaining) if timeout else remaining
+            retry_after = None
+            error = None
+            # proxies only carry plain http traffic, see _get_client
+            via_proxy = proxy if proxy and url.startswith("http://") else None
+            start_time = time.monotonic()
+            try:
+                async with self._get_host_slot(url):
+                    # httpx timeouts apply per phase, a slowly streamed body could still outlive the deadline
+                    resp = await asyncio.wait_for(self._get_client(proxy).request(
+                        method=method,
+                        url=url,
+                        headers=header,
+                        params=kwargs.get("params", None),
+                        data=kwargs.get("data", None),
+                        json=kwargs.get("json", None),
+                        timeout=attempt_timeout,
+                    ), timeout=None if expires_at is None else expires_at - time.monotonic())
+                if via_proxy:
+                    self.proxy_pool.report(via_proxy, time.monotonic() - start_time,
+                                           ok=resp.status_code not in self.retry_policy.retry_statuses)
+                if resp.status_code not in self.retry_policy.retry_statuses:
+                    resp.raise_for_status()
+                    return resp
+                reason = str(resp.status_code)
+                retry_after = resp.headers.get("Retry-After")
+            except (httpx.TransportError, asyncio.TimeoutError) as e:
+                if via_proxy:
+                    self.proxy_pool.report(via_proxy, time.monotonic() - start_time, ok=False)
+                if isinstance(e, asyncio.TimeoutError):
+                    e = httpx.TimeoutException("Deadline of {}s exceeded for {}".format(deadline, url))
+                error, reason = e, type(e).__name__
+            delay = self.retry_policy.delay(attempt, retry_after)
+            out_of_time = expires_at is not None and time.monotonic() + delay >= expires_at
+            retryable = self.retry_policy.retryable(method, error=error,
+                                                    status=None if error else resp.status_code)
+            if out_of_time or not retryable or not self.retry_policy.should_retry(attempt):
+                self.retry_policy.record_give_up(host)
+                if error is not None:
+                    raise error
+                resp.raise_for_status()
+                return resp
+            self.retry_policy.record_retry(host, reason)
+            if proxy:
+                tried.add(proxy)
+            if self.proxies and all(proxy in tried for proxy in self.proxies) and not refreshed:
+                await asyncio.get_running_loop().run_in_executor(None, self._update_proxy)
+                tried.clear()
+                refreshed = True
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def crawl_url(self, url: Text, **kwargs) -> Union[Any, httpx.Response]:
         """
         Crawl url
 
@@ -69,30 +238,54 @@ class CrawlUrl:
             url (str): url
 
         Returns:
-            requests.Response
+            httpx.Response
         """
-        proxy = None
-        if self.proxies:
-            proxy = {"http": random.choice(self.proxies)}
-        header = kwargs.get("headers", self.headers)
-        header["User-Agent"] = random.choice([random.choice(USERAGENT_LIST), self.ua.random])
-        timeout = kwargs.get("timeout", self.timeout)
-        method = kwargs.get("method", "get")
-        resp = request(
-            method=method,
-            url=url,
-            headers=header,
-            params=kwargs.get("params", None),
-            data=kwargs.get("data", None),
-            proxies=proxy if proxy else None,
-            timeout=timeout,
-            json=kwargs.get("json", None),
-        )
-        if resp.status_code == 429:
-            self._update_proxy()
-            return await self.crawl_url(url, **kwargs)
-        resp.raise_for_status()
-        return resp
+        loop_thread = self._get_loop_thread()
+        if asyncio.get_running_loop() is loop_thread.loop:
+            return await self._request(url, **kwargs)
+        return await asyncio.wrap_future(loop_thread.submit(self._request(url, **kwargs)))
+
+    def run_sync(self, coro) -> Any:
+        """
+        Run a coroutine on the shared event loop from synchronous code, its requests skip the hop between loops
+
+        Args:
+            coro: coroutine
+
+        Returns:
+            result of the coroutine
+        """
+        return self._get_loop_thread().submit(coro).result()
+
+    def crawl_url_future(self, url: Text, **kwargs) -> Future:
+        """
+        Start crawling url on the shared event loop
+
+        Args:
+            url (str): url
+
+        Returns:
+            Future of httpx.Response, cancelling it cancels the request and its retries
+        """
+        return self._get_loop_thread().submit(self._request(url, **kwargs))
+
+    def crawl_url_sync(self, url: Text, **kwargs) -> Union[Any, httpx.Response]:
+        """
+        Crawl url from synchronous code, blocks the calling thread only
+
+        Args:
+            url (str): url
+
+        Returns:
+            httpx.Response
+        """
+        return self.crawl_url_future(url, **kwargs).result()
+
+    @staticmethod
+    def _read(resp: httpx.Response) -> Union[str, dict]:
+        if resp and resp.headers.get("Content-Type") == "application/json":
+            return resp.json()
+        return resp.text
 
     async def gettext(self, url: Text, **kwargs) -> Union[str, dict]:
         """
@@ -106,6 +299,17 @@ class CrawlUrl:
             json: json from url
         """
         resp = await self.crawl_url(url, **kwargs)
-        if resp and resp.headers.get("Content-Type") == "application/json":
-            return resp.json()
-        return resp.text
+        return self._read(resp)
+
+    def gettext_sync(self, url: Text, **kwargs) -> Union[str, dict]:
+        """
+        Get text from url from synchronous code
+
+        Args:
+            url (str): url
+
+        Returns:
+            str: text from url
+            json: json from url
+        """
+        return self._read(self.crawl_url_sync(url, **kwargs))
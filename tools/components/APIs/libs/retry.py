@@ -0,0 +1,139 @@
+import time
+import random
+import threading
+from collections import Counter
+from email.utils import parsedate_to_datetime
+from typing import Text, Optional, Dict, Tuple
+
+import httpx
+
+# errors raised before the request reached the server, safe to retry whatever the method
+CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout, httpx.ProxyError)
+
+
+class RetryPolicy:
+    """
+    Bounded retries with exponential backoff and full jitter
+
+    Only idempotent methods are retried after the request was sent, a POST is retried on connection
+    errors and 429 only, the server never saw it or refused it. Every attempt and wait of a request
+    fits in its deadline.
+
+    Attributes:
+        max_attempts (int): max number of attempts of one request, including the first one
+        base_delay (float): backoff of the first retry in seconds, doubled on every retry
+        max_delay (float): max backoff in seconds
+        max_retry_after (float): max seconds to honor from a Retry-After header
+        retry_statuses (Tuple[int]): HTTP statuses worth retrying
+        deadline (float): default max seconds of a request, all attempts and waits included
+        idempotent_methods (Tuple[Text]): methods retried whatever the failure
+    """
+
+    def __init__(self,
+                 max_attempts: Optional[int] = 5,
+                 base_delay: Optional[float] = 0.5,
+                 max_delay: Optional[float] = 30,
+                 max_retry_after: Optional[float] = 120,
+                 retry_statuses: Optional[Tuple[int, ...]] = (429, 502, 503, 504),
+                 deadline: Optional[float] = 300,
+                 idempotent_methods: Optional[Tuple[Text, ...]] = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.retry_statuses = retry_statuses
+        self.deadline = deadline
+        self.idempotent_methods = idempotent_methods
+        self._lock = threading.Lock()
+        self._retries = Counter()
+        self._give_ups = Counter()
+        self._reasons = Counter()
+
+    @staticmethod
+    def parse_retry_after(value: Optional[Text]) -> Optional[float]:
+        """
+        Parse a Retry-After header, given either in seconds or as an HTTP date
+
+        Args:
+            value: header value
+
+        Returns:
+            seconds to wait or None
+        """
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def should_retry(self, attempt: int) -> bool:
+        """
+        Check if another attempt is allowed after attempt (0-based) failed
+        """
+        return attempt + 1 < self.max_attempts
+
+    def retryable(self, method: Text, error: Optional[Exception] = None, status: Optional[int] = None) -> bool:
+        """
+        Check if a failure may be retried without risking to repeat its effect
+
+        Args:
+            method: HTTP method
+            error: transport error of the failed attempt
+            status: HTTP status of the failed attempt
+
+        Returns:
+            True if retrying is safe
+        """
+        if method.upper() in self.idempotent_methods:
+            return True
+        if error is not None:
+            return isinstance(error, CONNECT_ERRORS)
+        return status == 429
+
+    def delay(self, attempt: int, retry_after: Optional[Text] = None) -> float:
+        """
+        Seconds to wait before the next attempt
+
+        Args:
+            attempt: 0-based number of the attempt that failed
+            retry_after: Retry-After header of the failed response
+
+        Returns:
+            seconds to wait
+        """
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = self.parse_retry_after(retry_after)
+        if retry_after is not None:
+            return max(backoff, min(retry_after, self.max_retry_after))
+        return backoff
+
+    def record_retry(self, host: Text, reason: Text):
+        with self._lock:
+            self._retries[host] += 1
+            self._reasons[reason] += 1
+
+    def record_give_up(self, host: Text):
+        with self._lock:
+            self._give_ups[host] += 1
+
+    def stats(self) -> Dict:
+        """
+        Retry metrics
+
+        Returns:
+            dict with retries and give ups by host and retries by reason
+        """
+        with self._lock:
+            return {
+                "retries": dict(self._retries),
+                "give_ups": dict(self._give_ups),
+                "reasons": dict(self._reasons),
+            }
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
@@ -6,6 +6,17 @@ from .constants import (
     REGEX_COMMAND_REMOVE,
 )
 
+# compiled once, clean_text and normalize_res run on every search result
+PATTERN_REMOVE_ADS = re.compile(REGEX_REMOVE_ADS, re.DOTALL | re.IGNORECASE)
+# clean_text always passed its flags to re.sub as the count argument, so these rules are case-sensitive
+# and bounded by that count, kept as is since answers stored so far were cleaned this way
+PATTERN_REMOVE_ADS_CASE = re.compile(REGEX_REMOVE_ADS)
+PATTERN_COMMAND_REMOVE = re.compile(REGEX_COMMAND_REMOVE)
+COUNT_REMOVE_ADS = int(re.DOTALL | re.IGNORECASE)
+COUNT_COMMAND_REMOVE = int(re.MULTILINE | re.IGNORECASE | re.DOTALL)
+PATTERN_SEPARATORS = re.compile(r'[\t\r\xa0\\/]')
+PATTERN_SPACES = re.compile(r'\s+')
+
 
 class StringUtils:
 
@@ -21,11 +32,10 @@ class StringUtils:
             str: cleaned text
         """
         text = StringUtils.normalize_res(text)
-        ads = re.search(REGEX_REMOVE_ADS, text, re.DOTALL | re.IGNORECASE)
-        if ads:
-            text = text[:ads.start()] + text[ads.end():]
-        text = re.sub(REGEX_REMOVE_ADS, '', text, re.DOTALL | re.IGNORECASE)
-        text = re.sub(REGEX_COMMAND_REMOVE, '', text, re.MULTILINE | re.IGNORECASE | re.DOTALL)
+        # first ad with the flags, then the case-sensitive ones
+        text = PATTERN_REMOVE_ADS.sub('', text, count=1)
+        text = PATTERN_REMOVE_ADS_CASE.sub('', text, count=COUNT_REMOVE_ADS)
+        text = PATTERN_COMMAND_REMOVE.sub('', text, count=COUNT_COMMAND_REMOVE)
         text = text.strip(' ')
         return text
 
@@ -60,10 +70,11 @@ class StringUtils:
         Returns:
             str: string in Vietnamese
         """
-        text = re.sub(r'&amp;', '&', text)
-        text = re.sub(r'&quot;', '"', text)
-        text = re.sub(r'&lt;', '<', text)
-        text = re.sub(r'&gt;', '>', text)
+        # literal patterns, str.replace in the same order gives the same result without regexes
+        text = text.replace('&amp;', '&')
+        text = text.replace('&quot;', '"')
+        text = text.replace('&lt;', '<')
+        text = text.replace('&gt;', '>')
         return text
 
     @staticmethod
@@ -79,7 +90,7 @@ class StringUtils:
         """
         source = unquote(html, encoding='utf-8')
         source = StringUtils.html2vietnamese(source)
-        source = re.sub(r'[\t\r\xa0\\/]', ' ', source)
+        source = PATTERN_SEPARATORS.sub(' ', source)
         source = source.replace("...", "")
-        source = re.sub(r'\s+', ' ', source)
+        source = PATTERN_SPACES.sub(' ', source)
         return source.strip()
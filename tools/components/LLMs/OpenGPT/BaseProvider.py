@@ -1,8 +1,10 @@
-import asyncio
+import time
+import threading
+from typing import Optional
 from abc import ABC, abstractmethod
+from concurrent.futures import CancelledError
 
 from tools.components.APIs.libs.req_agents import CrawlUrl
-from tools.components.LLMs.OpenGPT.libs.asynctask import RunThread
 from tools.components.LLMs.OpenGPT.libs.typing import Any, CreateResult
 
 class BaseProvider(ABC):
@@ -13,32 +15,50 @@ class BaseProvider(ABC):
     supports_gpt_35_turbo = False
     supports_gpt_4 = False
 
-    def __init__(self):
+    def __init__(self, timeout: Optional[float] = 1000):
         self._req_agent = CrawlUrl()
-        self._tasks = None
+        self.timeout = timeout
+        self.cancelled = False
+        self.expires_at = None
+        self._requests = set()
+        self._lock = threading.Lock()
 
-    def _get_task(self):
-        try:
-            loop = asyncio.get_running_loop()
-        except RuntimeError:
-            loop = None
-        self._tasks = loop
-
-    def _add_task(self, task, *args, **kwargs):
-        print(self._tasks)
-        if self._tasks:
-            thread = RunThread(task, args, kwargs)
-            thread.start()
-            thread.join()
-            return thread.result
-        else:
-            return asyncio.run(task(*args, **kwargs))
+    def start(self):
+        """
+        Start the time budget of one completion, every request and retry of it fits in timeout
+        """
+        self.expires_at = time.monotonic() + self.timeout if self.timeout else None
 
     def send_request(self, url, **kwargs):
-        # add timeout to kwargs
-        kwargs["timeout"] = 1000
-        self._get_task()
-        return self._add_task(self._req_agent.crawl_url, url, **kwargs)
+        # the time left of the completion, not a fresh timeout per request or per retry
+        remaining = self.timeout
+        if self.expires_at is not None:
+            remaining = max(0.0, self.expires_at - time.monotonic())
+            if remaining == 0:
+                raise TimeoutError("{} ran out of its {}s budget".format(type(self).__name__, self.timeout))
+        kwargs.setdefault("timeout", remaining)
+        kwargs.setdefault("deadline", remaining)
+        # runs on the shared CrawlUrl event loop, safe to call with or without a running loop
+        with self._lock:
+            if self.cancelled:
+                raise CancelledError()
+            request = self._req_agent.crawl_url_future(url, **kwargs)
+            self._requests.add(request)
+        try:
+            return request.result()
+        finally:
+            with self._lock:
+                self._requests.discard(request)
+
+    def cancel(self):
+        """
+        Cancel the requests in flight and the next ones, send_request raises CancelledError
+        """
+        with self._lock:
+            self.cancelled = True
+            requests = list(self._requests)
+        for request in requests:
+            request.cancel()
 
     @abstractmethod
     def create_completion(
@@ -42,16 +42,15 @@ class GetGPT(BaseProvider):
             method="POST",
             url="https://chat.getgpt.world/api/chat/stream",
             headers=headers,
-            json={"signature": self._encrypt(data)},
-            stream=True
+            json={"signature": self._encrypt(data)}
         )
 
         if res is None:
             return None
 
         for line in res.iter_lines():
-            if b"content" in line:
-                line_json = json.loads(line.decode("utf-8").split("data: ")[1])
+            if "content" in line:
+                line_json = json.loads(line.split("data: ")[1])
                 yield line_json["choices"][0]["delta"]["content"]
 
     def _encrypt(self, e: str):
@@ -1,6 +1,7 @@
 import os
 import re
 import base64
+from typing import Optional
 
 from tools.components.LLMs.OpenGPT.BaseProvider import BaseProvider
 from tools.components.LLMs.OpenGPT.libs.typing import Any, CreateResult
@@ -11,8 +12,8 @@ class LoChatGPT(BaseProvider):
     supports_gpt_35_turbo = True
     working = True
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, timeout: Optional[float] = 1000):
+        super().__init__(timeout=timeout)
         self._nonce = self._get_nonce()
 
     def create_completion(
@@ -1,15 +0,0 @@
-import asyncio
-import threading
-
-
-class RunThread(threading.Thread):
-    def __init__(self, func, args, kwargs):
-        self.func = func
-        self.args = args
-        self.kwargs = kwargs
-        self.result = None
-        super().__init__()
-
-    def run(self):
-        self.result = asyncio.run(self.func(*self.args, **self.kwargs))
-        print(self.result)
@@ -0,0 +1,202 @@
+import json
+import time
+import threading
+from collections import deque
+from typing import Dict, List, Optional, Text
+
+
+class ProviderRegistry:
+    """
+    Track per-provider health so the fastest healthy providers are tried first and dead ones are skipped
+
+    Every provider keeps a rolling window of its last calls. After failure_threshold consecutive failures
+    its circuit opens and the provider is skipped for cooldown seconds. It is then tried again (half-open)
+    by a single probe call, see acquire: a success closes the circuit, a failure opens it for another
+    cooldown. Timeouts follow the observed p95 latency.
+
+    Attributes:
+        providers (List[type]): provider classes
+        window (int): number of recent calls kept per provider
+        failure_threshold (int): consecutive failures opening the circuit
+        cooldown (float): seconds a provider is skipped once its circuit is open
+        default_timeout (float): timeout while a provider has too few successful calls
+        min_timeout (float): lower bound of the adaptive timeout
+        max_timeout (float): upper bound of the adaptive timeout
+        timeout_factor (float): multiplier applied to the p95 latency
+    """
+
+    def __init__(self,
+                 providers: List[type],
+                 window: Optional[int] = 50,
+                 failure_threshold: Optional[int] = 3,
+                 cooldown: Optional[float] = 300,
+                 default_timeout: Optional[float] = 120,
+                 min_timeout: Optional[float] = 10,
+                 max_timeout: Optional[float] = 1000,
+                 timeout_factor: Optional[float] = 1.5):
+        self.providers = list(providers)
+        self.window = window
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.default_timeout = default_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.timeout_factor = timeout_factor
+        self._calls = {provider.__name__: deque(maxlen=window) for provider in self.providers}
+        self._consecutive_failures = {provider.__name__: 0 for provider in self.providers}
+        self._opened_at = {}
+        self._probing = set()
+        self._lock = threading.Lock()
+
+    def record(self, provider: type, latency: float, ok: bool):
+        """
+        Record the outcome of one call to provider
+
+        Args:
+            provider: provider class
+            latency: seconds the call took
+            ok: whether the provider returned an acceptable answer
+        """
+        name = provider.__name__
+        with self._lock:
+            self._probing.discard(name)
+            self._calls[name].append((latency, ok))
+            if ok:
+                self._consecutive_failures[name] = 0
+                self._opened_at.pop(name, None)
+            else:
+                self._consecutive_failures[name] += 1
+                if self._consecutive_failures[name] >= self.failure_threshold:
+                    # (re)open the circuit, also when a half-open trial call failed
+                    self._opened_at[name] = time.time()
+
+    def _state(self, name: Text) -> Text:
+        opened_at = self._opened_at.get(name)
+        if opened_at is None:
+            return "closed"
+        if time.time() - opened_at >= self.cooldown:
+            return "half-open"
+        return "open"
+
+    def available(self, provider: type) -> bool:
+        """
+        Check if provider may be called, i.e. its circuit is not open and no probe of it is running
+        """
+        with self._lock:
+            name = provider.__name__
+            return self._state(name) != "open" and name not in self._probing
+
+    def acquire(self, provider: type) -> bool:
+        """
+        Claim a call to provider, only one caller at a time gets to probe a half-open circuit
+
+        Args:
+            provider: provider class
+
+        Returns:
+            True if the call may go ahead, record or release must follow a successful probe claim
+        """
+        name = provider.__name__
+        with self._lock:
+            if self._state(name) != "half-open":
+                return True
+            if name in self._probing:
+                return False
+            self._probing.add(name)
+            return True
+
+    def release(self, provider: type):
+        """
+        Give up a claimed probe without an outcome, e.g. a call cancelled because another provider won
+        """
+        with self._lock:
+            self._probing.discard(provider.__name__)
+
+    @staticmethod
+    def _percentile(values: List[float], q: float) -> Optional[float]:
+        if not values:
+            return None
+        values = sorted(values)
+        return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+    def _latencies(self, name: Text) -> List[float]:
+        return [latency for latency, ok in self._calls[name] if ok]
+
+    def timeout(self, provider: type) -> float:
+        """
+        Timeout of the next call to provider, derived from the p95 latency of its successful calls
+
+        Args:
+            provider: provider class
+
+        Returns:
+            seconds
+        """
+        with self._lock:
+            latencies = self._latencies(provider.__name__)
+        if len(latencies) < 5:
+            return self.default_timeout
+        timeout = self._percentile(latencies, 0.95) * self.timeout_factor
+        return max(self.min_timeout, min(self.max_timeout, timeout))
+
+    def _rank(self, provider: type):
+        calls = self._calls[provider.__name__]
+        successes = sum(1 for _, ok in calls if ok)
+        success_rate = (successes + 1) / (len(calls) + 2)
+        latency = self._percentile(self._latencies(provider.__name__), 0.5)
+        # untried providers keep their declared order after the proven ones
+        return -success_rate, latency if latency is not None else float("inf")
+
+    def ranked(self, limit: Optional[int] = None) -> List[type]:
+        """
+        Callable providers from most to least preferred, all of them if every circuit is open
+
+        Args:
+            limit: max number of providers to return
+
+        Returns:
+            list of provider classes
+        """
+        with self._lock:
+            providers = [provider for provider in self.providers
+                         if self._state(provider.__name__) != "open" and provider.__name__ not in self._probing]
+            providers = sorted(providers if providers else self.providers, key=self._rank)
+        return providers[:limit] if limit else providers
+
+    def stats(self) -> Dict:
+        """
+        Health of every provider
+
+        Returns:
+            dict of provider name -> stats
+        """
+        result = {}
+        for provider in self.providers:
+            name = provider.__name__
+            with self._lock:
+                calls = list(self._calls[name])
+                latencies = self._latencies(name)
+                state = self._state(name)
+                consecutive_failures = self._consecutive_failures[name]
+            successes = sum(1 for _, ok in calls if ok)
+            result[name] = {
+                "calls": len(calls),
+                "successes": successes,
+                "success_rate": successes / len(calls) if calls else None,
+                "p50": self._percentile(latencies, 0.5),
+                "p95": self._percentile(latencies, 0.95),
+                "timeout": self.timeout(provider),
+                "state": state,
+                "consecutive_failures": consecutive_failures,
+            }
+        return result
+
+    def dump(self, path: Text):
+        """
+        Write stats to a json file
+
+        Args:
+            path: path to json file
+        """
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.stats(), f, indent=2)
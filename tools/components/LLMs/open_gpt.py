@@ -1,7 +1,11 @@
+import time
 import ftfy
-from typing import Text, Union, List
+import threading
+from typing import Text, Union, List, Optional
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, CancelledError
 
 from tools.utils import clean_bot_answer
+from tools.components.LLMs.OpenGPT.libs.registry import ProviderRegistry
 from tools.components.LLMs.OpenGPT import (GetGPT,
                                            YqChatGPT,
                                            OpChatGPT,
@@ -13,11 +17,17 @@ class OpenGPTBot:
     Open AI bot with gpt_4_free
     """
 
-    def __init__(self):
+    def __init__(self, race: Optional[int] = None):
         """
         Initialize OpenAIBot
+
+        Args:
+            race: number of providers asked concurrently, the first acceptable answer wins (default: one by one)
         """
         self._list_provider = [GetGPT, OpChatGPT, LoChatGPT, OrChatGPT, YqChatGPT]
+        self.registry = ProviderRegistry(self._list_provider)
+        self.race = race
+        self._executor = None
         self._provider = None
         self._retry = len(self._list_provider)
         self.form = {
@@ -28,6 +38,7 @@ class OpenGPTBot:
     @staticmethod
     def _get_answer(engine, form, **kwargs):
         try:
+            engine.start()
             response = engine.create_completion(model="gpt-3.5-turbo", messages=[form],
                                                   stream=engine.supports_stream, **kwargs)
             if not isinstance(response, str):
@@ -36,10 +47,89 @@ class OpenGPTBot:
                     full_text += text
                 response = full_text
             return response
+        except CancelledError:
+            raise
         except Exception as e:
             print(e)
             return None
 
+    def _try_provider(self, provider, form, engine=None, on_engine=None, **kwargs):
+        """
+        Instantiate provider and ask it, recording latency and outcome
+
+        A provider failing to instantiate, e.g. LoChatGPT fetching its nonce, is recorded as a failure.
+
+        Args:
+            provider: provider class
+            form: message
+            engine: instance of provider to use, created when None
+            on_engine: called with the engine once it exists, before it is asked
+
+        Returns:
+            (engine, answer), answer is None on failure
+        """
+        if not self.registry.acquire(provider):
+            # another caller is probing the half-open circuit of this provider
+            return engine, None
+        start_time = time.time()
+        res_bot = None
+        try:
+            engine = engine if engine else provider(timeout=self.registry.timeout(provider))
+            if on_engine is not None:
+                on_engine(engine)
+            res_bot = self._get_answer(engine, form, **kwargs)
+        except CancelledError:
+            # lost a race, says nothing about the health of the provider
+            self.registry.release(provider)
+            return engine, None
+        except Exception as e:
+            print(e)
+        self.registry.record(provider, time.time() - start_time, ok=bool(res_bot))
+        return engine, res_bot
+
+    def _race(self, form, **kwargs):
+        """
+        Ask the best ranked providers at the same time and keep the first acceptable answer
+
+        Providers are instantiated in the race threads, a slow constructor only delays its own answer.
+        Once a winner is found the requests of the other providers are cancelled on the shared event
+        loop, see BaseProvider.cancel, so their threads are free again right away, engines created after
+        that are cancelled as soon as they exist.
+
+        Returns:
+            (engine, answer) of the winner or (None, None)
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=len(self._list_provider) * 2,
+                                                thread_name_prefix="open-gpt-race")
+        providers = self.registry.ranked(limit=self.race)
+        print("Race: ", [provider.__name__ for provider in providers])
+        engines = []
+        lock = threading.Lock()
+        winner = []
+
+        def on_engine(engine):
+            with lock:
+                engines.append(engine)
+                lost = bool(winner)
+            if lost:
+                engine.cancel()
+
+        pending = {self._executor.submit(self._try_provider, provider, form, on_engine=on_engine, **kwargs)
+                   for provider in providers}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                engine, res_bot = future.result()
+                if res_bot:
+                    with lock:
+                        winner.append(engine)
+                        others = [other for other in engines if other is not engine]
+                    for other in others:
+                        other.cancel()
+                    return engine, res_bot
+        return None, None
+
     def ask(self, question: Text, **kwargs) -> Union[Text, List[Text]]:
         """
         Ask a question to the bot.
@@ -56,29 +146,38 @@ class OpenGPTBot:
         form = self.form.copy()
         form["content"] = str(question)
         res = "Tôi xin lỗi, tôi không hiểu câu hỏi của bạn."
-        if not self._provider:
-            for provider in self._list_provider:
+        if self._provider and not (self.registry.available(type(self._provider))
+                                   and self.registry.acquire(type(self._provider))):
+            # circuit of the sticky provider opened or another caller probes it, pick the next healthy one
+            self._provider = None
+        if self.race and self.race > 1:
+            engine, res_bot = self._race(form, **kwargs)
+            if res_bot:
+                res = res_bot
+        elif not self._provider:
+            for provider in self.registry.ranked():
                 print("Try: ", provider.__name__)
-                try:
-                    engine = provider()
-                    res_bot = self._get_answer(engine, form, **kwargs)
-                    if res_bot:
-                        res = res_bot
-                        self._provider = engine
-                        self._retry = len(self._list_provider)
-                        break
-                except Exception as e:
-                    print(e)
-                    pass
+                engine, res_bot = self._try_provider(provider, form, **kwargs)
+                if res_bot:
+                    res = res_bot
+                    self._provider = engine
+                    self._retry = len(self._list_provider)
+                    break
         else:
             try:
-                print("Still try: ", self._provider.__name__)
+                print("Still try: ", type(self._provider).__name__)
+                self._provider.timeout = self.registry.timeout(type(self._provider))
+                start_time = time.time()
                 res_bot = self._get_answer(self._provider, form, **kwargs)
+                self.registry.record(type(self._provider), time.time() - start_time, ok=bool(res_bot))
                 if res_bot:
                     res = res_bot
                     print(res)
+                else:
+                    self._provider = None
             except Exception as e:
                 # print(e)
+                self.registry.release(type(self._provider))
                 self._provider = None
                 self._retry -= 1
                 if self._retry > 0:
@@ -87,6 +186,12 @@ class OpenGPTBot:
         print("===> ", res)
         return res
 
+    def stats(self):
+        """
+        Health of every provider, see ProviderRegistry.stats
+        """
+        return self.registry.stats()
+
 
 # if __name__ == "__main__":
 #     bot = OpenGPTBot()
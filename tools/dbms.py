@@ -1,24 +1,64 @@
 import os
-import re
-import chromadb
+import json
+import time
+import atexit
+import uuid
+import hashlib
+import unicodedata
+import functools
+import itertools
+import queue
+import threading
+import multiprocessing
+import numpy as np
 import pandas as pd
-from chromadb.config import Settings
-from typing import Text, Optional, List, Dict
-from tools.utils import clean_data, flatten_list
-from sentence_transformers import SentenceTransformer
+from typing import Text, Optional, List, Dict, Union
+from tools.utils import clean_data, flatten_list, TextCleaner, DEFAULT_RULES
+from tools.caching import EmbeddingCache, CachedEncoder
+from tools.batching import MicroBatcher
+from tools.embedding_backends import OnnxEncoder
+from tools.snapshot import SnapshotCollection, SpoolQueue
+from tools.vector_stores import VectorStore, ChromaStore, HnswStore, IdIndex
+from tools.wal import WriteAheadLog
+from tools.lexical import BM25Index, reciprocal_rank_fusion
 
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+
+def synchronized(func):
+    """
+    Run method while holding the instance lock, the duckdb backed collection is not safe for concurrent writes
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return func(self, *args, **kwargs)
+    return wrapper
 
 class DBMS:
     """
-    Database management system for ChromaDB
+    Database management system over a vector store, ChromaDB by default
 
     Attributes:
         device (Text): device to run model
+        backend (Text): 'torch' for SentenceTransformer or 'onnx' for ONNX Runtime
         threshold (float): threshold to filter data
         model_path (Text): path to SentenceTransformer model huggingface
-        model (SentenceTransformer): SentenceTransformer model
+        model (SentenceTransformer): SentenceTransformer model, wrapped by CachedEncoder when embedding_cache is on
+            and by MicroBatcher when micro_batch is on
         collection_name (Text): name of collection to store data
-        collection (chromadb.Collection): ChromaDB collection
+        vector_store (Text): 'chroma' for ChromaDB with duckdb+parquet or 'hnsw' for hnswlib with a memory-mapped
+            matrix and SQLite records (tuned with hnsw_M, hnsw_ef_construction and hnsw_ef)
+        collection (VectorStore): store of the records, or the shared snapshot when read_only
+        read_only (bool): query a memory-mapped snapshot and spool inserts to the writer process
+        hybrid (bool): keep a BM25 index of the documents and fuse its ranking with the vector search
+        lexical (BM25Index): lexical sidecar of the collection, kept in sync by insert/update/delete when hybrid
+        id_index (IdIndex): ids and content hashes of the stored records, inserts skip documents already stored
+        wal (WriteAheadLog): log of writes not persisted yet when the wal kwarg is on (default), the collection
+            is persisted in the background every compact_rows logged rows or compact_interval seconds. Writes
+            are then O(1) on the hnsw store, chromadb still saves its hnsw index on every add
+
+    Model and database are loaded lazily on first use, call warm_up to load them ahead of time.
     """
     def __init__(self,
                  model_path: Text,
@@ -29,27 +69,277 @@ class DBMS:
         self.model_path = model_path
         self.collection_name = collection_name
         self.device = 'cpu'
-        try:
-            import torch
-            if torch.cuda.is_available():
-                self.device = 'cuda'
-        except ImportError:
-            pass
-        self.model = SentenceTransformer(self.model_path, device=self.device)
-        self.db = chromadb.Client(Settings(
-            chroma_db_impl="duckdb+parquet",
-            persist_directory=os.path.join(os.path.dirname(__file__), 'data')
-        ))
-        self.collection = self.db.get_or_create_collection(self.collection_name, metadata={"hnsw:space": "cosine"})
-        print("Current has {} records".format(self.collection.count()))
+        self._lock = threading.RLock()
+        # model and database are only loaded on first use, see the model/db/collection properties
+        self._init_lock = threading.Lock()
+        self._model = None
+        self._collection = None
+        self.persist_directory = DATA_DIR
+        os.makedirs(self.persist_directory, exist_ok=True)
+        self.backend = kwargs.get("backend", "torch")
+        self.vector_store = kwargs.get("vector_store", "chroma")
+        self.read_only = kwargs.get("read_only", False)
+        self.spool = SpoolQueue(os.path.join(self.persist_directory, 'spool')) if self.read_only else None
+        self.hybrid = kwargs.get("hybrid", False)
+        self.lexical = None
+        self.id_index = None
+        self.wal = None
+        # writes made since the last persist
+        self._dirty = False
+        self._compact_event = threading.Event()
+        # lexical index writes, tokenized by a background thread rather than under the write lock
+        self._lexical_queue = queue.Queue()
         self.kwargs = kwargs
 
+    def _load_model(self):
+        kwargs = self.kwargs
+        model_name = self.model_path
+        if self.backend == "onnx":
+            # CPU inference with ONNX Runtime, optionally int8 quantized
+            model = OnnxEncoder(self.model_path,
+                                cache_dir=os.path.join(self.persist_directory, 'onnx'),
+                                quantize=kwargs.get("quantize", False),
+                                num_threads=kwargs.get("num_threads", None))
+            # quantized embeddings differ slightly, never mix them with the others in the cache
+            model_name += "#onnx-int8" if kwargs.get("quantize", False) else "#onnx"
+        else:
+            from sentence_transformers import SentenceTransformer
+            try:
+                import torch
+                if torch.cuda.is_available():
+                    self.device = 'cuda'
+            except ImportError:
+                pass
+            model = SentenceTransformer(self.model_path, device=self.device)
+        if kwargs.get("embedding_cache", True):
+            # skip encoding of texts embedded before, e.g. repeated questions or auto_clean runs
+            model = CachedEncoder(model, EmbeddingCache(
+                os.path.join(self.persist_directory, 'embeddings.sqlite3'),
+                model_name=model_name,
+                max_items=kwargs.get("embedding_cache_size", 1000000)
+            ))
+        if kwargs.get("micro_batch", False):
+            # merge encode calls of concurrent queries into one forward pass
+            model = MicroBatcher(model,
+                                 max_batch_size=kwargs.get("micro_batch_size", 64),
+                                 max_wait_ms=kwargs.get("micro_batch_wait_ms", 5))
+        return model
+
+    def _load_collection(self) -> VectorStore:
+        kwargs = self.kwargs
+        name = '{}-{}'.format(self.vector_store, self.collection_name)
+        if self.hybrid:
+            self.lexical = BM25Index(os.path.join(self.persist_directory, 'lexical', name + '.sqlite3'),
+                                     k1=kwargs.get("bm25_k1", 1.5),
+                                     b=kwargs.get("bm25_b", 0.75))
+        if self.read_only:
+            # query workers share the snapshot published by the single writer process
+            return SnapshotCollection(os.path.join(self.persist_directory, 'snapshots'),
+                                      refresh_interval=kwargs.get("snapshot_refresh_interval", 5))
+        if self.vector_store == "hnsw":
+            collection = HnswStore(os.path.join(self.persist_directory, 'hnsw', self.collection_name),
+                                   M=kwargs.get("hnsw_M", 16),
+                                   ef_construction=kwargs.get("hnsw_ef_construction", 200),
+                                   ef=kwargs.get("hnsw_ef", 64))
+        elif self.vector_store == "chroma":
+            collection = ChromaStore(self.persist_directory, self.collection_name)
+        else:
+            raise ValueError('Unknown vector store {}, use chroma or hnsw'.format(self.vector_store))
+        print("Current has {} records".format(collection.count()))
+        self.id_index = IdIndex(os.path.join(self.persist_directory, 'ids', name + '.sqlite3'))
+        if self.lexical is not None:
+            threading.Thread(target=self._lexical_loop, name="dbms-lexical", daemon=True).start()
+        if kwargs.get("wal", True):
+            self.wal = WriteAheadLog(
+                os.path.join(self.persist_directory, 'wal', name + '.jsonl'),
+                fsync=kwargs.get("wal_fsync", False))
+            self._replay_wal(collection)
+            threading.Thread(target=self._compact_loop, name="dbms-compactor", daemon=True).start()
+        if self.id_index.count() != collection.count():
+            # first run with the index, or records written by an older version
+            self.id_index.rebuild(collection, self.content_hash)
+        if self.lexical is not None:
+            self._lexical_queue.join()
+            if self.lexical.count() != collection.count():
+                self.lexical.rebuild(collection)
+        atexit.register(self.flush)
+        return collection
+
+    def _replay_wal(self, collection: VectorStore):
+        """
+        Apply the writes logged before the last shutdown that never reached a persist
+        """
+        if os.path.getsize(self.wal.path):
+            collection.recover()
+        replayed = 0
+        for entry in self.wal.replay():
+            op = entry.pop("op")
+            existing = set(collection.get(ids=entry["ids"], include=["metadatas"])["ids"])
+            # entries persisted before the process stopped are already in the collection
+            keep = [i for i, id_ in enumerate(entry["ids"]) if (id_ in existing) != (op == "add")]
+            if not keep:
+                continue
+            entry = {key: [value[i] for i in keep] for key, value in entry.items() if value is not None}
+            try:
+                getattr(collection, op)(**entry)
+            except Exception as e:
+                # logged before a write the collection rejected
+                print("Skip write-ahead log entry failing to apply: {}".format(e))
+                continue
+            self._index_write(op, entry)
+            replayed += len(keep)
+        if replayed:
+            print("Replayed {} records from the write-ahead log".format(replayed))
+            collection.persist()
+        self.wal.truncate()
+
+    def _compact_loop(self):
+        interval = self.kwargs.get("compact_interval", 60)
+        while True:
+            self._compact_event.wait(interval)
+            self._compact_event.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print("Compaction failed: {}".format(e))
+
+    def _lexical_loop(self):
+        while True:
+            op, records = self._lexical_queue.get()
+            try:
+                if op == "delete":
+                    self.lexical.remove(records["ids"])
+                else:
+                    self.lexical.add(records["ids"], records["documents"])
+            except Exception as e:
+                print("Lexical indexing failed: {}".format(e))
+            finally:
+                self._lexical_queue.task_done()
+
+    @staticmethod
+    def content_hash(document: Text) -> Text:
+        """
+        Id of a document, sha1 of its text with unicode form, case and whitespace normalized
+        """
+        text = unicodedata.normalize("NFC", str(document)).lower()
+        return hashlib.sha1(" ".join(text.split()).encode("utf-8")).hexdigest()
+
+    def _index_write(self, op: Text, records: Dict):
+        if op == "delete":
+            self.id_index.remove(records["ids"])
+            if self.lexical is not None:
+                self._lexical_queue.put((op, {"ids": records["ids"]}))
+        elif records.get("documents") is not None:
+            self.id_index.add(records["ids"], [self.content_hash(document) for document in records["documents"]])
+            if self.lexical is not None:
+                # hybrid queries see the records once the lexical thread indexed them, usually milliseconds
+                self._lexical_queue.put((op, {"ids": records["ids"], "documents": records["documents"]}))
+
+    def _write(self, op: Text, records: Dict, persist: Optional[bool] = True):
+        """
+        Apply a write to the collection, logged to the write-ahead log first so a crash in between is replayed
+
+        Every write is logged when the log is on, persist only matters without it: the collection is then
+        persisted after the write, a write with persist=False is lost on a crash until the next persist.
+        """
+        if self.wal is not None:
+            self.wal.append(op, **records)
+        getattr(self.collection, op)(**records)
+        self._index_write(op, records)
+        self._dirty = True
+        if self.wal is None:
+            if persist:
+                self.collection.persist()
+                self._dirty = False
+        elif self.wal.rows >= self.kwargs.get("compact_rows", 1000):
+            self._compact_event.set()
+
+    def flush(self):
+        """
+        Persist the collection and empty the write-ahead log, called on exit
+
+        Returns:
+            None
+        """
+        if self._collection is None or self.read_only:
+            return
+        if self.lexical is not None:
+            self._lexical_queue.join()
+        with self._lock:
+            if not self._dirty:
+                return
+            self.collection.persist()
+            self._dirty = False
+            if self.wal is not None:
+                self.wal.truncate()
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._init_lock:
+                if self._model is None:
+                    self._model = self._load_model()
+        return self._model
+
+    @property
+    def collection(self) -> VectorStore:
+        if self._collection is None:
+            with self._init_lock:
+                if self._collection is None:
+                    self._collection = self._load_collection()
+        return self._collection
+
+    @property
+    def db(self):
+        """
+        ChromaDB client, None on the other stores
+        """
+        return getattr(self.collection, "client", None)
+
+    @property
+    def ready(self) -> bool:
+        """
+        Whether model and collection are loaded
+        """
+        return self._model is not None and self._collection is not None
+
+    def warm_up(self, background: Optional[bool] = True) -> Optional[threading.Thread]:
+        """
+        Load model and collection ahead of the first request
+
+        Args:
+            background: load in a daemon thread instead of blocking
+
+        Returns:
+            the loading thread when background is True
+        """
+        def load():
+            self.collection
+            self.model.encode(["warm up"])
+
+        if not background:
+            load()
+            return None
+        thread = threading.Thread(target=load, name="dbms-warm-up", daemon=True)
+        thread.start()
+        return thread
+
     def query(self, ques: Text, **kwargs) -> Optional[pd.DataFrame]:
         """
         Search answer for question from collection
 
+        Neighbours are fetched in rounds, widening n_results until enough of them pass the threshold, the
+        farthest one fetched is beyond the threshold or the collection is exhausted. The number of rounds is
+        in the attrs of the returned dataframe.
+
         Args:
             ques: question
+            limit: max number of answers, None for every answer within the threshold (default: 10)
+            offset: number of answers to skip, for pagination (default: 0)
+            threshold: max distance of an answer (default: threshold of DBMS)
+            where: metadata filter pushed down to the store, e.g. {"source": "google"}
+            include: fields among documents, metadatas, embeddings, distances (default: include kwarg of DBMS)
+            hybrid: also rank answers with BM25 and fuse both rankings (default: hybrid of DBMS)
 
         Returns:
             dataframe of answer
@@ -57,21 +347,173 @@ class DBMS:
         print("Query in collection has {} records".format(self.collection.count()))
         print("Get number of records to query: {}".format(kwargs.get("limit", 10)))
         limit = kwargs.get("limit", 10)
+        offset = kwargs.get("offset") or 0
+        include = kwargs.get("include") or self.kwargs.get("include", ["documents", "metadatas", "embeddings",
+                                                                       "distances"])
         input_em = self.model.encode([ques]).tolist()
         threshold = kwargs.get("threshold", self.threshold)
-        result = self.collection.query(
-            query_embeddings=input_em,
-            include=self.kwargs.get("include", ["documents", "metadatas", "embeddings", "distances"]),
-            n_results=limit if limit > 10 else 10
-        )
-        result = flatten_list(result)
-        result["distances"] = result["distances"][0][:len(result["ids"])]
-        result = pd.DataFrame(result)
-        result = result[result['distances'] < threshold]
+        result, rounds = self._range_search(input_em, threshold,
+                                            needed=None if limit is None else offset + limit,
+                                            include=include,
+                                            where=kwargs.get("where"))
+        print("Fetched {} answers in {} rounds".format(len(result), rounds))
+        if kwargs.get("hybrid", self.hybrid) and self.lexical is not None:
+            result = self._fuse_lexical(ques, input_em, result, threshold,
+                                        needed=None if limit is None else offset + limit,
+                                        include=include,
+                                        where=kwargs.get("where"))
+        result = result.iloc[offset:None if limit is None else offset + limit]
         if result.empty:
             return None
-        result = clean_data(self.kwargs.get("pattern", None), result)
-        return result.head(limit)
+        # only the returned page is cleaned
+        if 'documents' in result:
+            result = clean_data(self.kwargs.get("pattern", None), result.copy())
+        if 'distances' not in include:
+            result = result.drop(columns=['distances'])
+        result.attrs["rounds"] = rounds
+        return result
+
+    def _fuse_lexical(self, ques: Text, input_em: List, result: pd.DataFrame, threshold: float,
+                      needed: Optional[int], include: List[Text], where: Optional[Dict] = None) -> pd.DataFrame:
+        """
+        Add the best BM25 matches to the vector hits and order both by reciprocal rank fusion
+
+        Lexical matches keep their real distance to the question and may be beyond the threshold, short
+        lookup questions often match lexically while their embeddings are far apart. They still need a
+        BM25 score of lexical_min_score and a distance within lexical_threshold (default: twice the
+        threshold, at most 1), a single shared word must not turn an unrelated record into an answer.
+
+        Returns:
+            dataframe of answers, best fused score first
+        """
+        min_score = self.kwargs.get("lexical_min_score", 0)
+        lexical_ids = [id_ for id_, score in self.lexical.search(ques,
+                                                                 limit=max(needed if needed else 0, 10),
+                                                                 min_match=self.kwargs.get("lexical_min_match", 0.5))
+                       if score >= min_score]
+        if not lexical_ids:
+            return result
+        vector_ids = result['ids'].tolist() if 'ids' in result else []
+        vector_id_set = set(vector_ids)
+        missing = [id_ for id_ in lexical_ids if id_ not in vector_id_set]
+        if missing:
+            fields = [field for field in include if field not in ("distances", "embeddings")] + ["embeddings"]
+            get_kwargs = {"where": where} if where else {}
+            with self._lock:
+                extra = self.collection.get(ids=missing, include=fields, **get_kwargs)
+            extra = pd.DataFrame({key: value for key, value in extra.items() if isinstance(value, list)})
+            if not extra.empty:
+                embeddings = np.asarray(extra['embeddings'].tolist(), dtype=np.float32)
+                question = np.asarray(input_em[0], dtype=np.float32)
+                extra['distances'] = 1 - embeddings @ question / np.clip(
+                    np.linalg.norm(embeddings, axis=1) * np.linalg.norm(question), 1e-12, None)
+                extra = extra[extra['distances'] < self.kwargs.get("lexical_threshold", min(1.0, 2 * threshold))]
+                if 'embeddings' not in include:
+                    extra = extra.drop(columns=['embeddings'])
+                result = pd.concat([result, extra], ignore_index=True)
+        if 'ids' not in result:
+            return result
+        # ranks among the lexical matches kept
+        kept = set(result['ids'])
+        lexical_ids = [id_ for id_ in lexical_ids if id_ in kept]
+        scores = reciprocal_rank_fusion([vector_ids, lexical_ids], k=self.kwargs.get("rrf_k", 60))
+        order = result['ids'].map(scores).sort_values(ascending=False, kind="stable").index
+        return result.loc[order].reset_index(drop=True)
+
+    def _range_search(self, input_em: List, threshold: float, needed: Optional[int], include: List[Text],
+                      where: Optional[Dict] = None):
+        """
+        Neighbours within threshold, fetched in widening rounds
+
+        Args:
+            input_em: embedding of the question, as a one item list
+            threshold: max distance
+            needed: number of answers wanted, None for all of them
+            include: fields to read, distances are always read
+            where: metadata filter
+
+        Returns:
+            dataframe of answers sorted by distance and the number of rounds
+        """
+        include = list(dict.fromkeys(list(include) + ["distances"]))
+        query_kwargs = {"where": where} if where else {}
+        growth = self.kwargs.get("over_fetch_growth", 4)
+        max_results = self.kwargs.get("max_n_results", 10000)
+        n_results = max(needed if needed else 0, 10)
+        rounds = 0
+        while True:
+            rounds += 1
+            with self._lock:
+                result = self.collection.query(query_embeddings=input_em, include=include,
+                                               n_results=n_results, **query_kwargs)
+            # one query embedding, unwrap the lists of the first query
+            result = pd.DataFrame({key: value[0] for key, value in result.items()
+                                   if isinstance(value, list) and value and isinstance(value[0], list)})
+            if result.empty:
+                return result, rounds
+            hits = result[result['distances'] < threshold]
+            exhausted = len(result) < n_results or n_results >= max_results
+            # neighbours come sorted by distance, once the farthest fetched is out of range no later one is in
+            beyond = result['distances'].iloc[-1] >= threshold
+            if exhausted or beyond or (needed is not None and len(hits) >= needed):
+                return hits, rounds
+            n_results = min(n_results * growth, max_results)
+
+    def query_many(self,
+                   questions: List[Text],
+                   limit: Optional[int] = 10,
+                   threshold: Optional[Union[float, List[float]]] = None) -> Dict[Text, Optional[pd.DataFrame]]:
+        """
+        Search answers for many questions with one encode and one collection query
+
+        Args:
+            questions: list of questions
+            limit: max number of answers per question
+            threshold: one threshold for all questions or one threshold per question
+
+        Returns:
+            dict of question -> dataframe of answer (None if nothing passes the threshold)
+        """
+        threshold = self.threshold if threshold is None else threshold
+        if isinstance(threshold, (list, tuple)):
+            if len(threshold) != len(questions):
+                raise ValueError('Number of thresholds must match number of questions')
+            # keep the first threshold given for a repeated question
+            thresholds = {}
+            for ques, thres in zip(questions, threshold):
+                thresholds.setdefault(ques, thres)
+        else:
+            thresholds = {ques: threshold for ques in questions}
+        unique_questions = list(thresholds)
+        if not unique_questions:
+            return {}
+        print("Batch query {} questions in collection has {} records".format(len(unique_questions),
+                                                                           self.collection.count()))
+        input_em = self.model.encode(unique_questions).tolist()
+        with self._lock:
+            result = self.collection.query(
+                query_embeddings=input_em,
+                include=self.kwargs.get("include", ["documents", "metadatas", "embeddings", "distances"]),
+                n_results=limit if limit > 10 else 10
+            )
+        # one row per (question, hit), the result lists are nested per query embedding
+        n_hits = [len(ids) for ids in result["ids"]]
+        frame = {"question": np.repeat(unique_questions, n_hits)}
+        for key, value in result.items():
+            if isinstance(value, list) and len(value) == len(unique_questions) and isinstance(value[0], list):
+                frame[key] = list(itertools.chain.from_iterable(value))
+        frame = pd.DataFrame(frame)
+        if frame.empty:
+            return {ques: None for ques in questions}
+        row_thresholds = np.repeat([thresholds[ques] for ques in unique_questions], n_hits)
+        frame = frame[frame["distances"].to_numpy() < row_thresholds]
+        # rank inside each question and cut before cleaning so regexes only run on returned rows
+        frame = frame[frame.groupby("question", sort=False).cumcount() < limit]
+        if not frame.empty:
+            frame = clean_data(self.kwargs.get("pattern", None), frame.copy())
+        groups = {ques: group.drop(columns=["question"]).reset_index(drop=True)
+                  for ques, group in frame.groupby("question", sort=False)}
+        return {ques: groups.get(ques) for ques in questions}
 
     @staticmethod
     def _transform(data: pd.DataFrame) -> Dict:
@@ -88,16 +530,23 @@ class DBMS:
         data = flatten_list(data)
         return data
 
-    def insert(self, data: pd.DataFrame) -> pd.DataFrame:
+    def insert(self, data: pd.DataFrame, persist: Optional[bool] = True) -> pd.DataFrame:
         """
-        Insert data into collection
+        Insert data into collection, cleaned and encoded without holding the lock queries take
 
         Args:
             data: dataframe of data
+            persist: persist the collection after the insert when the write-ahead log is off, with the log
+                on every write is durable (default: True)
 
         Returns:
-            None
+            dataframe of the records, documents already stored keep their id and have no embeddings
         """
+        if self.read_only:
+            # the writer process encodes and stores it, see app/writer.py
+            self.spool.submit(data)
+            print("Queued {} records for the writer".format(len(data)))
+            return data
         print("Before insert, collection has {} records".format(self.collection.count()))
 
         # Remove ids column if exists
@@ -108,20 +557,10 @@ class DBMS:
         if 'distances' in data:
             data.drop(columns=['distances'], inplace=True)  # Use inplace parameter
 
-        # Remove duplicates
-        data.drop_duplicates(subset=["documents"], inplace=True)  # Use inplace parameter
-
-        # Add ids column
-        ids_range = range(self.collection.count(), self.collection.count() + len(data))
-        data['ids'] = list(ids_range)
-
-        # Convert ids column to string
-        data['ids'] = data['ids'].astype(str)
-
         # Finding the column for embedding
         column_4_embedding = None
         for col in data.columns:
-            if isinstance(data[col][0], str):
+            if isinstance(data[col].iloc[0], str):
                 column_4_embedding = col
                 break
 
@@ -132,46 +571,73 @@ class DBMS:
         # Clean data
         data = clean_data(self.kwargs.get("pattern", None), data)
 
-        embeddings = self.model.encode(data[column_4_embedding].tolist()).tolist()
-        data['embeddings'] = embeddings
+        # Content addressed ids, remove duplicates in data then documents already stored before encoding
+        column_4_hash = 'documents' if 'documents' in data else column_4_embedding
+        hashes = data[column_4_hash].map(self.content_hash)
+        data = data[~hashes.duplicated()].copy()
+        hashes = hashes[data.index]
 
         # Check if metadatas column exists
         if 'metadatas' not in data:
             data['metadatas'] = [{"source": ""}] * len(data)
-        self.db.persist()
-        self.collection.add(**self._transform(data))
-        self.db.persist()
+        new_data = data[~hashes.isin(self.id_index.find_hashes(hashes.tolist())).to_numpy()].copy()
+        # encoding is the slow part, queries run meanwhile, the lock is only held to store the records
+        if not new_data.empty:
+            new_data['embeddings'] = self.model.encode(new_data[column_4_embedding].tolist()).tolist()
+
+        with self._lock:
+            # another insert may have stored some of the documents while this one was encoding
+            stored = self.id_index.find_hashes(hashes.tolist())
+            is_new = ~hashes.isin(stored)
+            # a record updated since it was inserted keeps the hash of its old document as id
+            taken = self.id_index.find_ids(hashes[is_new].tolist())
+            data['ids'] = [stored[hash_] if hash_ in stored else
+                           hash_ if hash_ not in taken else '{}-{}'.format(hash_, uuid.uuid4().hex[:8])
+                           for hash_ in hashes]
+            data['embeddings'] = None
+            if stored:
+                print("Skip {} records already stored".format(len(data) - int(is_new.sum())))
+            new_data = new_data[is_new[new_data.index].to_numpy()].copy()
+            if not new_data.empty:
+                new_data['ids'] = data.loc[new_data.index, 'ids']
+                records = self._transform(new_data)
+                self._write("add", records, persist=persist)
+                embeddings = dict(zip(new_data.index, new_data['embeddings']))
+                data['embeddings'] = [embeddings.get(index) for index in data.index]
         print("Now collection has {} records".format(self.collection.count()))
         column_4_show = ['ids', 'documents', 'embeddings', 'metadatas']
         data = data[column_4_show]
         return data
 
-    def update(self, data: pd.DataFrame):
+    @synchronized
+    def update(self, data: pd.DataFrame, persist: Optional[bool] = True):
         """
         Update data into collection
 
         Args:
             data: dataframe of data
+            persist: persist the collection after the update when the write-ahead log is off (default: True)
 
         Returns:
             None
         """
         data = clean_data(self.kwargs.get("pattern", None), data)
-        self.collection.update(**self._transform(data))
+        records = self._transform(data)
+        self._write("update", records, persist=persist)
 
-    def delete(self, data: List):
+    @synchronized
+    def delete(self, data: List, persist: Optional[bool] = True):
         """
         Delete data into collection
 
         Args:
             data: list of ids to delete
+            persist: persist the collection after the delete when the write-ahead log is off (default: True)
 
         Returns:
             None
         """
-        self.collection.delete(
-            ids=data
-        )
+        self._write("delete", {"ids": list(data)}, persist=persist)
 
     def get(self, data: Optional[List], **kwargs) -> Optional[pd.DataFrame]:
         """
@@ -179,13 +645,17 @@ class DBMS:
 
         Args:
             data: list of ids to get
+            include: fields among documents, metadatas, embeddings (default: include kwarg of DBMS)
 
         Returns:
             dataframe of data
         """
+        include = kwargs.pop("include", None) or self.kwargs.get("include", ["documents", "metadatas", "embeddings"])
+        # distances only exist for a query
+        include = [key for key in include if key != "distances"]
         result = self.collection.get(
             ids=data,
-            include=self.kwargs.get("include", ["documents", "metadatas", "embeddings", "distances"]),
+            include=include,
             **kwargs
         )
         result = flatten_list(result)
@@ -199,44 +669,125 @@ class DBMS:
         Returns:
             None
         """
+        if not isinstance(self.collection, ChromaStore):
+            raise ValueError('Visualization needs the chroma vector store')
         from chromaviz import visualize_collection
-        visualize_collection(self.collection)
+        visualize_collection(self.collection.collection)
 
-    def auto_clean(self):
-        data = self.collection.get(include=self.kwargs.get("include",
-                                                           ["documents", "metadatas", "embeddings"]))
-        data = pd.DataFrame(data)
-        data = clean_data(self.kwargs.get("pattern", None), data)
-        # get ids where documents is duplicated or length of documents has length less than 3
-        data = data.drop_duplicates(["documents"])
-        data_remove = data[data['documents'].str.len() < 3]
-        data_remove = data_remove['ids'].tolist()
-        print("Remove {} records".format(len(data_remove)))
-        # only keep records that does not exist in data_remove
-        data = data[~data['ids'].isin(data_remove)]
-        print(data[["documents", "metadatas"]].head())
-        # update embeddings
-        data["embeddings"] = self.model.encode(data["documents"]).tolist()
-        data["documents"] = data["documents"].apply(lambda x: re.sub(r"^.*#\s+", "", x))
-        self.update(data)
-        # show data with documents and metadatas
-        print(data[["documents", "metadatas"]].head())
-        # remove data
-        if len(data_remove) > 0:
-            self.delete(data_remove)
-
-    def from_pandas(self, data: pd.DataFrame):
+    def auto_clean(self, batch_size: Optional[int] = 5000, workers: Optional[int] = None,
+                   resume: Optional[bool] = True, min_rows_for_pool: Optional[int] = 50000) -> Dict:
+        """
+        Clean every document of the collection again, page by page
+
+        Pages follow the sorted ids of the id index, so records removed or inserted during the run never
+        shift a page and no record is skipped or cleaned twice. Large collections are cleaned by a pool of
+        spawned worker processes, small ones and daemon processes such as the writer clean in process.
+        Only rows whose text changed are updated and only rows whose cleaned text differs from the stored
+        one are encoded again. Documents shorter than 3 characters after cleaning are removed, later
+        duplicates of a cleaned document are left untouched. Progress is checkpointed after every page
+        so an interrupted run resumes where it stopped.
+
+        Args:
+            batch_size: number of records per page
+            workers: number of cleaning processes (default: number of cpus)
+            resume: continue from the checkpoint of an interrupted run
+            min_rows_for_pool: collections smaller than this are cleaned without a process pool
+
+        Returns:
+            dict of clean statistics
+        """
+        if self.read_only:
+            raise ValueError('auto_clean needs a writable DBMS, query workers are read-only: run it in a '
+                             'process without COT_READ_ONLY, e.g. processing/clean_database.py')
+        checkpoint_path = os.path.join(self.persist_directory, 'auto_clean-{}-{}.json'.format(self.vector_store,
+                                                                                            self.collection_name))
+        stats = {"after": "", "pages": 0, "scanned": 0, "updated": 0, "re_embedded": 0, "removed": 0,
+                 "duplicates": 0}
+        if resume and os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as f:
+                checkpoint = json.load(f)
+            if "after" in checkpoint:
+                stats = checkpoint
+                print("Resume auto clean after record {}".format(stats["after"]))
+        cleaner = TextCleaner.from_rules(DEFAULT_RULES + (self.kwargs.get("pattern", None) or []))
+        # digests of cleaned documents seen in this run, lost on resume which only means fewer skipped duplicates
+        seen = set()
+        workers = workers if workers else multiprocessing.cpu_count()
+        use_pool = (workers > 1 and self.collection.count() >= min_rows_for_pool
+                    and not multiprocessing.current_process().daemon)
+        # spawned, forking a process running model or server threads can deadlock the children
+        pool = multiprocessing.get_context("spawn").Pool(workers) if use_pool else None
+        try:
+            while True:
+                ids = self.id_index.page(after=stats["after"], limit=batch_size)
+                if not ids:
+                    break
+                page = self.collection.get(ids=ids, include=["documents"])
+                data = pd.DataFrame({"ids": page["ids"], "documents": page["documents"]})
+                texts = data["documents"].tolist()
+                cleaned = pd.Series(pool.map(cleaner, texts, chunksize=max(1, len(texts) // (workers * 4)))
+                                    if pool else [cleaner(text) for text in texts], index=data.index)
+                digests = cleaned.map(lambda x: hashlib.md5(x.encode('utf-8')).digest())
+                removed = cleaned.str.len() < 3
+                duplicated = ~removed & (digests.isin(seen) | digests.where(~removed).duplicated())
+                kept = ~removed & ~duplicated
+                seen.update(digests[kept])
+                final = cleaned.str.replace(r"^.*#\s+", "", regex=True)
+                # the embedding is computed on the cleaned text before the question prefix is stripped
+                re_embed = kept & (cleaned != data["documents"])
+                changed = kept & (final != data["documents"])
+                with self._lock:
+                    if re_embed.any():
+                        self._update_records(data["ids"][re_embed].tolist(), final[re_embed].tolist(),
+                                             self.model.encode(cleaned[re_embed].tolist()).tolist())
+                    only_text = changed & ~re_embed
+                    if only_text.any():
+                        self._update_records(data["ids"][only_text].tolist(), final[only_text].tolist())
+                    if removed.any():
+                        self.delete(data["ids"][removed].tolist())
+                    stats["after"] = ids[-1]
+                    stats["pages"] += 1
+                    stats["scanned"] += len(data)
+                    stats["updated"] += int(changed.sum())
+                    stats["re_embedded"] += int(re_embed.sum())
+                    stats["removed"] += int(removed.sum())
+                    stats["duplicates"] += int(duplicated.sum())
+                    with open(checkpoint_path + ".tmp", "w") as f:
+                        json.dump(stats, f)
+                    os.replace(checkpoint_path + ".tmp", checkpoint_path)
+                print("Auto clean: {scanned} scanned, {updated} updated, {re_embedded} re-embedded, "
+                      "{removed} removed".format(**stats))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        self.flush()
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        return stats
+
+    def _update_records(self, ids: List[Text], documents: List[Text], embeddings: Optional[List] = None):
+        records = {"ids": ids, "documents": documents}
+        if embeddings is not None:
+            records["embeddings"] = embeddings
+        self._write("update", records)
+
+    def from_pandas(self, data: pd.DataFrame, persist: Optional[bool] = True):
         """
         Insert data from pandas dataframe
 
         Args:
             data: dataframe of data
+            persist: persist the collection after the insert when the write-ahead log is off (default: True)
 
         Returns:
-            None
+            dataframe of the records, see insert, None if there was nothing to insert
         """
         data = data.dropna()
         data = data.drop_duplicates()
+        data = data.reset_index(drop=True)
+        if data.empty:
+            return None
         if "documents" not in data.columns:
             for col in data.columns:
                 if isinstance(data[col][0], str):
@@ -245,7 +796,90 @@ class DBMS:
                     data = data.rename(columns={col: 'metadatas'})
         if 'metadatas' not in data.columns:
             data['metadatas'] = [{"source": ""}] * len(data)
-        self.insert(data)
+        return self.insert(data, persist=persist)
+
+    @staticmethod
+    def _merge_columns(data: pd.DataFrame, merge_columns: Optional[List]) -> pd.DataFrame:
+        """
+        Prefix the last column of merge_columns with the others, separated by " # "
+
+        Args:
+            data: dataframe of data
+            merge_columns: list of columns to merge, the last one is the target
+
+        Returns:
+            dataframe of data
+        """
+        if merge_columns:
+            target = merge_columns[-1]
+            for col in merge_columns[:-1]:
+                data[target] = data[col] + " # " + data[target]
+        return data
+
+    @staticmethod
+    def read_chunks(path: Text, data_type: Optional[Text] = None, chunk_size: Optional[int] = 10000):
+        """
+        Read a jsonl or csv file lazily, chunk by chunk
+
+        Args:
+            path: path to file
+            data_type: 'jsonl' or 'csv' (default: guessed from the file extension)
+            chunk_size: number of rows per chunk
+
+        Returns:
+            iterator of dataframes
+        """
+        data_type = data_type if data_type else path.rsplit('.', 1)[-1]
+        if data_type == 'jsonl':
+            return pd.read_json(path, orient='records', lines=True, encoding='utf-8', chunksize=chunk_size)
+        if data_type == 'csv':
+            return pd.read_csv(path, encoding='utf-8', chunksize=chunk_size)
+        raise ValueError('Streaming only supports jsonl and csv files, got {}'.format(data_type))
+
+    def stream_insert(self, chunks, transform=None, persist_every: Optional[int] = 10) -> Dict:
+        """
+        Insert data chunk by chunk so peak memory only depends on the chunk size
+
+        Duplicates are found by insert through the content hashes of the id index on disk, nothing grows
+        in memory with the number of rows read.
+
+        Args:
+            chunks: iterator of dataframes
+            transform: function applied to every chunk before inserting
+            persist_every: persist the collection every n chunks when the write-ahead log is off (always
+                persisted at the end)
+
+        Returns:
+            dict of ingest statistics
+        """
+        stats = {"chunks": 0, "rows": 0, "inserted": 0, "duplicates": 0, "seconds": 0.0}
+        start_time = time.time()
+        for chunk in chunks:
+            stats["chunks"] += 1
+            stats["rows"] += len(chunk)
+            chunk = transform(chunk) if transform else chunk
+            chunk = chunk.dropna().reset_index(drop=True)
+            if chunk.empty:
+                continue
+            persist = persist_every is not None and stats["chunks"] % persist_every == 0
+            if 'documents' in chunk.columns:
+                result = self.insert(chunk, persist=persist)
+            else:
+                result = self.from_pandas(chunk, persist=persist)
+            # documents already stored, by this run or before, come back without embeddings
+            inserted = 0 if result is None else (int(result['embeddings'].notna().sum())
+                                                 if 'embeddings' in result else len(result))
+            stats["inserted"] += inserted
+            stats["duplicates"] += len(chunk) - inserted
+            elapsed = time.time() - start_time
+            print("Chunk {}: {} rows read, {} inserted, {:.1f} rows/sec".format(
+                stats["chunks"], stats["rows"], stats["inserted"], stats["rows"] / elapsed if elapsed else 0))
+        self.flush()
+        stats["seconds"] = time.time() - start_time
+        stats["rows_per_sec"] = stats["rows"] / stats["seconds"] if stats["seconds"] else 0
+        print("Stream insert done: {rows} rows, {inserted} inserted, {duplicates} duplicates "
+              "in {seconds:.1f}s ({rows_per_sec:.1f} rows/sec)".format(**stats))
+        return stats
 
     def from_json(self, path: Text, cols: List = None, **kwargs):
         """
@@ -254,21 +888,28 @@ class DBMS:
         Args:
             path: path to json file
             cols: list of columns to read
+            chunk_size: stream a jsonl file in chunks of this many rows instead of loading it at once
+            persist_every: persist every n chunks when streaming (default: 10)
 
         Returns:
             None
         """
+        if kwargs.get("chunk_size"):
+            def transform(chunk):
+                chunk = self._merge_columns(chunk, kwargs.get("merge_columns"))
+                return chunk[cols] if cols else chunk
+            self.stream_insert(self.read_chunks(path, chunk_size=kwargs.get("chunk_size")),
+                               transform=transform,
+                               persist_every=kwargs.get("persist_every", 10))
+            print(f'Load {self.collection.count()} data successfully')
+            return
+
         data = pd.read_json(path,
                             lines=True if path.endswith('.jsonl') else False,
                             encoding='utf-8')
 
         if not data.empty:
-            if kwargs.get("merge_columns"):
-                columns_to_merge = kwargs.get("merge_columns")
-                target = columns_to_merge[-1]
-                columns_to_merge = columns_to_merge[:-1]
-                for col in columns_to_merge:
-                    data[target] = data[col] + " # " + data[target]
+            data = self._merge_columns(data, kwargs.get("merge_columns"))
             data = data[cols] if cols else data
             print(data.head())
             self.from_pandas(data)
@@ -0,0 +1,177 @@
+import os
+import time
+import numpy as np
+from typing import Text, Optional, List, Dict
+
+
+class OnnxEncoder:
+    """
+    Sentence embeddings with ONNX Runtime on CPU, drop-in for SentenceTransformer.encode
+
+    The transformer is exported to ONNX on first use (optionally int8 dynamically quantized) and
+    sentence embeddings are mean pooled over the attention mask, like the paraphrase-multilingual
+    SentenceTransformer models do.
+
+    Attributes:
+        model_path (Text): huggingface model name or path
+        onnx_path (Text): path to the exported (and quantized) ONNX model
+        max_seq_length (int): max number of tokens per text
+        batch_size (int): number of texts per forward pass
+    """
+
+    def __init__(self,
+                 model_path: Text,
+                 cache_dir: Text,
+                 quantize: Optional[bool] = False,
+                 max_seq_length: Optional[int] = 128,
+                 batch_size: Optional[int] = 32,
+                 num_threads: Optional[int] = None):
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        self.model_path = model_path
+        self.max_seq_length = max_seq_length
+        self.batch_size = batch_size
+        export_dir = os.path.join(cache_dir, model_path.replace("/", "__"))
+        self.onnx_path = os.path.join(export_dir, "model-int8.onnx" if quantize else "model.onnx")
+        if not os.path.exists(self.onnx_path):
+            self.export(model_path, export_dir, quantize=quantize)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(self.onnx_path, options, providers=["CPUExecutionProvider"])
+        self._input_names = {item.name for item in self.session.get_inputs()}
+
+    @staticmethod
+    def export(model_path: Text, export_dir: Text, quantize: Optional[bool] = False) -> Text:
+        """
+        Export the transformer of model_path to ONNX
+
+        Args:
+            model_path: huggingface model name or path
+            export_dir: directory to write model.onnx (and model-int8.onnx) to
+            quantize: also write an int8 dynamically quantized copy
+
+        Returns:
+            path to the model to load
+        """
+        import torch
+        from transformers import AutoModel, AutoTokenizer
+
+        os.makedirs(export_dir, exist_ok=True)
+        onnx_path = os.path.join(export_dir, "model.onnx")
+        if not os.path.exists(onnx_path):
+            tokenizer = AutoTokenizer.from_pretrained(model_path)
+            model = AutoModel.from_pretrained(model_path)
+            model.eval()
+            dummy = tokenizer(["xin chào"], return_tensors="pt")
+            with torch.no_grad():
+                torch.onnx.export(
+                    model,
+                    (dummy["input_ids"], dummy["attention_mask"]),
+                    onnx_path,
+                    input_names=["input_ids", "attention_mask"],
+                    output_names=["last_hidden_state"],
+                    dynamic_axes={
+                        "input_ids": {0: "batch", 1: "sequence"},
+                        "attention_mask": {0: "batch", 1: "sequence"},
+                        "last_hidden_state": {0: "batch", 1: "sequence"},
+                    },
+                    opset_version=14,
+                )
+        if not quantize:
+            return onnx_path
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantized_path = os.path.join(export_dir, "model-int8.onnx")
+        if not os.path.exists(quantized_path):
+            quantize_dynamic(onnx_path, quantized_path, weight_type=QuantType.QInt8)
+        return quantized_path
+
+    def encode(self, sentences, batch_size: Optional[int] = None, **kwargs) -> np.ndarray:
+        """
+        Encode sentences
+
+        Args:
+            sentences: text or list of texts
+            batch_size: number of texts per forward pass
+
+        Returns:
+            numpy array of float32 embeddings
+        """
+        single = isinstance(sentences, str)
+        sentences = [sentences] if single else list(sentences)
+        batch_size = batch_size if batch_size else self.batch_size
+        embeddings = []
+        for start in range(0, len(sentences), batch_size):
+            features = self.tokenizer(sentences[start:start + batch_size],
+                                      padding=True,
+                                      truncation=True,
+                                      max_length=self.max_seq_length,
+                                      return_tensors="np")
+            inputs = {name: value.astype(np.int64) for name, value in features.items() if name in self._input_names}
+            token_embeddings = self.session.run(None, inputs)[0]
+            mask = features["attention_mask"][..., None].astype(np.float32)
+            pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            embeddings.append(pooled.astype(np.float32))
+        if not embeddings:
+            return np.zeros((0, self.get_sentence_embedding_dimension()), dtype=np.float32)
+        embeddings = np.concatenate(embeddings)
+        return embeddings[0] if single else embeddings
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.session.get_outputs()[0].shape[-1]
+
+
+def parity_check(reference, candidate, sentences: List[Text]) -> Dict:
+    """
+    Compare embeddings of two encoders on the same sentences
+
+    Args:
+        reference: encoder taken as ground truth, e.g. SentenceTransformer
+        candidate: encoder to check, e.g. OnnxEncoder
+        sentences: sentences to encode
+
+    Returns:
+        dict with max absolute difference and min/mean cosine similarity
+    """
+    expected = np.asarray(reference.encode(sentences), dtype=np.float32)
+    actual = np.asarray(candidate.encode(sentences), dtype=np.float32)
+    cosine = (expected * actual).sum(axis=1) / (np.linalg.norm(expected, axis=1) * np.linalg.norm(actual, axis=1))
+    return {
+        "max_abs_diff": float(np.abs(expected - actual).max()),
+        "min_cosine": float(cosine.min()),
+        "mean_cosine": float(cosine.mean()),
+    }
+
+
+def benchmark(encoders: Dict, sentences: List[Text], repeat: Optional[int] = 3) -> Dict:
+    """
+    Measure single-text latency and batch throughput of encoders
+
+    Args:
+        encoders: dict of name -> encoder
+        sentences: sentences to encode
+        repeat: number of runs, the best one is kept
+
+    Returns:
+        dict of name -> {"latency_ms": ..., "sentences_per_sec": ...}
+    """
+    result = {}
+    for name, encoder in encoders.items():
+        # warm up so lazy initialisation is not measured
+        encoder.encode(sentences[:1])
+        latency = min(_timed(encoder.encode, [sentences[0]]) for _ in range(repeat * 10))
+        throughput = min(_timed(encoder.encode, sentences) for _ in range(repeat))
+        result[name] = {
+            "latency_ms": latency * 1000,
+            "sentences_per_sec": len(sentences) / throughput,
+        }
+    return result
+
+
+def _timed(func, *args) -> float:
+    start_time = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start_time
@@ -0,0 +1,171 @@
+import os
+import re
+import math
+import sqlite3
+import threading
+from collections import Counter
+from typing import Text, Optional, List, Dict, Tuple
+
+
+def tokenize(text: Text) -> List[Text]:
+    """
+    Vietnamese word tokens, lowercased, multi-syllable words joined by underscores
+
+    Args:
+        text: text to tokenize
+
+    Returns:
+        list of tokens, punctuation removed
+    """
+    try:
+        from underthesea import word_tokenize
+        words = word_tokenize(text)
+    except ImportError:
+        # syllables only, still useful for exact lookups
+        words = re.findall(r'\w+', text)
+    return [word.lower().replace(' ', '_') for word in words if re.search(r'\w', word)]
+
+
+class BM25Index:
+    """
+    Inverted index with BM25 scoring stored in SQLite, the lexical sidecar of a vector store
+
+    Attributes:
+        path (Text): path to SQLite file
+        k1 (float): term frequency saturation
+        b (float): document length normalization
+        max_df_ratio (float): query terms found in more than this share of documents are ignored, they
+            behave like stop words ("là", "gì", ...) and have the longest posting lists, unless every query
+            term found in the collection is that common
+    """
+
+    def __init__(self,
+                 path: Text,
+                 k1: Optional[float] = 1.5,
+                 b: Optional[float] = 0.75,
+                 max_df_ratio: Optional[float] = 0.3):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.max_df_ratio = max_df_ratio
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS docs (id TEXT PRIMARY KEY, length INTEGER)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS postings "
+                           "(term TEXT, id TEXT, tf INTEGER, PRIMARY KEY (term, id)) WITHOUT ROWID")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS postings_id ON postings (id)")
+        self._conn.commit()
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    def _remove(self, ids: List[Text]):
+        self._conn.executemany("DELETE FROM postings WHERE id = ?", [(id_,) for id_ in ids])
+        self._conn.executemany("DELETE FROM docs WHERE id = ?", [(id_,) for id_ in ids])
+
+    def add(self, ids: List[Text], documents: List[Text]):
+        """
+        Index documents, replacing the ones already indexed under the same ids
+
+        Args:
+            ids: list of ids
+            documents: list of documents
+        """
+        tokens = [Counter(tokenize(document if document else "")) for document in documents]
+        with self._lock:
+            with self._conn:
+                self._remove(ids)
+                self._conn.executemany("INSERT INTO docs (id, length) VALUES (?, ?)",
+                                       [(id_, sum(counts.values())) for id_, counts in zip(ids, tokens)])
+                self._conn.executemany("INSERT INTO postings (term, id, tf) VALUES (?, ?, ?)",
+                                       [(term, id_, tf) for id_, counts in zip(ids, tokens)
+                                        for term, tf in counts.items()])
+
+    update = add
+
+    def remove(self, ids: List[Text]):
+        with self._lock:
+            with self._conn:
+                self._remove(ids)
+
+    def search(self, query: Text, limit: Optional[int] = 10,
+               min_match: Optional[float] = 0.5) -> List[Tuple[Text, float]]:
+        """
+        Best documents for a query
+
+        Args:
+            query: query text
+            limit: max number of documents
+            min_match: share of the informative query terms found in the collection a document must contain
+
+        Returns:
+            list of (id, score), best first
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return []
+        with self._lock:
+            n_docs, total_length = self._conn.execute("SELECT COUNT(*), SUM(length) FROM docs").fetchone()
+            if not n_docs:
+                return []
+            average_length = total_length / n_docs
+            dfs = dict(self._conn.execute("SELECT term, COUNT(*) FROM postings WHERE term IN ({}) GROUP BY term".format(
+                ",".join("?" * len(terms))), terms).fetchall())
+            # terms found in no document can match nothing, they neither score nor count in the share to match
+            present = [term for term in terms if dfs.get(term, 0)]
+            informative = [term for term in present if dfs[term] <= self.max_df_ratio * n_docs]
+            if not informative:
+                # only common terms, e.g. a one word question or a small collection, score with them
+                informative = present
+            scores, matches = Counter(), Counter()
+            for term in informative:
+                df = dfs[term]
+                idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+                for id_, tf, length in self._conn.execute(
+                        "SELECT p.id, p.tf, d.length FROM postings p JOIN docs d ON d.id = p.id WHERE p.term = ?",
+                        (term,)):
+                    scores[id_] += idf * tf * (self.k1 + 1) / (
+                            tf + self.k1 * (1 - self.b + self.b * length / average_length))
+                    matches[id_] += 1
+        needed = math.ceil(min_match * len(informative))
+        return [(id_, score) for id_, score in scores.most_common() if matches[id_] >= needed][:limit]
+
+    def rebuild(self, store, batch_size: Optional[int] = 5000):
+        """
+        Index every document of a store again
+
+        Args:
+            store: VectorStore to read from
+            batch_size: number of records read at once
+        """
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM postings")
+                self._conn.execute("DELETE FROM docs")
+        total = store.count()
+        for offset in range(0, total, batch_size):
+            data = store.get(include=["documents"], limit=batch_size, offset=offset)
+            self.add(data["ids"], data["documents"])
+        print("Indexed terms of {} records".format(total))
+
+
+def reciprocal_rank_fusion(rankings: List[List[Text]], k: Optional[int] = 60) -> Dict[Text, float]:
+    """
+    Fuse rankings, every list adds 1 / (k + rank) to the score of its ids
+
+    Args:
+        rankings: lists of ids, best first
+        k: damping constant, 60 in the original paper
+
+    Returns:
+        dict of id -> fused score
+    """
+    scores = Counter()
+    for ranking in rankings:
+        for rank, id_ in enumerate(ranking, start=1):
+            scores[id_] += 1 / (k + rank)
+    return dict(scores)
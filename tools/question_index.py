@@ -0,0 +1,128 @@
+import re
+import threading
+from rapidfuzz import process, fuzz
+from typing import Text, Optional, List, Dict, Tuple
+
+from tools.caching import AnswerCache
+
+# numbers and symbols, e.g. "1945", "2+2", "c++": a question differing in one of them is another question
+PATTERN_EXACT_TOKENS = re.compile(r"\d+(?:[.,]\d+)*|[^\w\s,;:'\"()…]+")
+
+
+def exact_tokens(question: Text) -> Tuple[Text, ...]:
+    """
+    Numbers and symbols of a normalized question, in order, they must match exactly
+
+    Args:
+        question: normalized question
+
+    Returns:
+        tuple of tokens
+    """
+    return tuple(PATTERN_EXACT_TOKENS.findall(question))
+
+
+class QuestionIndex:
+    """
+    In-memory index of the questions answers were stored for, the cheap first stage of question matching
+
+    Questions are normalized like the answer cache keys and compared with rapidfuzz, which scans a plain
+    list of strings in C, so a lookup costs milliseconds where an embedding query or a Google search
+    costs much more. Candidates are only proposed here, the search engine confirms them with embeddings.
+    A candidate must have the same numbers and symbols as the question, see exact_tokens, fuzzy scores
+    and embeddings barely see the difference between "năm 1945" and "năm 1954".
+
+    Attributes:
+        min_score (float): min rapidfuzz token sort ratio (0-100) of a candidate
+        max_candidates (int): max number of candidates returned by a lookup
+        loaded (bool): questions stored in the collection were read
+        version (Text): snapshot version loaded, None for a writable store
+    """
+
+    def __init__(self, min_score: Optional[float] = 80, max_candidates: Optional[int] = 5):
+        self.min_score = min_score
+        self.max_candidates = max_candidates
+        self.loaded = False
+        self.version = None
+        self._lock = threading.Lock()
+        self._questions: List[Text] = []
+        self._ids: List[List[Text]] = []
+        self._exact: List[Tuple[Text, ...]] = []
+        self._positions: Dict[Text, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._questions)
+
+    def add(self, question: Text, ids: List[Text]):
+        """
+        Remember the records answering a question
+
+        Args:
+            question: question as asked
+            ids: ids of the answer records
+        """
+        key = AnswerCache.normalize(question)
+        if not key:
+            return
+        with self._lock:
+            position = self._positions.get(key)
+            if position is None:
+                self._positions[key] = len(self._questions)
+                self._questions.append(key)
+                self._exact.append(exact_tokens(key))
+                self._ids.append(list(dict.fromkeys(ids)))
+            else:
+                self._ids[position] = list(dict.fromkeys(self._ids[position] + list(ids)))
+
+    def load(self, store, batch_size: Optional[int] = 5000):
+        """
+        Read the questions kept in the "question" metadata of a store
+
+        Args:
+            store: VectorStore to read from
+            batch_size: number of records read at once
+        """
+        total = store.count()
+        version = getattr(store, "version", None)
+        for offset in range(0, total, batch_size):
+            self.add_records(store.get(include=["metadatas"], limit=batch_size, offset=offset))
+        self.version = version
+        self.loaded = True
+        print("Indexed {} questions of {} records".format(len(self), total))
+
+    def add_records(self, data: Dict, version: Optional[Text] = None):
+        """
+        Remember the questions of records, e.g. the ones added to a snapshot since the version loaded
+
+        Args:
+            data: dict of ids and metadatas, as returned by a store get
+            version: snapshot version the index is up to date with once they are added
+        """
+        for id_, metadata in zip(data["ids"], data["metadatas"]):
+            if metadata and metadata.get("question"):
+                self.add(metadata["question"], [id_])
+        if version is not None:
+            self.version = version
+
+    def candidates(self, question: Text) -> List[Tuple[Text, List[Text], float]]:
+        """
+        Stored questions close to a question
+
+        Args:
+            question: question as asked
+
+        Returns:
+            list of (normalized question, answer ids, score), best first
+        """
+        key = AnswerCache.normalize(question)
+        if not key:
+            return []
+        exact = exact_tokens(key)
+        with self._lock:
+            questions, ids = self._questions, self._ids
+            # scan more than needed, some candidates drop out on their numbers or symbols
+            matches = process.extract(key, questions, scorer=fuzz.token_sort_ratio, processor=None,
+                                      limit=self.max_candidates * 4, score_cutoff=self.min_score)
+            matches = [(match, list(ids[position]), score) for match, score, position in matches
+                       if self._exact[position] == exact]
+            return matches[:self.max_candidates]
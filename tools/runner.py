@@ -0,0 +1,84 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, Iterable, List, Optional, Text, Tuple
+
+from tools.search import SearchEngine
+from tools.components.APIs.libs.rate_limit import HOST_LIMITER
+
+
+class BatchRunner:
+    """
+    Answer many questions concurrently with a bounded thread pool around SearchEngine
+
+    Attributes:
+        search_engine (SearchEngine): engine answering the questions
+        concurrency (int): number of questions processed at the same time
+        checkpoint_every (int): call on_checkpoint every n finished questions
+        on_checkpoint (Callable): called with the ordered list of finished results
+    """
+
+    def __init__(self,
+                 search_engine: SearchEngine,
+                 concurrency: Optional[int] = 8,
+                 rate_limits: Optional[Dict[Text, float]] = None,
+                 checkpoint_every: Optional[int] = 10,
+                 on_checkpoint: Optional[Callable[[List[Tuple]], Any]] = None,
+                 process: Optional[Callable[[Any, Text], Tuple]] = None):
+        """
+        Answer many questions concurrently
+
+        Args:
+            search_engine: engine answering the questions
+            concurrency: number of worker threads (default: 8)
+            rate_limits: max requests per second by host, e.g. {"google.com": 1}
+            checkpoint_every: call on_checkpoint every n finished questions (default: 10)
+            on_checkpoint: called with the ordered list of finished results
+            process: function (index, question) -> result tuple, defaults to SearchEngine.search
+
+        Return:
+            None
+        """
+        self.search_engine = search_engine
+        self.concurrency = concurrency
+        self.checkpoint_every = checkpoint_every
+        self.on_checkpoint = on_checkpoint
+        self.process = process if process else self._search
+        for host, rate in (rate_limits or {}).items():
+            HOST_LIMITER.set_rate(host, rate)
+
+    def _search(self, index: Any, ques: Text) -> Tuple:
+        start_time = time.time()
+        result = self.search_engine.search(ques)
+        return index, result, time.time() - start_time
+
+    def _safe_process(self, index: Any, ques: Text) -> Tuple:
+        try:
+            return self.process(index, ques)
+        except Exception as e:
+            print(e)
+            return e
+
+    def run(self, questions: Iterable[Tuple[Any, Text]]) -> List[Tuple]:
+        """
+        Process questions concurrently
+
+        Args:
+            questions: iterable of (index, question)
+
+        Returns:
+            list of results in the same order as questions, an exception is returned in place of a failed result
+        """
+        questions = list(questions)
+        results = [None] * len(questions)
+        done = 0
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {executor.submit(self._safe_process, index, ques): position
+                       for position, (index, ques) in enumerate(questions)}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                done += 1
+                if self.on_checkpoint and self.checkpoint_every and done % self.checkpoint_every == 0:
+                    self.on_checkpoint([res for res in results if res is not None])
+        if self.on_checkpoint:
+            self.on_checkpoint(results)
+        return results
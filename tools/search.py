@@ -1,9 +1,12 @@
+import os
+import threading
+import numpy as np
 import pandas as pd
-from typing import Text, Optional
+from collections import Counter
+from typing import Text, Optional, Dict
 
 from tools.dbms import DBMS
-from tools.components.APIs.google import Google
-from tools.components.LLMs.edge_gpt import EdgeBot
+from tools.caching import AnswerCache
 
 
 class SearchEngine:
@@ -11,7 +14,11 @@ class SearchEngine:
     Search question in existing data or ask bot to answer question
 
     Attributes:
-        bot (EdgeBot): EdgeGPT Chatbot
+        google (Google): Google search engine, created on first use
+        bot (EdgeBot): EdgeGPT Chatbot, created on first use
+        cache (AnswerCache): answers of questions asked before, None if disabled
+        questions (QuestionIndex): questions answers were stored for, loaded on first use
+        counters (Counter): number of answers served by each stage of the pipeline
     """
 
     def __init__(self,
@@ -27,14 +34,163 @@ class SearchEngine:
             model_path: path to SentenceTransformer model
             collection_name: name of collection to store data (default: search)
             threshold: threshold to filter data (default: 0.8)
+            answer_cache: cache answers by normalized question (default: True)
+            cache_ttl: seconds a cached answer stays valid (default: 7 days)
+            cache_size: max number of answers kept in memory (default: 10000)
+            question_min_score: min rapidfuzz score of a stored question to rerank (default: 80)
+            question_candidates: max number of stored questions to rerank (default: 5)
+            question_threshold: max cosine distance of a stored question answered locally (default: 0.1)
+            google_results: number of Google results fetched and scored per question (default: 3)
+            google_fetch_timeout: seconds given to fetching the content of those results (default: 15)
 
         Return:
             None
         """
-        self.google = Google()
         self.use_bot = use_bot
-        self.bot = EdgeBot(**kwargs)
+        self.kwargs = kwargs
+        self._google = None
+        self._bot = None
+        self._questions = None
+        self._questions_loader = None
+        self._init_lock = threading.Lock()
         self.db = DBMS(model_path=model_path, threshold=threshold, collection_name=collection_name, **kwargs)
+        self.cache = None
+        if kwargs.get("answer_cache", True):
+            self.cache = AnswerCache(path=os.path.join(self.db.persist_directory, 'answers.sqlite3'),
+                                     ttl=kwargs.get("cache_ttl", 7 * 24 * 3600),
+                                     max_memory_items=kwargs.get("cache_size", 10000))
+        self.counters = Counter()
+        self._counters_lock = threading.Lock()
+
+    @property
+    def google(self):
+        if self._google is None:
+            with self._init_lock:
+                if self._google is None:
+                    from tools.components.APIs.google import Google
+                    self._google = Google(num_results=self.kwargs.get("google_results", 3),
+                                          fetch_timeout=self.kwargs.get("google_fetch_timeout", 15))
+        return self._google
+
+    @property
+    def bot(self):
+        if self._bot is None:
+            with self._init_lock:
+                if self._bot is None:
+                    from tools.components.LLMs.edge_gpt import EdgeBot
+                    self._bot = EdgeBot(**self.kwargs)
+        return self._bot
+
+    def _stale_questions(self) -> bool:
+        if self._questions is None:
+            return True
+        collection = self.db.collection
+        if hasattr(collection, "refresh"):
+            # read-only worker, questions asked by every worker come back with each new snapshot
+            collection.refresh()
+            return getattr(collection, "version", None) != self._questions.version
+        return False
+
+    def _load_questions(self):
+        from tools.question_index import QuestionIndex
+        questions = QuestionIndex(min_score=self.kwargs.get("question_min_score", 80),
+                                  max_candidates=self.kwargs.get("question_candidates", 5))
+        questions.load(self.db.collection)
+        return questions
+
+    def _reload_questions(self):
+        try:
+            questions = self._load_questions()
+        except Exception as e:
+            print("Question index reload failed: {}".format(e))
+            return
+        with self._init_lock:
+            self._questions = questions
+
+    @property
+    def questions(self):
+        if self._stale_questions():
+            with self._init_lock:
+                if self._stale_questions():
+                    collection = self.db.collection
+                    added = collection.added_since(self._questions.version, include=["metadatas"]) \
+                        if self._questions is not None else None
+                    if self._questions is None:
+                        self._questions = self._load_questions()
+                    elif added is not None:
+                        # the questions of the new snapshot segments only
+                        self._questions.add_records(added, collection.version)
+                    elif self._questions_loader is None or not self._questions_loader.is_alive():
+                        # the snapshot was exported again, the current index answers while it is rebuilt
+                        self._questions_loader = threading.Thread(target=self._reload_questions,
+                                                                  name="question-index-loader", daemon=True)
+                        self._questions_loader.start()
+        return self._questions
+
+    def _count(self, key: Text):
+        with self._counters_lock:
+            self.counters[key] += 1
+
+    def stats(self) -> Dict:
+        """
+        Number of answers served by each stage, the local ones are network calls avoided
+
+        Returns:
+            dict of counter -> value
+        """
+        with self._counters_lock:
+            counters = dict(self.counters)
+        local = sum(counters.get(key, 0) for key in ("cache_hits", "question_hits", "db_hits"))
+        network = sum(counters.get(key, 0) for key in ("google_calls", "bot_calls"))
+        return {**counters, "network_calls": network, "network_calls_avoided": local}
+
+    def warm_up(self, background: Optional[bool] = True):
+        """
+        Load the database model and collection ahead of the first question, see DBMS.warm_up
+        """
+        return self.db.warm_up(background=background)
+
+    def _remember_question(self, ques: Text, df: pd.DataFrame) -> pd.DataFrame:
+        # read-only workers only spool the records, they have no ids until the writer stores them and
+        # publishes a snapshot, the index is then loaded again, see questions
+        if 'ids' in df:
+            self.questions.add(ques, df['ids'].tolist())
+        return df
+
+    def match_question(self, ques: Text) -> Optional[pd.DataFrame]:
+        """
+        Answer of a stored question near-identical to the question
+
+        Stored questions with the same numbers and symbols are prefiltered with rapidfuzz, then the
+        candidates are encoded with the question and the closest one is kept if its cosine distance is
+        within question_threshold.
+
+        Args:
+            ques: question
+
+        Returns:
+            dataframe of answer, the distances are the one of the matched question
+        """
+        candidates = self.questions.candidates(ques)
+        if not candidates:
+            return None
+        questions = [AnswerCache.normalize(ques)] + [question for question, _, _ in candidates]
+        embeddings = self.db.model.encode(questions)
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        distances = np.clip(1 - embeddings[1:] @ embeddings[0], 0, None)
+        best = int(np.argmin(distances))
+        distance = float(distances[best])
+        if distance > self.kwargs.get("question_threshold", 0.1):
+            return None
+        question, ids, score = candidates[best]
+        result = self.db.get(ids, include=["documents", "metadatas"])
+        if result.empty:
+            # answers removed since, e.g. by auto_clean
+            return None
+        print("\nMatch stored question: {} (score: {:.0f}, distance: {:.3f})".format(question, score, distance))
+        result['distances'] = distance
+        return result
 
     def search_db(self, ques: Text) -> Optional[pd.DataFrame]:
         """
@@ -61,11 +217,14 @@ class SearchEngine:
             dataframe of answer
         """
         print("\nAsk Google")
+        self._count("google_calls")
         result = self.google.ask(ques)
         if result:
             df = pd.DataFrame(result)
+            # kept with the answer so near-identical questions are answered locally, see match_question
+            df['metadatas'] = [{**metadata, "question": ques} for metadata in df['metadatas']]
             try:
-                df = self.db.insert(df)
+                df = self._remember_question(ques, self.db.insert(df))
             except Exception as e:
                 print(e)
                 pass
@@ -83,17 +242,18 @@ class SearchEngine:
             answer
         """
         print("\nAsk Bot")
+        self._count("bot_calls")
         query = self.bot.ask(ques)
         if query is None:
             return None
         answer = query.output
-        source = {"source": query.sources}
+        source = {"source": query.sources, "question": ques}
         df = pd.DataFrame({
             'documents': [answer],
             'metadatas': [source]
         })
         try:
-            df = self.db.insert(df)
+            df = self._remember_question(ques, self.db.insert(df))
         except Exception as e:
             # print(e)
             pass
@@ -103,25 +263,44 @@ class SearchEngine:
         """
         Search answer for question from collection or ask bot
 
+        Near-identical stored questions are tried first, then the collection, whatever its size, and Google
+        or the bot only when neither has an answer.
+
         Args:
             ques: question
 
         Returns:
             dataframe of answer
         """
-        if self.db.collection.count() < 20:
-            result = self.ask_google(ques)
-            if result is None and self.use_bot:
-                result = self.ask_bot(ques)
+        result = self.match_question(ques)
+        if result is not None:
+            self._count("question_hits")
             return result
-        else:
-            result = self.search_db(ques)
-            if result is None:
-                result = self.ask_google(ques)
-                if result is None and self.use_bot:
-                    result = self.ask_bot(ques)
+        result = self.search_db(ques)
+        if result is not None:
+            self._count("db_hits")
             return result
+        result = self.ask_google(ques)
+        if result is None and self.use_bot:
+            result = self.ask_bot(ques)
+        return result
 
     def search(self, ques: Text) -> Optional[pd.DataFrame]:
+        """
+        Search answer for question, answers found before are served from the cache
+
+        Args:
+            ques: question
+
+        Returns:
+            dataframe of answer
+        """
+        if self.cache:
+            data_found = self.cache.get(ques)
+            if data_found is not None:
+                self._count("cache_hits")
+                return data_found
         data_found = self.pipeline(ques)
+        if self.cache and data_found is not None:
+            self.cache.set(ques, data_found)
         return data_found
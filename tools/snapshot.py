@@ -0,0 +1,418 @@
+import os
+import json
+import time
+import uuid
+import pickle
+import shutil
+import sqlite3
+import threading
+import numpy as np
+import pandas as pd
+from typing import Text, Optional, List, Dict, Tuple
+from tools.vector_stores import VectorStore, where_sql, check_filters
+
+CURRENT = "CURRENT"
+
+
+def _write_segment(path: Text, collection, ids: Optional[List[Text]] = None,
+                   batch_size: Optional[int] = 5000) -> int:
+    """
+    Export records of a collection to a segment directory, all of them or the given ids
+
+    Returns:
+        number of records exported
+    """
+    os.makedirs(path)
+    conn = sqlite3.connect(os.path.join(path, "records.sqlite3"))
+    conn.execute("CREATE TABLE records (pos INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, document TEXT, "
+                 "metadata TEXT)")
+    embeddings = []
+    rows = 0
+    total = len(ids) if ids is not None else collection.count()
+    for start in range(0, total, batch_size):
+        include = ["embeddings", "documents", "metadatas"]
+        data = collection.get(ids=ids[start:start + batch_size], include=include) if ids is not None else \
+            collection.get(include=include, limit=batch_size, offset=start)
+        if not data["ids"]:
+            continue
+        conn.executemany("INSERT INTO records (pos, id, document, metadata) VALUES (?, ?, ?, ?)",
+                         [(rows + i, id_, document, json.dumps(metadata, ensure_ascii=False))
+                          for i, (id_, document, metadata) in enumerate(zip(data["ids"], data["documents"],
+                                                                           data["metadatas"]))])
+        embeddings.append(np.asarray(data["embeddings"], dtype=np.float32))
+        rows += len(data["ids"])
+    conn.commit()
+    conn.close()
+    embeddings = np.concatenate(embeddings) if embeddings else np.zeros((0, 0), dtype=np.float32)
+    if len(embeddings):
+        embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+    np.save(os.path.join(path, "embeddings.npy"), embeddings)
+    return rows
+
+
+def read_manifest(root: Text) -> Optional[Dict]:
+    """
+    Manifest of the current snapshot, None when nothing was published yet
+    """
+    try:
+        with open(os.path.join(root, CURRENT)) as f:
+            version = f.read().strip()
+        with open(os.path.join(root, version + ".json"), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def publish_snapshot(collection, root: Text, ids: Optional[List[Text]] = None, keep: Optional[int] = 2,
+                     max_segments: Optional[int] = 8, max_rows: Optional[int] = 2000000) -> Text:
+    """
+    Publish the records of a collection as a new read-only snapshot and make it current
+
+    A snapshot is a list of segments, directories with the L2 normalized embeddings as a float32 .npy file,
+    which readers memory-map, and the ids, documents and metadatas in an immutable SQLite file. Given the ids
+    inserted since the last publish, only those are exported to a new segment appended to the current
+    ones, the whole collection is exported again on the first publish or once max_segments are reached.
+    The CURRENT file is replaced atomically so readers switch to the new version on their next refresh
+    and only open the segments they do not have yet.
+
+    Readers search the embeddings exactly, every query reads all of them: above max_rows the collection
+    is better served by one process on the hnsw store than by read-only workers, publishing then fails.
+
+    Args:
+        collection: collection to export, anything with a chromadb-like get and count
+        root: directory holding the snapshots
+        ids: ids added since the last publish, None to export the whole collection
+        keep: number of versions kept, segments only used by older ones are removed
+        max_segments: number of segments after which the collection is exported again as one
+        max_rows: max number of records of a snapshot
+
+    Returns:
+        version of the new snapshot
+    """
+    os.makedirs(root, exist_ok=True)
+    manifest = read_manifest(root)
+    incremental = ids is not None and manifest is not None and len(manifest["segments"]) < max_segments
+    total = (sum(segment["rows"] for segment in manifest["segments"]) + len(ids)) if incremental else \
+        collection.count()
+    if max_rows and total > max_rows:
+        raise ValueError('Collection of {} records is above the {} records a snapshot may hold'.format(
+            total, max_rows))
+    version = "{:.6f}".format(time.time()).replace(".", "")
+    tmp_dir = os.path.join(root, "tmp-" + version)
+    rows = _write_segment(tmp_dir, collection, ids=ids if incremental else None)
+    name = "seg-" + version
+    os.replace(tmp_dir, os.path.join(root, name))
+    segments = (manifest["segments"] if incremental else []) + [{"name": name, "rows": rows}]
+    tmp_manifest = os.path.join(root, version + ".json.tmp")
+    with open(tmp_manifest, "w", encoding="utf-8") as f:
+        json.dump({"version": version, "segments": segments}, f)
+    os.replace(tmp_manifest, os.path.join(root, version + ".json"))
+    tmp_current = os.path.join(root, CURRENT + ".tmp")
+    with open(tmp_current, "w") as f:
+        f.write(version)
+    os.replace(tmp_current, os.path.join(root, CURRENT))
+
+    versions = sorted(name[:-len(".json")] for name in os.listdir(root)
+                      if name.endswith(".json") and name[:-len(".json")].isdigit())
+    for old in versions[:-keep]:
+        os.remove(os.path.join(root, old + ".json"))
+    used = set()
+    for kept in versions[-keep:]:
+        with open(os.path.join(root, kept + ".json"), encoding="utf-8") as f:
+            used.update(segment["name"] for segment in json.load(f)["segments"])
+    for old in os.listdir(root):
+        # segments of removed versions, and snapshot directories of the json records layout
+        if (old.startswith("seg-") and old not in used) or old.isdigit():
+            shutil.rmtree(os.path.join(root, old), ignore_errors=True)
+    return version
+
+
+class _Segment:
+    """
+    One published segment: memory-mapped embeddings and a read-only SQLite file of the records
+    """
+
+    def __init__(self, path: Text):
+        self.path = path
+        self.embeddings = np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r")
+        self.rows = len(self.embeddings)
+        self._lock = threading.Lock()
+        # published segments never change, SQLite can skip locking
+        self._conn = sqlite3.connect("file:{}?immutable=1".format(os.path.join(path, "records.sqlite3")),
+                                     uri=True, check_same_thread=False)
+
+    def _select(self, sql: Text, params: List) -> List[tuple]:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def records(self, positions: List[int]) -> Dict[int, tuple]:
+        records = {}
+        for start in range(0, len(positions), 500):
+            batch = [int(pos) for pos in positions[start:start + 500]]
+            records.update((row[0], row[1:]) for row in self._select(
+                "SELECT pos, id, document, metadata FROM records WHERE pos IN ({})".format(
+                    ",".join("?" * len(batch))), batch))
+        return records
+
+    def find(self, ids: List[Text], where: Optional[Dict] = None) -> Dict[Text, int]:
+        clause, params = where_sql(where) if where else ("1", [])
+        found = {}
+        for start in range(0, len(ids), 500):
+            batch = list(ids[start:start + 500])
+            found.update(self._select("SELECT id, pos FROM records WHERE id IN ({}) AND {}".format(
+                ",".join("?" * len(batch)), clause), batch + params))
+        return found
+
+    def positions(self, where: Optional[Dict] = None, limit: Optional[int] = None,
+                  offset: Optional[int] = 0) -> List[int]:
+        if not where and limit is None:
+            return list(range(offset, self.rows))
+        clause, params = where_sql(where) if where else ("1", [])
+        return [pos for pos, in self._select("SELECT pos FROM records WHERE {} ORDER BY pos LIMIT ? OFFSET ?".format(
+            clause), params + [limit if limit is not None else -1, offset])]
+
+    def count(self, where: Optional[Dict] = None) -> int:
+        if not where:
+            return self.rows
+        clause, params = where_sql(where)
+        return self._select("SELECT COUNT(*) FROM records WHERE {}".format(clause), params)[0][0]
+
+
+class SnapshotCollection(VectorStore):
+    """
+    Read-only collection over the current snapshot, shared by every worker through memory-mapping
+
+    Only count, query and get are supported, writes raise ValueError. Records stay on disk in the SQLite
+    file of their segment, a refresh only opens the segments published since the last one. Queries are
+    exact, see publish_snapshot for the size this suits.
+
+    Attributes:
+        root (Text): directory holding the snapshots
+        refresh_interval (float): seconds between checks for a newer snapshot
+        version (Text): version currently loaded
+    """
+
+    def __init__(self, root: Text, refresh_interval: Optional[float] = 5):
+        self.root = root
+        self.refresh_interval = refresh_interval
+        self.version = None
+        self._checked_at = 0
+        # segments swapped as a whole so readers never mix two versions
+        self._segments: Tuple[_Segment, ...] = ()
+        self._opened: Dict[Text, _Segment] = {}
+        self.refresh(force=True)
+
+    def refresh(self, force: Optional[bool] = False):
+        """
+        Load the current snapshot if it changed since the last check
+        """
+        now = time.time()
+        if not force and now - self._checked_at < self.refresh_interval:
+            return
+        self._checked_at = now
+        manifest = read_manifest(self.root)
+        if manifest is None or manifest["version"] == self.version:
+            return
+        opened = {name: self._opened.get(name) or _Segment(os.path.join(self.root, name))
+                  for name in (segment["name"] for segment in manifest["segments"])}
+        new = [name for name in opened if name not in self._opened]
+        self._segments = tuple(opened.values())
+        self._opened = opened
+        self.version = manifest["version"]
+        print("Load snapshot {} with {} records, {} new segments".format(
+            self.version, sum(segment.rows for segment in self._segments), len(new)))
+
+    def added_since(self, version: Optional[Text], include: Optional[List[Text]] = None) -> Optional[Dict]:
+        """
+        Records published after a version, when the current snapshot still contains it
+
+        Every version appends one segment named after it, the records of the segments following it are
+        the ones added since.
+
+        Args:
+            version: version loaded before
+            include: fields to return among documents, metadatas, embeddings
+
+        Returns:
+            dict of field -> list, None when the collection was exported again since that version
+        """
+        self.refresh()
+        segments = self._segments
+        names = [os.path.basename(segment.path) for segment in segments]
+        if version is None or "seg-" + version not in names:
+            return None
+        items = [(segment, pos) for segment in segments[names.index("seg-" + version) + 1:]
+                 for pos in range(segment.rows)]
+        return self._rows(items, include if include else ["documents", "metadatas"])
+
+    def count(self) -> int:
+        self.refresh()
+        return sum(segment.rows for segment in self._segments)
+
+    @staticmethod
+    def _rows(items: List[Tuple[_Segment, int]], include: List[Text]) -> Dict:
+        records = {}
+        for segment in {id(segment): segment for segment, _ in items}.values():
+            positions = [pos for other, pos in items if other is segment]
+            records[id(segment)] = segment.records(positions)
+        rows = [records[id(segment)][pos] for segment, pos in items]
+        result = {"ids": [row[0] for row in rows]}
+        if "documents" in include:
+            result["documents"] = [row[1] for row in rows]
+        if "metadatas" in include:
+            result["metadatas"] = [json.loads(row[2]) for row in rows]
+        if "embeddings" in include:
+            result["embeddings"] = [segment.embeddings[pos].tolist() for segment, pos in items]
+        return result
+
+    def query(self, query_embeddings: List[List[float]], n_results: Optional[int] = 10,
+              include: Optional[List[Text]] = None, where: Optional[Dict] = None, **kwargs) -> Dict:
+        """
+        Exact cosine search over the snapshot, same result layout as chromadb
+
+        Args:
+            query_embeddings: list of query embeddings
+            n_results: number of results per query
+            include: fields to return among documents, metadatas, embeddings, distances
+            where: metadata filter, see tools.vector_stores.match_where
+
+        Returns:
+            dict of field -> list (one entry per query) of lists
+        """
+        check_filters(kwargs)
+        self.refresh()
+        include = include if include else ["documents", "metadatas", "distances"]
+        segments = self._segments
+        keys = ["ids"] + [key for key in ["documents", "metadatas", "embeddings", "distances"] if key in include]
+        result = {key: [] for key in keys}
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        queries /= np.clip(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12, None)
+        # best n_results of every segment, then of all of them
+        candidates = [[] for _ in queries]
+        for segment in segments:
+            allowed = np.asarray(segment.positions(where), dtype=np.int64) if where else None
+            size = segment.rows if allowed is None else len(allowed)
+            k = min(n_results, size)
+            if k == 0:
+                continue
+            vectors = segment.embeddings if allowed is None else segment.embeddings[allowed]
+            distances = 1 - queries @ np.asarray(vectors).T
+            for i, row in enumerate(distances):
+                best = np.argpartition(row, k - 1)[:k]
+                positions = best if allowed is None else allowed[best]
+                candidates[i] += [(float(row[j]), segment, int(pos)) for j, pos in zip(best, positions)]
+        for found in candidates:
+            found = sorted(found, key=lambda candidate: candidate[0])[:n_results]
+            rows = self._rows([(segment, pos) for _, segment, pos in found], include)
+            rows["distances"] = [distance for distance, _, _ in found]
+            for key in keys:
+                result[key].append(rows[key])
+        return result
+
+    def get(self, ids: Optional[List[Text]] = None, include: Optional[List[Text]] = None,
+            limit: Optional[int] = None, offset: Optional[int] = None, where: Optional[Dict] = None,
+            **kwargs) -> Dict:
+        """
+        Get records by ids, or a page of records
+
+        Returns:
+            dict of field -> list
+        """
+        check_filters(kwargs)
+        self.refresh()
+        include = include if include else ["documents", "metadatas"]
+        offset = offset if offset else 0
+        items = []
+        if ids is not None:
+            found = {}
+            for segment in self._segments:
+                found.update((id_, (segment, pos)) for id_, pos in segment.find(ids, where).items())
+            items = [found[id_] for id_ in dict.fromkeys(ids) if id_ in found]
+            items = items[offset:offset + limit if limit else None]
+        else:
+            for segment in self._segments:
+                count = segment.count(where)
+                if offset >= count:
+                    offset -= count
+                    continue
+                remaining = limit - len(items) if limit else None
+                items += [(segment, pos) for pos in segment.positions(where, remaining, offset)]
+                offset = 0
+                if limit and len(items) >= limit:
+                    break
+        return self._rows(items, include)
+
+    def add(self, **kwargs):
+        raise ValueError('Snapshot collection is read-only, inserts go through the writer process')
+
+    update = add
+    delete = add
+
+
+class SpoolQueue:
+    """
+    Directory based queue carrying insert batches from read-only workers to the single writer
+
+    Batches the writer cannot store are moved to the failed/ directory with the error next to them,
+    they can be inspected and moved back to the spool directory to be retried.
+
+    Attributes:
+        root (Text): spool directory
+        failed_dir (Text): dead-letter directory
+    """
+
+    def __init__(self, root: Text):
+        self.root = root
+        self.failed_dir = os.path.join(self.root, "failed")
+        os.makedirs(self.failed_dir, exist_ok=True)
+
+    def submit(self, data: pd.DataFrame) -> Text:
+        """
+        Queue a dataframe for insertion
+
+        Args:
+            data: dataframe of data
+
+        Returns:
+            path of the spooled batch
+        """
+        name = "{:.6f}-{}".format(time.time(), uuid.uuid4().hex)
+        tmp_path = os.path.join(self.root, name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump(data, f)
+        # rename last so the writer never sees a partially written batch
+        path = os.path.join(self.root, name + ".pkl")
+        os.replace(tmp_path, path)
+        return path
+
+    def pending(self) -> List[Text]:
+        """
+        Spooled batches in submission order
+
+        Returns:
+            list of paths, load each with load and remove it once the batch is stored
+        """
+        return [os.path.join(self.root, name)
+                for name in sorted(name for name in os.listdir(self.root) if name.endswith(".pkl"))]
+
+    @staticmethod
+    def load(path: Text) -> pd.DataFrame:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+    def fail(self, path: Text, error: Exception) -> Text:
+        """
+        Move a batch to the dead-letter directory
+
+        Args:
+            path: path of the batch
+            error: why it failed, written next to it
+
+        Returns:
+            new path of the batch
+        """
+        failed_path = os.path.join(self.failed_dir, os.path.basename(path))
+        os.replace(path, failed_path)
+        with open(failed_path + ".error", "w", encoding="utf-8") as f:
+            f.write("{}: {}\n".format(type(error).__name__, error))
+        return failed_path
@@ -1,7 +1,20 @@
 import re
 import itertools
+import functools
+import multiprocessing
+import pandas as pd
 from typing import List, Optional, Tuple, Text
 
+RULE_FLAGS = re.MULTILINE | re.DOTALL | re.IGNORECASE
+
+DEFAULT_RULES = [(r'\[\^\d+\^]', ''),
+                 (r'< p>.*', ''),
+                 (r':\[.*', ''),
+                 (r'\\n\\n.*', ''),
+                 (r'Searching.*', ''),
+                 (r'(từ tương tự|hành chính|tham khảo|lịch sử|khái quát).*sửa đổi', ''),
+                 (r'Tra cứu.*?\.', '')]
+
 
 def replace_by_rule(rules: List[Tuple[Text, Text]], text: Text) -> Text:
     """
@@ -14,29 +27,135 @@ def replace_by_rule(rules: List[Tuple[Text, Text]], text: Text) -> Text:
     Returns:
         text after remove
     """
+    return TextCleaner.from_rules(rules)(text)
+
+
+def _truncation_marker(rule: Tuple[Text, Text]) -> Optional[Text]:
+    """
+    Literal marker of a rule cutting the text from the marker to the end, e.g. ('Searching.*', '')
+    """
+    pattern, repl = rule
+    prefix = pattern[:-2]
+    # plain characters and escaped punctuation only, e.g. r':\[' or r'\\n\\n'
+    if repl or not pattern.endswith('.*') or not re.fullmatch(r'(?:\\[^0-9A-Za-z]|[^\\.^$*+?{}()|\[\]])+', prefix):
+        return None
+    marker = re.sub(r'\\(.)', r'\1', prefix)
+    # cutting strips spaces, a marker starting or ending with one could stop matching
+    if marker != marker.strip(' '):
+        return None
+    return marker
+
+
+def _overlaps(first: Text, second: Text) -> bool:
+    first, second = first.lower(), second.lower()
+    for start in range(1, len(first)):
+        tail = first[start:]
+        if second.startswith(tail) or tail.startswith(second):
+            return True
+    return False
+
+
+def merge_rules(rules: List[Tuple[Text, Text]]) -> List[Tuple[Text, Text]]:
+    """
+    Merge consecutive rules cutting the text from a literal marker to the end into one alternation
+
+    Applying them one after the other cuts at the first marker found, like the alternation does, as long as
+    no marker can start inside another one, which is checked before merging.
+
+    Args:
+        rules: list of (pattern, replacement)
+
+    Returns:
+        list of (pattern, replacement)
+    """
+    merged, group = [], []
+
+    def close_group():
+        if len(group) > 1:
+            merged.append(('(?:{}).*'.format('|'.join(pattern[:-2] for pattern, _ in group)), ''))
+        else:
+            merged.extend(group)
+        group.clear()
+
     for rule in rules:
-        text = re.sub(rule[0], rule[1], text, flags=re.MULTILINE | re.DOTALL | re.IGNORECASE)
-        text = text.strip(' ')
-    return text
+        marker = _truncation_marker(rule)
+        markers = [_truncation_marker(other) for other in group]
+        if marker is not None and not any(_overlaps(marker, other) or _overlaps(other, marker) for other in markers):
+            group.append(rule)
+            continue
+        close_group()
+        if marker is not None:
+            group.append(rule)
+        else:
+            merged.append(rule)
+    close_group()
+    return merged
+
+
+class TextCleaner:
+    """
+    Cleaning rules compiled once, applied to a text or to a whole column
+
+    Attributes:
+        rules (List[Tuple[re.Pattern, Text]]): compiled patterns and their replacements, applied in order
+    """
+
+    def __init__(self, rules: List[Tuple[Text, Text]]):
+        self.rules = [(re.compile(pattern, RULE_FLAGS), repl) for pattern, repl in merge_rules(rules)]
+
+    @staticmethod
+    @functools.lru_cache(maxsize=32)
+    def _cached(rules: Tuple[Tuple[Text, Text], ...]) -> 'TextCleaner':
+        return TextCleaner(list(rules))
+
+    @staticmethod
+    def from_rules(rules: List[Tuple[Text, Text]]) -> 'TextCleaner':
+        """
+        Cleaner for rules, compiled on the first call only
+        """
+        return TextCleaner._cached(tuple(tuple(rule) for rule in rules))
+
+    def __call__(self, text: Text) -> Text:
+        for pattern, repl in self.rules:
+            text = pattern.sub(repl, text).strip(' ')
+        return text
+
+    def clean_series(self, series: pd.Series, processes: Optional[int] = None,
+                     min_rows_per_process: Optional[int] = 50000) -> pd.Series:
+        """
+        Clean every text of a column, in a process pool when the column is large enough to pay for it
+
+        Args:
+            series: column of texts
+            processes: max number of processes (default: number of cpus)
+            min_rows_per_process: rows each process should get at least
+
+        Returns:
+            cleaned column with the same index
+        """
+        texts = series.tolist()
+        processes = min(processes if processes else multiprocessing.cpu_count(), len(texts) // min_rows_per_process)
+        # daemon processes, e.g. the writer, are not allowed to start a pool
+        if processes > 1 and not multiprocessing.current_process().daemon:
+            # spawned, forking the threaded API or torch processes can deadlock the children
+            with multiprocessing.get_context("spawn").Pool(processes) as pool:
+                cleaned = pool.map(self, texts, chunksize=max(1, len(texts) // (processes * 4)))
+        else:
+            cleaned = [self(text) for text in texts]
+        return pd.Series(cleaned, index=series.index, name=series.name)
 
 
-def clean_data(rules: Optional[List], data):
+def clean_data(rules: Optional[List], data, processes: Optional[int] = None):
     """
     Clean data
 
     Args:
         rules: list of rules to clean data
         data: dataframe
+        processes: max number of processes for large dataframes (default: number of cpus)
     """
-    rules = rules if rules else []
-    rules = [(r'\[\^\d+\^]', ''),
-             (r'< p>.*', ''),
-             (r':\[.*', ''),
-             (r'\\n\\n.*', ''),
-             (r'Searching.*', ''),
-             (r'(từ tương tự|hành chính|tham khảo|lịch sử|khái quát).*sửa đổi', ''),
-             (r'Tra cứu.*?\.', '')] + rules
-    data['documents'] = data['documents'].apply(lambda x: replace_by_rule(rules, x))
+    rules = DEFAULT_RULES + (rules if rules else [])
+    data['documents'] = TextCleaner.from_rules(rules).clean_series(data['documents'], processes=processes)
     return data
 
 
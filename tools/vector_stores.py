@@ -0,0 +1,602 @@
+import os
+import abc
+import json
+import sqlite3
+import operator
+import threading
+import numpy as np
+from typing import Text, Optional, List, Dict, Tuple
+
+DEFAULT_INCLUDE = ["documents", "metadatas"]
+
+# chromadb where operators, a plain value means $eq
+WHERE_OPERATORS = {"$eq": ("=", operator.eq), "$ne": ("!=", operator.ne), "$gt": (">", operator.gt),
+                   "$gte": (">=", operator.ge), "$lt": ("<", operator.lt), "$lte": ("<=", operator.le)}
+
+
+def match_where(metadata: Optional[Dict], where: Dict) -> bool:
+    """
+    Whether a metadata passes a chromadb style where filter, e.g. {"source": "google", "year": {"$gte": 2020}}
+
+    Like chromadb, a metadata missing the key never passes the condition on it, even $ne and $nin.
+
+    Args:
+        metadata: metadata of a record
+        where: filter with $and/$or lists and $eq, $ne, $gt, $gte, $lt, $lte, $in, $nin conditions
+
+    Returns:
+        True if the metadata passes
+    """
+    metadata = metadata if metadata else {}
+    for key, condition in where.items():
+        if key in ("$and", "$or"):
+            matches = (match_where(metadata, sub_where) for sub_where in condition)
+            if not (all(matches) if key == "$and" else any(matches)):
+                return False
+            continue
+        if key not in metadata:
+            return False
+        value = metadata[key]
+        for op, operand in (condition if isinstance(condition, dict) else {"$eq": condition}).items():
+            if op in ("$in", "$nin"):
+                passed = (value in operand) == (op == "$in")
+            elif op in WHERE_OPERATORS:
+                try:
+                    passed = WHERE_OPERATORS[op][1](value, operand)
+                except TypeError:
+                    passed = False
+            else:
+                raise ValueError('Unknown where operator {}'.format(op))
+            if not passed:
+                return False
+    return True
+
+
+def where_sql(where: Dict, column: Optional[Text] = "metadata") -> Tuple[Text, List]:
+    """
+    SQLite condition of a chromadb style where filter on a json column, same semantics as match_where
+
+    Args:
+        where: filter, see match_where
+        column: json column holding the metadatas
+
+    Returns:
+        condition and its parameters
+    """
+    clauses, params = [], []
+    for key, condition in where.items():
+        if key in ("$and", "$or"):
+            parts = [where_sql(sub_where, column) for sub_where in condition]
+            joiner = " AND " if key == "$and" else " OR "
+            clauses.append("({})".format(joiner.join(part for part, _ in parts) if parts else
+                                         "1" if key == "$and" else "0"))
+            params += [param for _, part_params in parts for param in part_params]
+            continue
+        path = '$."{}"'.format(key.replace('"', '\\"'))
+        value = "json_extract({}, ?)".format(column)
+        clauses.append("json_type({}, ?) IS NOT NULL".format(column))
+        params.append(path)
+        for op, operand in (condition if isinstance(condition, dict) else {"$eq": condition}).items():
+            if op in ("$in", "$nin"):
+                clauses.append("{} {} ({})".format(value, "IN" if op == "$in" else "NOT IN", ",".join("?" * len(operand))))
+                params += [path] + list(operand)
+            elif op in WHERE_OPERATORS:
+                clauses.append("{} {} ?".format(value, WHERE_OPERATORS[op][0]))
+                params += [path, operand]
+            else:
+                raise ValueError('Unknown where operator {}'.format(op))
+    return " AND ".join(clauses) if clauses else "1", params
+
+
+def check_filters(kwargs: Dict):
+    """
+    Raise on query/get arguments a store without chromadb cannot honour, e.g. where_document, rather than
+    returning unfiltered records
+
+    Args:
+        kwargs: extra keyword arguments of a query or get call
+    """
+    unsupported = [key for key, value in kwargs.items() if value is not None]
+    if unsupported:
+        raise ValueError('Unsupported arguments for this vector store: {}'.format(", ".join(unsupported)))
+
+
+class VectorStore(abc.ABC):
+    """
+    Storage of documents, metadatas and embeddings used by DBMS
+
+    Arguments and results follow the chromadb collection API so DBMS works the same on every backend:
+    ids, embeddings, documents and metadatas are parallel lists, query returns one list per query embedding
+    and cosine distances (1 - cosine similarity).
+    """
+
+    @abc.abstractmethod
+    def add(self, ids: List[Text], embeddings: List[List[float]], documents: Optional[List[Text]] = None,
+            metadatas: Optional[List[Dict]] = None):
+        ...
+
+    @abc.abstractmethod
+    def update(self, ids: List[Text], embeddings: Optional[List[List[float]]] = None,
+               documents: Optional[List[Text]] = None, metadatas: Optional[List[Dict]] = None):
+        ...
+
+    @abc.abstractmethod
+    def delete(self, ids: List[Text]):
+        ...
+
+    @abc.abstractmethod
+    def query(self, query_embeddings: List[List[float]], n_results: Optional[int] = 10,
+              include: Optional[List[Text]] = None, **kwargs) -> Dict:
+        ...
+
+    @abc.abstractmethod
+    def get(self, ids: Optional[List[Text]] = None, include: Optional[List[Text]] = None,
+            limit: Optional[int] = None, offset: Optional[int] = None, **kwargs) -> Dict:
+        ...
+
+    @abc.abstractmethod
+    def count(self) -> int:
+        ...
+
+    def persist(self):
+        """
+        Write pending changes to disk, no-op for stores writing through
+        """
+
+    def recover(self):
+        """
+        Bring the store back to its last persisted state before the write-ahead log is replayed after a
+        crash, no-op for stores whose files are consistent with each other
+        """
+
+
+class ChromaStore(VectorStore):
+    """
+    Chromadb collection stored with duckdb+parquet
+
+    Chromadb 0.3 saves its whole hnsw index on every add, an insert costs O(collection size) whatever
+    the write-ahead log saves on the parquet persist, use HnswStore for inserts in O(1). The saved index
+    can therefore be ahead of the parquet files after a crash, see recover.
+
+    Attributes:
+        client (chromadb.Client): chromadb client
+        collection (chromadb.Collection): wrapped collection
+    """
+
+    def __init__(self, persist_directory: Text, collection_name: Text):
+        import chromadb
+        from chromadb.config import Settings
+        self.client = chromadb.Client(Settings(
+            chroma_db_impl="duckdb+parquet",
+            persist_directory=persist_directory
+        ))
+        self.collection = self.client.get_or_create_collection(collection_name, metadata={"hnsw:space": "cosine"})
+
+    def add(self, ids, embeddings, documents=None, metadatas=None):
+        self.collection.add(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+
+    def update(self, ids, embeddings=None, documents=None, metadatas=None):
+        self.collection.update(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+
+    def delete(self, ids):
+        self.collection.delete(ids=ids)
+
+    def query(self, query_embeddings, n_results=10, include=None, **kwargs):
+        return self.collection.query(query_embeddings=query_embeddings, n_results=n_results,
+                                     include=include if include else DEFAULT_INCLUDE + ["distances"], **kwargs)
+
+    def get(self, ids=None, include=None, limit=None, offset=None, **kwargs):
+        return self.collection.get(ids=ids, include=include if include else DEFAULT_INCLUDE,
+                                   limit=limit, offset=offset, **kwargs)
+
+    def count(self):
+        return self.collection.count()
+
+    def persist(self):
+        self.client.persist()
+
+    def recover(self):
+        # rebuild the hnsw index from the persisted rows, it may hold labels of rows lost with the crash
+        # and chromadb would refuse to add them again when the log is replayed
+        if self.collection.count():
+            self.collection.create_index()
+
+
+class HnswStore(VectorStore):
+    """
+    Vector store on hnswlib, a memory-mapped float32 matrix and a SQLite table of records
+
+    Every record gets an integer label, the row of its embedding in vectors.f32 and its label in the hnsw
+    index. Records (id, document, metadata) are written through to SQLite, the index and the matrix are
+    written by persist. When the saved index is behind SQLite after a crash, the missing labels are
+    re-added from the matrix on load.
+
+    Attributes:
+        path (Text): directory of the store
+        space (Text): hnswlib space, 'cosine' gives the same distances as chromadb
+        M (int): hnsw graph degree, higher is more accurate and uses more memory
+        ef_construction (int): candidate list size while building, higher is more accurate and slower
+        ef (int): candidate list size while searching, raised to n_results when smaller
+        exact_threshold (int): where filters keeping at most this many records are searched exactly
+    """
+
+    def __init__(self,
+                 path: Text,
+                 space: Optional[Text] = "cosine",
+                 M: Optional[int] = 16,
+                 ef_construction: Optional[int] = 200,
+                 ef: Optional[int] = 64,
+                 initial_capacity: Optional[int] = 10000,
+                 exact_threshold: Optional[int] = 10000):
+        self.path = path
+        self.space = space
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef = ef
+        self.initial_capacity = initial_capacity
+        self.exact_threshold = exact_threshold
+        os.makedirs(self.path, exist_ok=True)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(os.path.join(self.path, "records.sqlite3"), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS records "
+                           "(label INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, document TEXT, metadata TEXT)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.commit()
+        settings = dict(self._conn.execute("SELECT key, value FROM settings").fetchall())
+        self.dim = int(settings["dim"]) if "dim" in settings else None
+        self._next_label = int(settings.get("next_label", 0))
+        self._index = None
+        self._vectors = None
+        if self.dim is not None:
+            self._open()
+
+    @property
+    def _index_path(self) -> Text:
+        return os.path.join(self.path, "index.bin")
+
+    @property
+    def _vectors_path(self) -> Text:
+        return os.path.join(self.path, "vectors.f32")
+
+    def _set_setting(self, key: Text, value):
+        self._conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def _map_vectors(self, capacity: int):
+        if self._vectors is not None:
+            self._vectors.flush()
+        size = capacity * self.dim * 4
+        with open(self._vectors_path, "ab") as f:
+            if f.tell() < size:
+                f.truncate(size)
+        self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+
+    def _open(self):
+        import hnswlib
+        rows = os.path.getsize(self._vectors_path) // (self.dim * 4) if os.path.exists(self._vectors_path) else 0
+        capacity = max(rows, self.initial_capacity, self._next_label)
+        self._map_vectors(capacity)
+        self._index = hnswlib.Index(space=self.space, dim=self.dim)
+        labels = [label for label, in self._conn.execute("SELECT label FROM records ORDER BY label")]
+        if os.path.exists(self._index_path):
+            self._index.load_index(self._index_path, max_elements=capacity)
+            indexed = set(self._index.get_ids_list())
+            missing = [label for label in labels if label not in indexed]
+        else:
+            self._index.init_index(max_elements=capacity, ef_construction=self.ef_construction, M=self.M)
+            missing = labels
+        if missing:
+            print("Re-index {} records missing from the hnsw index".format(len(missing)))
+            self._index.add_items(np.asarray(self._vectors[missing]), missing)
+        self._index.set_ef(self.ef)
+
+    def _reserve(self, n: int):
+        capacity = self._vectors.shape[0]
+        if self._next_label + n <= capacity:
+            return
+        # grow geometrically so appending one record at a time stays cheap
+        capacity = max(capacity * 2, self._next_label + n)
+        self._map_vectors(capacity)
+        self._index.resize_index(capacity)
+
+    def _labels(self, ids: List[Text]) -> Dict[Text, int]:
+        labels = {}
+        for start in range(0, len(ids), 500):
+            batch = ids[start:start + 500]
+            rows = self._conn.execute("SELECT id, label FROM records WHERE id IN ({})".format(
+                ",".join("?" * len(batch))), batch).fetchall()
+            labels.update(rows)
+        return labels
+
+    def add(self, ids, embeddings, documents=None, metadatas=None):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if embeddings.ndim != 2 or len(embeddings) != len(ids):
+            raise ValueError('Need one embedding per id')
+        documents = documents if documents is not None else [None] * len(ids)
+        metadatas = metadatas if metadatas is not None else [None] * len(ids)
+        with self._lock:
+            if self.dim is None:
+                self.dim = embeddings.shape[1]
+                self._set_setting("dim", self.dim)
+                self._open()
+            elif embeddings.shape[1] != self.dim:
+                raise ValueError('Embedding dimension {} does not match store dimension {}'.format(
+                    embeddings.shape[1], self.dim))
+            existing = self._labels(list(ids))
+            if existing:
+                raise ValueError('IDs already exist: {}'.format(list(existing)[:10]))
+            self._reserve(len(ids))
+            labels = np.arange(self._next_label, self._next_label + len(ids))
+            try:
+                # the transaction commits once the vectors are indexed, the labels are only taken after it
+                with self._conn:
+                    self._conn.executemany(
+                        "INSERT INTO records (label, id, document, metadata) VALUES (?, ?, ?, ?)",
+                        [(int(label), id_, document, json.dumps(metadata, ensure_ascii=False))
+                         for label, id_, document, metadata in zip(labels, ids, documents, metadatas)])
+                    self._set_setting("next_label", self._next_label + len(ids))
+                    self._vectors[labels] = embeddings
+                    self._index.add_items(embeddings, labels)
+            except Exception:
+                # the next add reuses the labels, hnswlib replaces the vector of a label added again
+                indexed = set(self._index.get_ids_list())
+                for label in labels:
+                    if int(label) in indexed:
+                        try:
+                            self._index.mark_deleted(int(label))
+                        except RuntimeError:
+                            # already deleted by an earlier failed add
+                            pass
+                raise
+            self._next_label += len(ids)
+
+    def update(self, ids, embeddings=None, documents=None, metadatas=None):
+        with self._lock:
+            labels = self._labels(list(ids))
+            missing = [id_ for id_ in ids if id_ not in labels]
+            if missing:
+                raise ValueError('IDs not found: {}'.format(missing[:10]))
+            positions = [labels[id_] for id_ in ids]
+            if embeddings is not None:
+                embeddings = np.asarray(embeddings, dtype=np.float32)
+                self._vectors[positions] = embeddings
+                # hnswlib replaces the vector of a label added again
+                self._index.add_items(embeddings, positions)
+            with self._conn:
+                if documents is not None:
+                    self._conn.executemany("UPDATE records SET document = ? WHERE label = ?",
+                                           zip(documents, positions))
+                if metadatas is not None:
+                    self._conn.executemany("UPDATE records SET metadata = ? WHERE label = ?",
+                                           [(json.dumps(metadata, ensure_ascii=False), label)
+                                            for metadata, label in zip(metadatas, positions)])
+
+    def delete(self, ids):
+        with self._lock:
+            labels = self._labels(list(ids))
+            for label in labels.values():
+                self._index.mark_deleted(label)
+            with self._conn:
+                self._conn.executemany("DELETE FROM records WHERE label = ?", [(label,) for label in labels.values()])
+
+    def _records(self, labels: List[int]) -> Dict[int, tuple]:
+        records = {}
+        for start in range(0, len(labels), 500):
+            batch = labels[start:start + 500]
+            rows = self._conn.execute("SELECT label, id, document, metadata FROM records WHERE label IN ({})".format(
+                ",".join("?" * len(batch))), batch).fetchall()
+            records.update((row[0], row[1:]) for row in rows)
+        return records
+
+    def _rows(self, labels: List[int], records: Dict[int, tuple], include: List[Text]) -> Dict:
+        result = {"ids": [records[label][0] for label in labels]}
+        if "documents" in include:
+            result["documents"] = [records[label][1] for label in labels]
+        if "metadatas" in include:
+            result["metadatas"] = [json.loads(records[label][2]) for label in labels]
+        if "embeddings" in include:
+            result["embeddings"] = self._vectors[labels].tolist() if labels else []
+        return result
+
+    def _where_labels(self, where: Dict) -> List[int]:
+        clause, params = where_sql(where)
+        return [label for label, in self._conn.execute(
+            "SELECT label FROM records WHERE {} ORDER BY label".format(clause), params)]
+
+    def _exact_query(self, queries: np.ndarray, labels: List[int], k: int):
+        # brute force over a few labels, cheaper and more accurate than a filtered graph search
+        vectors = np.asarray(self._vectors[labels])
+        vectors = vectors / np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+        queries = queries / np.clip(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12, None)
+        distances = 1 - queries @ vectors.T
+        positions = np.argsort(distances, axis=1)[:, :k]
+        return np.asarray(labels)[positions], np.take_along_axis(distances, positions, axis=1)
+
+    def query(self, query_embeddings, n_results=10, include=None, where=None, **kwargs):
+        check_filters(kwargs)
+        include = include if include else DEFAULT_INCLUDE + ["distances"]
+        keys = ["ids"] + [key for key in ["documents", "metadatas", "embeddings", "distances"] if key in include]
+        result = {key: [] for key in keys}
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        with self._lock:
+            allowed = self._where_labels(where) if where else None
+            n_results = min(n_results, self.count() if allowed is None else len(allowed))
+            if n_results == 0:
+                for _ in query_embeddings:
+                    for key in keys:
+                        result[key].append([])
+                return result
+            self._index.set_ef(max(self.ef, n_results))
+            if allowed is None:
+                all_labels, all_distances = self._index.knn_query(queries, k=n_results)
+            elif len(allowed) <= max(self.exact_threshold, n_results * 10):
+                all_labels, all_distances = self._exact_query(queries, allowed, n_results)
+            else:
+                allowed_set = set(allowed)
+                try:
+                    all_labels, all_distances = self._index.knn_query(queries, k=n_results, num_threads=1,
+                                                                      filter=lambda label: label in allowed_set)
+                except RuntimeError:
+                    # the filtered graph search found fewer than n_results neighbours
+                    all_labels, all_distances = self._exact_query(queries, allowed, n_results)
+            records = self._records(sorted({int(label) for label in all_labels.ravel()}))
+            for labels, distances in zip(all_labels, all_distances):
+                # labels deleted since the last persist may still come back from a reloaded index
+                kept = [(int(label), float(distance)) for label, distance in zip(labels, distances)
+                        if int(label) in records]
+                rows = self._rows([label for label, _ in kept], records, include)
+                rows["distances"] = [distance for _, distance in kept]
+                for key in keys:
+                    result[key].append(rows[key])
+        return result
+
+    def get(self, ids=None, include=None, limit=None, offset=None, where=None, **kwargs):
+        check_filters(kwargs)
+        include = include if include else DEFAULT_INCLUDE
+        offset = offset if offset else 0
+        with self._lock:
+            if ids is not None:
+                labels = self._labels(list(ids))
+                labels = [labels[id_] for id_ in ids if id_ in labels]
+                if where:
+                    allowed = set(self._where_labels(where))
+                    labels = [label for label in labels if label in allowed]
+                labels = labels[offset:offset + limit if limit else None]
+            else:
+                clause, params = where_sql(where) if where else ("1", [])
+                labels = [label for label, in self._conn.execute(
+                    "SELECT label FROM records WHERE {} ORDER BY label LIMIT ? OFFSET ?".format(clause),
+                    params + [limit if limit else -1, offset])]
+            return self._rows(labels, self._records(labels), include)
+
+    def count(self):
+        return self._conn.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def persist(self):
+        with self._lock:
+            if self._index is None:
+                return
+            self._vectors.flush()
+            tmp_path = self._index_path + ".tmp"
+            self._index.save_index(tmp_path)
+            os.replace(tmp_path, self._index_path)
+
+    def close(self):
+        self.persist()
+        self._conn.close()
+
+
+class IdIndex:
+    """
+    Ids and content hashes of the records of a store, looked up before encoding to skip duplicates
+
+    Attributes:
+        path (Text): path to SQLite file
+    """
+
+    def __init__(self, path: Text):
+        self.path = path
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS ids (id TEXT PRIMARY KEY, hash TEXT)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ids_hash ON ids (hash)")
+        self._conn.commit()
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM ids").fetchone()[0]
+
+    def _select(self, column: Text, values: List[Text]) -> List[tuple]:
+        rows = []
+        with self._lock:
+            # stay under SQLite's limit of host parameters per statement
+            for start in range(0, len(values), 500):
+                batch = values[start:start + 500]
+                rows += self._conn.execute("SELECT id, hash FROM ids WHERE {} IN ({})".format(
+                    column, ",".join("?" * len(batch))), batch).fetchall()
+        return rows
+
+    def find_hashes(self, hashes: List[Text]) -> Dict[Text, Text]:
+        """
+        Returns:
+            dict of hash -> id for hashes already stored
+        """
+        return {hash_: id_ for id_, hash_ in self._select("hash", list(hashes))}
+
+    def find_ids(self, ids: List[Text]) -> set:
+        """
+        Returns:
+            set of ids already stored
+        """
+        return {id_ for id_, _ in self._select("id", list(ids))}
+
+    def page(self, after: Optional[Text] = "", limit: Optional[int] = 5000) -> List[Text]:
+        """
+        Ids in sorted order, paged by the last id seen so deletions and inserts never shift a page
+
+        Args:
+            after: last id of the previous page, empty for the first page
+            limit: max number of ids
+
+        Returns:
+            list of ids
+        """
+        with self._lock:
+            return [id_ for id_, in self._conn.execute("SELECT id FROM ids WHERE id > ? ORDER BY id LIMIT ?",
+                                                       (after, limit))]
+
+    def add(self, ids: List[Text], hashes: List[Text]):
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO ids (id, hash) VALUES (?, ?)", zip(ids, hashes))
+            self._conn.commit()
+
+    def remove(self, ids: List[Text]):
+        with self._lock:
+            self._conn.executemany("DELETE FROM ids WHERE id = ?", [(id_,) for id_ in ids])
+            self._conn.commit()
+
+    def rebuild(self, store: VectorStore, hash_func, batch_size: Optional[int] = 5000):
+        """
+        Index every record of a store again, e.g. records stored before the index existed
+
+        Args:
+            store: store to read from
+            hash_func: function of document -> hash
+            batch_size: number of records read at once
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM ids")
+            self._conn.commit()
+        total = store.count()
+        for offset in range(0, total, batch_size):
+            data = store.get(include=["documents"], limit=batch_size, offset=offset)
+            self.add(data["ids"], [hash_func(document) for document in data["documents"]])
+        print("Indexed ids of {} records".format(total))
+
+
+def migrate_chroma(source, target: VectorStore, batch_size: Optional[int] = 5000) -> int:
+    """
+    Copy every record of a store, e.g. a ChromaStore on the existing data directory, into another one
+
+    Args:
+        source: store or chromadb collection to read from
+        target: store to write to
+        batch_size: number of records copied at once
+
+    Returns:
+        number of records copied
+    """
+    total, copied = source.count(), 0
+    for offset in range(0, total, batch_size):
+        data = source.get(include=["embeddings", "documents", "metadatas"], limit=batch_size, offset=offset)
+        if not data["ids"]:
+            break
+        target.add(ids=data["ids"], embeddings=data["embeddings"],
+                   documents=data["documents"], metadatas=data["metadatas"])
+        copied += len(data["ids"])
+        print("Migrated {}/{} records".format(copied, total))
+    target.persist()
+    return copied
@@ -0,0 +1,80 @@
+import os
+import json
+import threading
+from typing import Text, Optional, Dict, Iterator
+
+
+def _to_json(value):
+    # numpy scalars coming from dataframes
+    return value.item() if hasattr(value, "item") else str(value)
+
+
+class WriteAheadLog:
+    """
+    Append-only log of writes made to a collection since it was last persisted
+
+    Every write is one json line, appending is O(1) whatever the size of the collection. The log is
+    replayed when the collection is opened again and emptied once the collection is persisted.
+
+    Attributes:
+        path (Text): path to the log file
+        fsync (bool): fsync after every append, survives power loss and not only process crashes
+        rows (int): number of records logged since the last truncate
+    """
+
+    def __init__(self, path: Text, fsync: Optional[bool] = False):
+        self.path = path
+        self.fsync = fsync
+        self.rows = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def append(self, op: Text, **records):
+        """
+        Log a write
+
+        Args:
+            op: 'add', 'update' or 'delete'
+            records: keyword arguments of the collection call, e.g. ids, embeddings, documents, metadatas
+        """
+        line = json.dumps({"op": op, **records}, ensure_ascii=False, default=_to_json)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self.rows += len(records.get("ids", []))
+
+    def replay(self) -> Iterator[Dict]:
+        """
+        Writes logged since the last truncate, in order
+
+        Returns:
+            iterator of dict with the op and the keyword arguments of the collection call
+        """
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # last line of a process killed while appending
+                    print("Skip incomplete write-ahead log entry")
+                    continue
+                self.rows += len(entry.get("ids", []))
+                yield entry
+
+    def truncate(self):
+        """
+        Empty the log, call once every logged write is persisted
+        """
+        with self._lock:
+            self._file.seek(0)
+            self._file.truncate()
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.rows = 0
+
+    def close(self):
+        with self._lock:
+            self._file.close()
@@ -5,6 +5,7 @@ from tqdm import tqdm
 from tabulate import tabulate
 
 from tools.search import SearchEngine
+from tools.runner import BatchRunner
 
 DATA_PATH = "D:/Projects/COT-lib/datasets/vnd.jsonl"
 
@@ -31,6 +32,9 @@ search_engine = SearchEngine(model_path='sentence-transformers/paraphrase-multil
                              use_bot=False, # True if you want to use BingAI
                              threshold=0.2)
 
+CONCURRENCY = 8
+RATE_LIMITS = {"google.com": 1}
+
 
 def save_result(data):
     if DATA_PATH.endswith(".csv"):
@@ -40,10 +44,10 @@ def save_result(data):
                      orient="records", lines=True, force_ascii=False)
 
 
-def process_question(index, row):
+def process_question(index, question):
     start_time = time.time()
-    print(f"\nQ:{row['instruction']}\n")
-    result_search = search_engine.search(row["instruction"])
+    print(f"\nQ:{question}\n")
+    result_search = search_engine.search(question)
     if result_search is None:
         cost_time = time.time() - start_time
         return index, "Không tìm thấy kết quả phù hợp", cost_time
@@ -72,18 +76,16 @@ def post_process_result(data_sheet, results):
 
 
 def process_all_questions(data_sheet):
-    results = []
-    for index, row in tqdm(data_sheet.iterrows(), total=len(data_sheet)):
-        try:
-            result = process_question(index, row)
-            results.append(result)
-        except Exception as e:
-            print(e)
-            results.append((index, "Không tìm thấy kết quả phù hợp", 0))
-        if len(results) % 10 == 0:
-            data_sheet = post_process_result(data_sheet, results)
-            save_result(data_sheet)
-
+    def checkpoint(results):
+        save_result(post_process_result(data_sheet, results))
+
+    runner = BatchRunner(search_engine,
+                         concurrency=CONCURRENCY,
+                         rate_limits=RATE_LIMITS,
+                         checkpoint_every=10,
+                         on_checkpoint=checkpoint,
+                         process=process_question)
+    results = runner.run(data_sheet["instruction"].items())
     data_sheet = post_process_result(data_sheet, results)
 
     return data_sheet
@@ -92,5 +94,6 @@ def process_all_questions(data_sheet):
 if __name__ == "__main__":
     data = process_all_questions(data)
     save_result(data)
+    print(search_engine.stats())
     search_engine.db.visualize()
     print("Done")